@@ -1,8 +1,11 @@
-import math
 import argparse
-import LatLon
 import itertools
 import os
+import sys
+
+# The beehive layout is shared with runserver.py's --beehive mode
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from pogom.transform import get_beehive_locations
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-lat", "--lat", help="latitude", type=float, required=True)
@@ -23,9 +26,6 @@ server_template = "nohup python runserver.py -os -l '{lat}, {lon}' &\n" #this is
 worker_template = "sleep 0.5; nohup python runserver.py -ns -l '{lat}, {lon}' -st {steps} {auth}&\n" # so is this
 auth_template = "-a {} -u {} -p '{}' "  # unix people want single-quoted passwords - for threading reasons whitespace after ' before ""
 
-R = 6378137.0
-r_hex = 52.5  # probably not correct
-
 args = parser.parse_args()
 steps = args.steps
 rings = args.leaps
@@ -65,60 +65,8 @@ output_fh.write(server_template.format(lat=args.lat, lon=args.lon))
 print("Generating raw coordinates to {}".format(args.output_raw))
 coords_fh = file(args.output_raw, 'wb')
 
-w_worker = (2 * steps - 1) * r_hex #convert the step limit of the worker into the r radius of the hexagon in meters?
-d = 2.0 * w_worker / 1000.0 #convert that into a diameter and convert to gps scale
-d_s = d
-
-brng_s = 0.0
-brng = 0.0
-mod = math.degrees(math.atan(1.732 / (6 * (steps - 1) + 3)))
-
-total_workers = (((rings * (rings - 1)) *3) + 1) # this mathamtically calculates the total number of workers
-
-locations = [LatLon.LatLon(LatLon.Latitude(0), LatLon.Longitude(0))] * total_workers #this initialises the list
-locations[0] = LatLon.LatLon(LatLon.Latitude(args.lat), LatLon.Longitude(args.lon)) #set the latlon for worker 0 from cli args
-
-
-turns = 0               # number of turns made in this ring (0 to 6)
-turn_steps = 0          # number of cells required to complete one turn of the ring
-turn_steps_so_far = 0   # current cell number in this side of the current ring
-
-
-for i in range(1, total_workers):
-    if turns == 6 or turn_steps == 0:
-        # we have completed a ring (or are starting the very first ring)
-        turns = 0
-        turn_steps += 1
-        turn_steps_so_far = 0
-
-    if turn_steps_so_far == 0:
-        brng = brng_s
-        loc = locations[0]
-        d = turn_steps * d
-    else:
-        loc = locations[0]
-        C = math.radians(60.0)#inside angle of a regular hexagon
-        a = d_s / R * 2.0 * math.pi #in radians get the arclength of the unit circle covered by d_s
-        b = turn_steps_so_far * d_s / turn_steps / R * 2.0 * math.pi #percentage of a
-         #the first spherical law of cosines gives us the length of side c from known angle C
-        c = math.acos(math.cos(a) * math.cos(b) + math.sin(a) * math.sin(b) * math.cos(C))
-         #turnsteps here represents ring number because yay coincidence always the same. multiply by derived arclength and convert to meters
-        d = turn_steps * c * R / 2.0 / math.pi
-        #from the first spherical law of cosines we get the angle A from the side lengths a b c
-        A = math.acos((math.cos(b) - math.cos(a) * math.cos(c)) / (math.sin(c) * math.sin(a))) 
-        brng = 60 * turns + math.degrees(A)
-
-    loc = loc.offset(brng + mod, d)
-    locations[i] = loc
-    d = d_s
-
-    turn_steps_so_far += 1
-    if turn_steps_so_far >= turn_steps:
-        # make a turn
-        brng_s += 60.0
-        brng = brng_s
-        turns += 1
-        turn_steps_so_far = 0
+locations = get_beehive_locations((args.lat, args.lon), steps, rings)
+total_workers = len(locations)
 
 #if threading is desired (-t flag) cycle through all accounts and merge them into an array (do this anyway because otherwise we need an if statement below)
 
@@ -137,7 +85,7 @@ location_and_auth = [(i, j) for i, j in itertools.izip(locations, accountStack)]
 
 for i, (location, auth) in enumerate(location_and_auth):
     threadname = "Movable{}".format(i)
-    output_fh.write(worker_template.format(lat=location.lat, lon=location.lon, steps=args.steps, auth=auth, threadname=threadname))
-    coords_fh.write(str(location.lat) + ", " + str(location.lon) + "\n")
+    output_fh.write(worker_template.format(lat=location[0], lon=location[1], steps=args.steps, auth=auth, threadname=threadname))
+    coords_fh.write(str(location[0]) + ", " + str(location[1]) + "\n")
     if args.verbose:
-        print("{}, {}".format(location.lat, location.lon))
+        print("{}, {}".format(location[0], location[1]))
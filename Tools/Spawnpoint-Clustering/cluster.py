@@ -1,5 +1,7 @@
 import argparse
 import json
+import math
+import multiprocessing
 import time
 import random
 
@@ -68,15 +70,13 @@ class Spawncluster(object):
         return new_centroid
             
 def cost(spawnpoint, cluster, time_threshold):
-    distance = utils.distance(spawnpoint.position, cluster.centroid)
-
     min_time = min(cluster.min_time, spawnpoint.time)
     max_time = max(cluster.max_time, spawnpoint.time)
 
     if max_time - min_time > time_threshold:
         return float('inf')
 
-    return distance
+    return utils.distance(spawnpoint.position, cluster.centroid)
     
 def check_cluster(spawnpoint, cluster, radius, time_threshold):
     # discard infinite cost or too far away
@@ -95,24 +95,166 @@ def check_cluster(spawnpoint, cluster, radius, time_threshold):
         
     return True
     
+class Grid(object):
+    '''
+    Indexes of things by their position, in cells at least size meters across,
+    so that everything within size of a position is in the 3x3 cells around it.
+    max_lat is the furthest from the equator the positions get.
+    '''
+    def __init__(self, size, max_lat):
+        # A degree of latitude is at least 110.5 km long, and one of longitude is the
+        # shortest at the furthest from the equator
+        self.lat_step = size / 110000.0
+        self.lng_step = min(360.0, size / (0.99 * utils.meters_per_degree_lng(min(abs(max_lat) + 0.1, 89.9))))
+        # Cells around the world (the last a bit wider), so they wrap around the antimeridian
+        self.columns = max(1, int(360 / self.lng_step))
+        self.cells = {}
+
+    def _cell(self, position):
+        return (int(math.floor(position[0] / self.lat_step)),
+                min(int((position[1] + 180) / self.lng_step), self.columns - 1))
+
+    def add(self, index, position):
+        self.cells.setdefault(self._cell(position), []).append(index)
+
+    def move(self, index, old_position, position):
+        old_cell = self._cell(old_position)
+        cell = self._cell(position)
+        if cell != old_cell:
+            self.cells[old_cell].remove(index)
+            self.cells.setdefault(cell, []).append(index)
+
+    # The cell and the cells around it
+    def around(self, cell):
+        row, column = cell
+        columns = set((column + i) % self.columns for i in (-1, 0, 1))
+        return [(r, c) for r in (row - 1, row, row + 1) for c in columns]
+
+    def near(self, position):
+        found = []
+        for cell in self.around(self._cell(position)):
+            found.extend(self.cells.get(cell, ()))
+        return found
+
+
 def cluster(spawnpoints, radius, time_threshold):
-  clusters = []
-  diameter = 2 * radius
-  
-  for p in spawnpoints:
-    if len(clusters) == 0:
-      clusters.append(Spawncluster(p))
-    else:
-      c = min(clusters, key=lambda x: cost(p, x, time_threshold))
-      
-      if check_cluster(p, c, radius, time_threshold):
-        c.append(p)
-      else:
-        c = Spawncluster(p)
+    clusters = []
+    if not spawnpoints:
+        return clusters
+
+    # A spawnpoint can't join a cluster more than 2 * radius away (see
+    # check_cluster), so only the clusters around it are looked at. Of those,
+    # the cheapest (the first made of the cheapest) is the one the spawnpoint
+    # would have been tried with out of all clusters.
+    grid = Grid(2 * radius, max(abs(p.position[0]) for p in spawnpoints))
+
+    for p in spawnpoints:
+        nearby = grid.near(p.position)
+        if nearby:
+            i = min(nearby, key=lambda i: (cost(p, clusters[i], time_threshold), i))
+            c = clusters[i]
+
+            if check_cluster(p, c, radius, time_threshold):
+                centroid = c.centroid
+                c.append(p)
+                grid.move(i, centroid, c.centroid)
+                continue
+
+        grid.add(len(clusters), p.position)
+        clusters.append(Spawncluster(p))
+
+    return clusters
+
+
+def regions(spawnpoints, radius):
+    '''
+    Splits spawnpoints into regions that cluster independently of each other, as
+    lists of their indexes in order. A spawnpoint only joins a cluster whose
+    centroid is within 2 * radius, and whose spawnpoints are then all within
+    3 * radius of it, so spawnpoints further than that from all the spawnpoints
+    of a region never end up in, or change, its clusters. Regions are made of
+    touching grid cells of that size with spawnpoints in them.
+    '''
+    if not spawnpoints:
+        return []
+
+    grid = Grid(3 * radius, max(abs(p.position[0]) for p in spawnpoints))
+    for i, p in enumerate(spawnpoints):
+        grid.add(i, p.position)
+
+    # Union-find of the cells
+    parents = dict((cell, cell) for cell in grid.cells)
+
+    def root(cell):
+        while parents[cell] != cell:
+            parents[cell] = parents[parents[cell]]
+            cell = parents[cell]
+        return cell
+
+    for cell in grid.cells:
+        for other in grid.around(cell):
+            if other in parents:
+                parents[root(cell)] = root(other)
+
+    found = {}
+    for cell, indexes in grid.cells.items():
+        found.setdefault(root(cell), []).extend(indexes)
+    return sorted(sorted(region) for region in found.values())
+
+
+# Clusters regions of (index, latitude, longitude, time), returning the clusters as lists of the indexes of their
+# spawnpoints. Plain tuples and lists go between processes much quicker than spawnpoints and clusters do.
+def cluster_regions(work):
+    regions, radius, time_threshold = work
+    clusters = []
+    for region in regions:
+        spawnpoints = [Spawnpoint({'sid': i, 'lat': lat, 'lng': lng, 'time': t}) for i, lat, lng, t in region]
+        for c in cluster(spawnpoints, radius, time_threshold):
+            clusters.append([p.spawnpoint_id for p in c])
+    return clusters
+
+
+def cluster_parallel(spawnpoints, radius, time_threshold, processes):
+    '''
+    cluster() on the regions of spawnpoints in processes, giving the same
+    clusters in the same order. Spawnpoints of separate areas (like a few
+    towns) make regions of their own, but those of a city are mostly close
+    enough to each other to be one region, and are clustered right here.
+    '''
+    if processes <= 1:
+        return cluster(spawnpoints, radius, time_threshold)
+
+    found = regions(spawnpoints, radius)
+    # Not worth sending them to other processes when one region would keep them waiting anyway
+    if max(len(region) for region in found) > len(spawnpoints) / 2:
+        return cluster(spawnpoints, radius, time_threshold)
+
+    # Share out the regions, the biggest first, to the processes with the
+    # fewest spawnpoints so far, a few batches per process to even them out
+    batches = [[] for i in range(processes * 4)]
+    sizes = [0] * len(batches)
+    for region in sorted(found, key=len, reverse=True):
+        smallest = sizes.index(min(sizes))
+        batches[smallest].append([(i, spawnpoints[i].position[0], spawnpoints[i].position[1], spawnpoints[i].time) for i in region])
+        sizes[smallest] += len(region)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(cluster_regions, [(batch, radius, time_threshold) for batch in batches if batch])
+    finally:
+        pool.close()
+        pool.join()
+
+    # Made again from the same spawnpoints in the same order, they get the same centroids
+    clusters = []
+    for indexes in sorted((indexes for result in results for indexes in result), key=lambda indexes: indexes[0]):
+        c = Spawncluster(spawnpoints[indexes[0]])
+        for i in indexes[1:]:
+            c.append(spawnpoints[i])
         clusters.append(c)
-        
-  return clusters
-  
+    return clusters
+
+
 def test(cluster, radius, time_threshold):
     assert cluster.max_time - cluster.min_time <= time_threshold
     
@@ -132,7 +274,7 @@ def main(args):
     print 'Processing', len(spawnpoints), 'spawnpoints...'
 
     start_time = time.time()
-    clusters = cluster(spawnpoints, radius, time_threshold)
+    clusters = cluster_parallel(spawnpoints, radius, time_threshold, args.processes)
     end_time = time.time()
 
     print 'Completed in {:.2f} seconds.'.format(end_time - start_time)
@@ -191,6 +333,7 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--radius', type=float, help='Maximum radius (in meters) where spawnpoints are considered close (defaults to 70).', default=70)
     parser.add_argument('-t', '--time-threshold', type=float, help='Maximum time threshold (in seconds) to consider when clustering (defaults to 180).', default=180)
     parser.add_argument('--long-keys', action='store_true', help='Uses prettier longer key names in the output spawnpoints.json.')
+    parser.add_argument('-j', '--processes', type=int, help='Number of processes to cluster separate areas in (defaults to the number of CPUs).', default=multiprocessing.cpu_count())
     
     args = parser.parse_args()
     
@@ -1,22 +1,15 @@
+import os
+import sys
 from math import acos, atan2, cos, degrees, pi, radians, sin, sqrt
 
-R = 6378137.0
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from pogom import geo
 
 def distance(pos1, pos2):
-    if pos1 == pos2:
-        return 0.0
+    return geo.distance(pos1[0], pos1[1], pos2[0], pos2[1])
 
-    lat1 = radians(pos1[0])
-    lon1 = radians(pos1[1])
-    lat2 = radians(pos2[0])
-    lon2 = radians(pos2[1])
-    
-    a = sin(lat1)*sin(lat2) + cos(lat1)*cos(lat2) * cos(lon2-lon1)
-    
-    if a > 1:
-        return 0.0
-    
-    return acos(a) * R
+def meters_per_degree_lng(lat):
+    return geo.Origin(lat, 0).kx
     
 def intermediate_point(pos1, pos2, f):
     if pos1 == pos2:
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Microbenchmarks
+
+Times the helpers the scanner calls over and over, on synthetic fixtures of
+realistic sizes, generated from a fixed seed so every run times the same work:
+
+ - transform.get_new_coords, for every step of every hex a worker walks
+ - transform.transform_from_wgs_to_gcj, for every scanned location, in and
+   out of China, and for every row of /raw_data with --china, one at a time
+   and all at once
+ - search.calc_distance and the geo distances, between scans, forts and
+   spawnpoints, from anywhere and from a fixed origin
+ - search.jitterLocation, for every step with -j
+ - HexSearch._generate_locations, every time a location is scanned anew
+ - models.parse_map, for every map response, with and without a cell cache,
+   for an average step and for one in the middle of a city with lots of forts
+
+Every benchmark is run a number of times (--repeat), each run calling the
+helper in a loop for at least --min-time seconds, and the median time per call
+is reported. Runs can be saved as a baseline and later runs compared to it:
+
+    python contrib/benchmark.py --save
+    ... change things ...
+    python contrib/benchmark.py --compare
+
+The comparison lists the change of every benchmark, and exits with 1 if any of
+them got slower by more than --threshold percent (or failed), so it can be used
+to check changes before committing them. contrib/benchmark-baseline.json is the
+baseline of the last change to one of these helpers; as timings depend on the
+machine, save a baseline of your own before comparing to it.
+'''
+
+import copy
+import json
+import logging
+import math
+import os
+import platform
+import random
+import re
+import sys
+import time
+import timeit
+import configargparse
+
+from datetime import datetime
+
+CONTRIB_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(CONTRIB_DIR)
+DEFAULT_BASELINE = os.path.join(CONTRIB_DIR, 'benchmark-baseline.json')
+
+parser = configargparse.ArgParser()
+parser.add_argument('-b', '--bench', help='Only run the benchmarks whose names match this regular expression')
+parser.add_argument('-r', '--repeat', help='Times to run every benchmark', type=int, default=5)
+parser.add_argument('-mt', '--min-time', help='Seconds every run of a benchmark takes at least', type=float, default=0.2)
+parser.add_argument('-s', '--seed', help='Seed for the fixtures', default='benchmark')
+parser.add_argument('--save', help='Save the results as a baseline (to contrib/benchmark-baseline.json without a file)',
+                    nargs='?', const=DEFAULT_BASELINE)
+parser.add_argument('--compare', help='Compare the results to a baseline (contrib/benchmark-baseline.json without a file)',
+                    nargs='?', const=DEFAULT_BASELINE)
+parser.add_argument('-t', '--threshold', help='Percent a benchmark may get slower than the baseline before it counts as a regression',
+                    type=float, default=10)
+parser.add_argument('-l', '--list', help='List the benchmarks and exit', action='store_true')
+
+# Where the fixtures are, the default location of the readme
+LOCATION = (40.7831, -73.9712, 0)
+CHINA_LOCATION = (39.9042, 116.4074, 0)
+
+# Points a fixture of distances or coordinates has; the helpers are timed per call
+POINTS = 1000
+
+
+# Random locations within meters of a location
+def scatter(rng, location, meters, count):
+    points = []
+    for i in range(count):
+        d = math.sqrt(rng.random()) * meters
+        b = math.radians(rng.uniform(0, 360))
+        lat = location[0] + d * math.cos(b) / 111111.0
+        lng = location[1] + d * math.sin(b) / (111111.0 * math.cos(math.radians(location[0])))
+        points.append((lat, lng, 0))
+    return points
+
+
+# A GET_MAP_OBJECTS response as the API sends it around location: a step of
+# 21 level 15 cells, with pokemon in the cells around the middle and the forts
+# of a busy part of a city
+def map_response(rng, location, cells=21, pokemon=30, pokestops=30, gyms=6):
+    now_ms = int(time.time() * 1000)
+    map_cells = [{'s2_cell_id': 9926595690000000000 + i, 'current_timestamp_ms': now_ms, 'forts': []} for i in range(cells)]
+
+    for i, (lat, lng, alt) in enumerate(scatter(rng, location, 70, pokemon)):
+        cell = map_cells[rng.randrange(cells // 3)]
+        cell.setdefault('wild_pokemons', []).append({
+            'encounter_id': rng.getrandbits(63),
+            'spawn_point_id': '89c25{:06x}'.format(rng.getrandbits(24)),
+            'latitude': lat,
+            'longitude': lng,
+            'last_modified_timestamp_ms': now_ms,
+            'time_till_hidden_ms': rng.randrange(60000, 1800000),
+            'pokemon_data': {'pokemon_id': rng.randint(1, 151)}
+        })
+
+    for i, (lat, lng, alt) in enumerate(scatter(rng, location, 1000, pokestops + gyms)):
+        fort = {
+            'id': '{:032x}.16'.format(rng.getrandbits(128)),
+            'latitude': lat,
+            'longitude': lng,
+            'enabled': True,
+            'last_modified_timestamp_ms': now_ms - rng.randrange(3600000)
+        }
+        if i < pokestops:
+            fort['type'] = 1
+            # A few of them lured
+            if rng.random() < 0.1:
+                fort['active_fort_modifier'] = 501
+        else:
+            fort.update({
+                'owned_by_team': rng.randint(0, 3),
+                'guard_pokemon_id': rng.randint(1, 151),
+                'gym_points': rng.randrange(50000)
+            })
+        map_cells[rng.randrange(cells)]['forts'].append(fort)
+
+    return {'responses': {'GET_MAP_OBJECTS': {'status': 1, 'map_cells': map_cells}}}
+
+
+# A queue that forgets what is put in it, so parse_map is timed without what
+# the database and webhook threads do with its results
+class Discard(object):
+
+    def put(self, item):
+        pass
+
+
+# The benchmarks, as name: function taking the seeded random number generator
+# and returning a function that calls the helper loops times and returns the
+# seconds that took, and the calls of the helper one loop makes
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+@benchmark('transform.get_new_coords')
+def bench_get_new_coords(rng):
+    from pogom.transform import get_new_coords
+
+    steps = [(location, rng.uniform(0.05, 1), rng.uniform(0, 360)) for location in scatter(rng, LOCATION, 5000, POINTS)]
+
+    def run(loops):
+        start = timeit.default_timer()
+        for i in xrange(loops):
+            for location, distance, bearing in steps:
+                get_new_coords(location, distance, bearing)
+        return timeit.default_timer() - start
+    return run, len(steps)
+
+
+def gcj_benchmark(location):
+    def setup(rng):
+        from pogom.transform import transform_from_wgs_to_gcj
+
+        points = scatter(rng, location, 20000, POINTS)
+
+        def run(loops):
+            start = timeit.default_timer()
+            for i in xrange(loops):
+                for lat, lng, alt in points:
+                    transform_from_wgs_to_gcj(lat, lng)
+            return timeit.default_timer() - start
+        return run, len(points)
+    return setup
+
+
+benchmark('transform.transform_from_wgs_to_gcj[china]')(gcj_benchmark(CHINA_LOCATION))
+benchmark('transform.transform_from_wgs_to_gcj[elsewhere]')(gcj_benchmark(LOCATION))
+
+
+@benchmark('transform.transform_from_wgs_to_gcj_batch[china]')
+def bench_gcj_batch(rng):
+    from pogom.transform import transform_from_wgs_to_gcj_batch
+
+    points = scatter(rng, CHINA_LOCATION, 20000, POINTS)
+    latitudes = [lat for lat, lng, alt in points]
+    longitudes = [lng for lat, lng, alt in points]
+
+    def run(loops):
+        start = timeit.default_timer()
+        for i in xrange(loops):
+            transform_from_wgs_to_gcj_batch(latitudes, longitudes)
+        return timeit.default_timer() - start
+    return run, len(points)
+
+
+# The rows of /raw_data for --china, the pokestops seen before
+@benchmark('transform.transform_rows_from_wgs_to_gcj[china, cached]')
+def bench_gcj_rows_cached(rng):
+    from pogom.transform import transform_rows_from_wgs_to_gcj
+
+    points = scatter(rng, CHINA_LOCATION, 20000, POINTS)
+    cache = {}
+    transform_rows_from_wgs_to_gcj([{'latitude': lat, 'longitude': lng} for lat, lng, alt in points], cache)
+
+    def run(loops):
+        elapsed = 0
+        for i in xrange(loops):
+            # The rows are transformed in place, so every loop needs new ones
+            rows = [{'latitude': lat, 'longitude': lng} for lat, lng, alt in points]
+            start = timeit.default_timer()
+            transform_rows_from_wgs_to_gcj(rows, cache)
+            elapsed += timeit.default_timer() - start
+        return elapsed
+    return run, len(points)
+
+
+def pairs(rng):
+    return zip(scatter(rng, LOCATION, 5000, POINTS), scatter(rng, LOCATION, 5000, POINTS))
+
+
+@benchmark('search.calc_distance')
+def bench_calc_distance(rng):
+    from pogom.search import calc_distance
+
+    fixture = pairs(rng)
+
+    def run(loops):
+        start = timeit.default_timer()
+        for i in xrange(loops):
+            for pos1, pos2 in fixture:
+                calc_distance(pos1, pos2)
+        return timeit.default_timer() - start
+    return run, len(fixture)
+
+
+@benchmark('geo.distance')
+def bench_geo_distance(rng):
+    from pogom.geo import distance
+
+    fixture = pairs(rng)
+
+    def run(loops):
+        start = timeit.default_timer()
+        for i in xrange(loops):
+            for pos1, pos2 in fixture:
+                distance(pos1[0], pos1[1], pos2[0], pos2[1])
+        return timeit.default_timer() - start
+    return run, len(fixture)
+
+
+# The distances of the forts and spawnpoints around a scan from it
+@benchmark('geo.Origin.distance')
+def bench_origin_distance(rng):
+    from pogom.geo import Origin
+
+    origin = Origin(LOCATION[0], LOCATION[1])
+    points = scatter(rng, LOCATION, 1000, POINTS)
+
+    def run(loops):
+        start = timeit.default_timer()
+        for i in xrange(loops):
+            for lat, lng, alt in points:
+                origin.distance(lat, lng)
+        return timeit.default_timer() - start
+    return run, len(points)
+
+
+@benchmark('geo.Origin.distances')
+def bench_origin_distances(rng):
+    from pogom.geo import Origin
+
+    origin = Origin(LOCATION[0], LOCATION[1])
+    points = scatter(rng, LOCATION, 1000, POINTS)
+    lats = [lat for lat, lng, alt in points]
+    lngs = [lng for lat, lng, alt in points]
+
+    def run(loops):
+        start = timeit.default_timer()
+        for i in xrange(loops):
+            origin.distances(lats, lngs)
+        return timeit.default_timer() - start
+    return run, len(points)
+
+
+@benchmark('search.jitterLocation')
+def bench_jitter_location(rng):
+    from pogom.search import jitterLocation
+
+    locations = scatter(rng, LOCATION, 5000, POINTS)
+    seed = rng.random()
+
+    def run(loops):
+        # jitterLocation draws from the random module, the same numbers every run
+        random.seed(seed)
+        start = timeit.default_timer()
+        for i in xrange(loops):
+            for location in locations:
+                jitterLocation(location)
+        return timeit.default_timer() - start
+    return run, len(locations)
+
+
+def hex_benchmark(step_limit):
+    def setup(rng):
+        from pogom.schedulers import HexSearch
+        from pogom.utils import get_args
+
+        args = copy.copy(get_args())
+        args.step_limit = step_limit
+        args.no_pokemon = False
+        scheduler = HexSearch([], [], args)
+        scheduler.scan_location = LOCATION
+
+        def run(loops):
+            start = timeit.default_timer()
+            for i in xrange(loops):
+                scheduler._generate_locations()
+            return timeit.default_timer() - start
+        return run, 1
+    return setup
+
+
+benchmark('HexSearch._generate_locations[st=10]')(hex_benchmark(10))
+benchmark('HexSearch._generate_locations[st=50]')(hex_benchmark(50))
+
+
+def parse_map_benchmark(cell_cache, **fixture):
+    def setup(rng):
+        from pogom.models import parse_map
+        from pogom.utils import CellCache, get_args
+
+        args = copy.copy(get_args())
+        args.webhooks = ['http://127.0.0.1/']
+        args.webhook_updates_only = False
+        args.slack_webhooks = []
+        args.gym_info = True
+        response = map_response(rng, LOCATION, **fixture)
+        queue = Discard()
+
+        def run(loops):
+            cache = None
+            if cell_cache:
+                # Every cell seen before, as when a worker scans its steps again
+                cache = CellCache()
+                parse_map(args, response, LOCATION, LOCATION, queue, queue, cache)
+            start = timeit.default_timer()
+            for i in xrange(loops):
+                parse_map(args, response, LOCATION, LOCATION, queue, queue, cache)
+            return timeit.default_timer() - start
+        return run, 1
+    return setup
+
+
+benchmark('models.parse_map')(parse_map_benchmark(False))
+benchmark('models.parse_map[cell cache]')(parse_map_benchmark(True))
+# Downtown, where the forts of a step are most of the work
+benchmark('models.parse_map[forts]')(parse_map_benchmark(False, pokemon=5, pokestops=300, gyms=60))
+benchmark('models.parse_map[forts, cell cache]')(parse_map_benchmark(True, pokemon=5, pokestops=300, gyms=60))
+
+
+# Runs a benchmark for at least min_time seconds, repeat times, and returns the seconds per call of every run
+def measure(run, calls, repeat, min_time):
+    # The loops one run needs, found by running it with more and more of them
+    loops = 1
+    while True:
+        elapsed = run(loops)
+        if elapsed >= min_time:
+            break
+        loops = max(loops * 2, int(loops * 1.2 * min_time / elapsed) if elapsed > 0 else 0)
+    runs = [elapsed]
+    while len(runs) < repeat:
+        runs.append(run(loops))
+    return [run_time / loops / calls for run_time in runs]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def stdev(values):
+    if len(values) < 2:
+        return 0.0
+    mean = sum(values) / float(len(values))
+    return math.sqrt(sum((value - mean) ** 2 for value in values) / (len(values) - 1))
+
+
+def format_time(seconds):
+    if seconds is None:
+        return '-'
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            return '{:.2f} {}'.format(seconds * scale, unit)
+    return '{:.0f} ns'.format(seconds * 1e9)
+
+
+# Prints the table comparing results to a baseline, returns the names of the benchmarks that got slower than threshold
+def compare(baseline, results, threshold):
+    regressions = []
+    rows = [('Benchmark', 'Baseline', 'Now', 'Change', '')]
+    for name in sorted(set(baseline['benchmarks']) | set(results['benchmarks'])):
+        before = baseline['benchmarks'].get(name, {}).get('median')
+        after = results['benchmarks'].get(name, {}).get('median')
+        if before is None or after is None:
+            rows.append((name, format_time(before), format_time(after), '', 'new' if before is None else 'not run'))
+            continue
+        change = (after - before) / before * 100
+        # Changes within the noise of either run don't count
+        noise = max(baseline['benchmarks'][name]['stdev'], results['benchmarks'][name]['stdev']) / before * 100
+        if change > threshold and change > noise:
+            verdict = 'slower'
+            regressions.append(name)
+        elif change < -threshold and -change > noise:
+            verdict = 'faster ({:.2f}x)'.format(before / after)
+        else:
+            verdict = ''
+        rows.append((name, format_time(before), format_time(after), '{:+.1f}%'.format(change), verdict))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print '  '.join(cell.ljust(width) if i in (0, 4) else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))).rstrip()
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+
+    # The pogom modules read their arguments on import; give them what they
+    # need to import without a config file
+    sys.argv = [sys.argv[0], '-l', '{},{}'.format(*LOCATION[:2]), '-u', 'benchmark', '-p', 'benchmark', '-k', 'benchmark']
+    sys.path.insert(0, ROOT_DIR)
+    logging.basicConfig(format='%(asctime)s [%(module)14s][%(levelname)8s] %(message)s')
+    # parse_map logs every response it parses
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from pogom import config
+    config['ROOT_PATH'] = ROOT_DIR
+    config['parse_pokemon'] = config['parse_pokestops'] = config['parse_gyms'] = True
+
+    selected = [(name, setup) for name, setup in BENCHMARKS if not args.bench or re.search(args.bench, name)]
+    if args.list:
+        for name, setup in selected:
+            print name
+        return 0
+    if not selected:
+        print >> sys.stderr, 'No benchmarks match {}'.format(args.bench)
+        return 1
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'repeat': args.repeat,
+        'min_time': args.min_time,
+        'benchmarks': {}
+    }
+    width = max(len(name) for name, setup in selected)
+    failed = []
+    for name, setup in selected:
+        # Every benchmark gets the same fixtures, whichever ones run before it
+        try:
+            run, calls = setup(random.Random('{}:{}'.format(args.seed, name)))
+            runs = measure(run, calls, args.repeat, args.min_time)
+        except Exception as e:
+            # A broken helper shouldn't keep the others from being timed
+            print '{}  failed: {!r}'.format(name.ljust(width), e)
+            failed.append(name)
+            continue
+        results['benchmarks'][name] = {'median': median(runs), 'stdev': stdev(runs), 'runs': runs}
+        print '{}  {:>10} +- {}'.format(name.ljust(width), format_time(median(runs)), format_time(stdev(runs)))
+
+    status = 1 if failed else 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        # Leave out the benchmarks of the baseline that weren't to be run
+        baseline['benchmarks'] = {name: result for name, result in baseline['benchmarks'].items()
+                                  if not args.bench or re.search(args.bench, name)}
+        print
+        print 'Compared to {} (Python {}, {}):'.format(args.compare, baseline['python'], baseline['date'])
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print
+            print '{} slower by more than {:g}%: {}'.format(len(regressions), args.threshold, ', '.join(regressions))
+            status = 1
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+        print 'Saved the results to {}'.format(args.save)
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,6 +13,13 @@ When first "logged into" it will create a static map of evenly distributed
 gyms and poke stops. As each "scan" is run, it will gerenate a set of pokemon
 for that scan area. "New" pokemon will be found every 10 minutes.
 
+With --spawnpoints it behaves more like the real thing instead: the map also
+gets spawnpoints, each with its own time in the hour pokemon appear at and
+stay 15, 30 or 60 minutes, and every scan answers with the 60-70 map cells
+around it and the pokemon within 70 meters. Once the map is made, GET
+/spawnpoints has the spawnpoints in the format of -ss/--spawnpoint-scanning
+files.
+
 You can run this as is, and then just add `-m http://127.0.0.1:9090` to your
 runserver.py call to start using it.
 '''
@@ -22,13 +29,11 @@ import configargparse
 import math
 
 from flask import Flask, jsonify
-from random import randint, getrandbits, seed, random
-from uuid import uuid4
+from random import Random, choice, randint, getrandbits, seed, random
 from time import time
 from s2sphere import CellId, LatLng
 import geopy
 from geopy.distance import VincentyDistance
-from geopy.distance import vincenty
 
 logging.basicConfig(format='%(asctime)s [%(threadName)16s][%(module)14s][%(levelname)8s] %(message)s')
 log = logging.getLogger()
@@ -38,6 +43,11 @@ parser = configargparse.ArgParser()
 parser.add_argument('-H', '--host', help='Server Host', default='127.0.0.1')
 parser.add_argument('-p', '--port', help='Server Port', default=9090, type=int)
 parser.add_argument('-d', '--debug', help='Debug Mode', action='store_true')
+parser.add_argument('-s', '--seed', help='Seed for the random map and pokemon, to get the same ones every run')
+parser.add_argument('-ga', '--gym-area', help='Square meters of map per gym', type=int, default=25000)
+parser.add_argument('-pa', '--pokestop-area', help='Square meters of map per pokestop', type=int, default=15000)
+parser.add_argument('-sp', '--spawnpoints', help='Hand out pokemon from spawnpoints on a schedule, and the map cells around scans, like the real thing', action='store_true')
+parser.add_argument('-spa', '--spawnpoint-area', help='Square meters of map per spawnpoint', type=int, default=2000)
 parser.set_defaults(DEBUG=False)
 args = parser.parse_args()
 
@@ -47,8 +57,28 @@ else:
     log.setLevel(logging.INFO)
 
 
+# Scans get the forts within this many meters
+FORT_RADIUS = 900
+
+# And with --spawnpoints, the pokemon within this many meters, and the level 15 cells within this many meters
+POKEMON_RADIUS = 70
+MAP_CELL_RADIUS = 1200
+
+# Share of the spawnpoints that stay up for 15, 30 and 60 minutes
+SPAWN_DURATIONS = ((15, 0.7), (30, 0.15), (60, 0.15))
+
 # A holder of gyms/pokestops
 forts = []
+fort_grid = None
+# fort id: id of the level 15 cell it is in
+fort_cells = {}
+
+# A holder of spawnpoints, with --spawnpoints
+spawnpoints = []
+spawnpoint_grid = None
+
+# Ids of the map cells around a scan location
+map_cells = {}
 
 
 def getRandomPoint(location=None, maxMeters=70):
@@ -59,28 +89,130 @@ def getRandomPoint(location=None, maxMeters=70):
     return (destination.latitude, destination.longitude)
 
 
-# TODO: This method is suuuuper inefficient.
-#       Namely, it loops over EVERY POSSIBLE fort and does a distance calc
-#       Not a time-cheap operation to do at all. It would be way more efficient
-#       if we had all the forts setup with s2 locations and could more quickly
-#       query for 'within XYZ cells'. Or something like that :/
+# Distance in meters, flat earth style: at the distances of a scan the difference doesn't matter
+def distance(a, b):
+    x = math.radians(b[1] - a[1]) * math.cos(math.radians((a[0] + b[0]) / 2))
+    y = math.radians(b[0] - a[0])
+    return 6371009 * math.sqrt(x * x + y * y)
+
+
+# Things with a latitude and longitude in a grid of cells radius meters wide, so finding those within radius
+# of a location only takes looking at the cell it is in and the ones around it
+class Grid(object):
+
+    def __init__(self, items, radius, lat):
+        self.radius = radius
+
+        # A degree of latitude is at least 110 km. Degrees of longitude get shorter away from the equator; size
+        # the cells for a degree further from it than lat, so they are wide enough for everything around it.
+        meters_per_degree = 110000.0
+        self.cell_size = (radius / meters_per_degree,
+                          radius / (meters_per_degree * math.cos(math.radians(min(abs(lat) + 1, 89)))))
+
+        self.cells = {}
+        for item in items:
+            self.cells.setdefault(self.cell((item['latitude'], item['longitude'])), []).append(item)
+
+    def cell(self, location):
+        return (int(math.floor(location[0] / self.cell_size[0])), int(math.floor(location[1] / self.cell_size[1])))
+
+    def near(self, location):
+        found = []
+        row, column = self.cell(location)
+        for cell in ((r, c) for r in (row - 1, row, row + 1) for c in (column - 1, column, column + 1)):
+            for item in self.cells.get(cell, ()):
+                if distance(location, (item['latitude'], item['longitude'])) < self.radius:
+                    found.append(item)
+        return found
+
+
+def cellId(item):
+    return CellId.from_lat_lng(LatLng.from_degrees(item['latitude'], item['longitude'])).parent(15).id()
+
+
 def getForts(location):
-    global forts
+    if fort_grid is None:
+        return []
+    return fort_grid.near(location)
+
+
+# The level 15 cells with their center within MAP_CELL_RADIUS of location
+def getMapCells(location):
+    if location in map_cells:
+        return map_cells[location]
+
+    start = CellId.from_lat_lng(LatLng.from_degrees(location[0], location[1])).parent(15)
+    found = set([start.id()])
+    todo = [start]
+    while todo:
+        for neighbor in todo.pop().get_edge_neighbors():
+            if neighbor.id() in found:
+                continue
+            center = neighbor.to_lat_lng()
+            if distance(location, (center.lat().degrees, center.lng().degrees)) < MAP_CELL_RADIUS:
+                found.add(neighbor.id())
+                todo.append(neighbor)
+
+    # Scans with --jitter are all over the place
+    if len(map_cells) > 100000:
+        map_cells.clear()
+    map_cells[location] = found
+    return found
+
+
+def makeSpawnpoints(lat, lng, r):
+    durations = []
+    for duration, share in SPAWN_DURATIONS:
+        durations += [duration] * int(share * 100)
+
+    points = []
+    for i in range(int(math.ceil(3.14 * r * r / args.spawnpoint_area))):
+        coords = getRandomPoint(location=(lat, lng), maxMeters=r)
+        cell = CellId.from_lat_lng(LatLng.from_degrees(coords[0], coords[1]))
+        points.append({
+            'id': cell.parent(20).to_token(),
+            'latitude': coords[0],
+            'longitude': coords[1],
+            'cell_id': cell.parent(15).id(),
+            # Seconds after the hour pokemon appear
+            'appears': randint(0, 3599),
+            # Minutes they stay
+            'duration': choice(durations)
+        })
+    return points
 
-    lforts = []
-    for i in forts:
-        f = (i['latitude'], i['longitude'])
-        d = vincenty(location, f).meters
-        if d < 900:
-            lforts.append(i)
 
-    return lforts
+# The pokemon up at the spawnpoints within POKEMON_RADIUS of location, with the ids of their cells
+def getSpawnedPokemon(location):
+    current = time()
+    pokes = []
+    for point in spawnpoint_grid.near(location):
+        # Time since the pokemon appeared, if it is still up
+        hour_start = current - (current - point['appears']) % 3600
+        up = current - hour_start
+        if up >= point['duration'] * 60:
+            continue
+
+        # The same spawn always has the same pokemon
+        spawn_id = '{}-{}'.format(point['id'], int(hour_start))
+        pokes.append((point['cell_id'], {
+            'encounter_id': 'pkm' + spawn_id,
+            'last_modified_timestamp_ms': int(current * 1000),
+            'latitude': point['latitude'],
+            'longitude': point['longitude'],
+            'pokemon_data': {'pokemon_id': Random(spawn_id).randint(1, 140)},
+            'spawn_point_id': point['id'],
+            'time_till_hidden_ms': int((point['duration'] * 60 - up) * 1000)
+        }))
+    return pokes
 
 
 def makeWildPokemon(location):
     # Cause the randomness to only shift every N minutes (thus new pokes every N minutes)
     offset = int(time() % 3600) / 10
     seedid = str(location[0]) + str(location[1]) + str(offset)
+    if args.seed is not None:
+        seedid = args.seed + seedid
     seed(seedid)
 
     # Now, collect the pokes for this can point
@@ -102,16 +234,18 @@ def makeWildPokemon(location):
 
 # Fancy app time
 app = Flask(__name__)
+# Pretty printing the scans of a big map takes more time than making them
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
 
-@app.route('/')
+@app.route('/', methods=['GET', 'POST'])
 def api_root():
     return 'This here be a Fake PokemonGo API Endpoint Server'
 
 
 @app.route('/login/<lat>/<lng>/<r>')
 def api_login(lat, lng, r):
-    global forts
+    global forts, fort_grid, fort_cells, spawnpoints, spawnpoint_grid
 
     if len(forts):
         # already generated
@@ -125,11 +259,14 @@ def api_login(lat, lng, r):
     forts = []
     area = 3.14 * (r * r)
 
+    if args.seed is not None:
+        seed(args.seed)
+
     # One gym every N sq.m
-    gymCount = int(math.ceil(area / 25000))
+    gymCount = int(math.ceil(area / args.gym_area))
 
     # One pks every N sq.m
-    pksCount = int(math.ceil(area / 15000))
+    pksCount = int(math.ceil(area / args.pokestop_area))
 
     # Gyms
     for i in range(gymCount):
@@ -158,25 +295,60 @@ def api_login(lat, lng, r):
             'type': 1
         })
 
+    fort_grid = Grid(forts, FORT_RADIUS, lat)
+    fort_cells = {fort['id']: cellId(fort) for fort in forts}
+
     log.info('Login for location %f,%f generated %d gyms, %d pokestop', lat, lng, gymCount, pksCount)
+
+    if args.spawnpoints:
+        spawnpoints = makeSpawnpoints(lat, lng, r)
+        spawnpoint_grid = Grid(spawnpoints, POKEMON_RADIUS, lat)
+        log.info('Generated %d spawnpoints', len(spawnpoints))
+
     return jsonify(forts)
 
 
 @app.route('/scan/<lat>/<lng>')
 def api_scan(lat, lng):
     location = (float(lat), float(lng))
-    cells = []
-    # for i in range(randint(60,70)):
-    for i in range(3):
-        cells.append({
+
+    # Hand out forts and pokemon in the level 15 S2 cells they are in, like the real thing
+    cells = {}
+
+    def add_cell(cell_id):
+        cells[cell_id] = {
             'current_timestamp_ms': int(time() * 1000),
-            'forts': getForts(location),
-            's2_cell_id': uuid4(),  # wrong, but also unused so it doesn't matter
-            'wild_pokemons': makeWildPokemon(location),
+            'forts': [],
+            's2_cell_id': cell_id,
+            'wild_pokemons': [],
             'catchable_pokemons': [],  # unused
             'nearby_pokemons': []  # unused
-        })
-    return jsonify({'responses': {'GET_MAP_OBJECTS': {'map_cells': cells}}})
+        }
+
+    def cell(cell_id):
+        if cell_id not in cells:
+            add_cell(cell_id)
+        return cells[cell_id]
+
+    if args.spawnpoints and spawnpoint_grid is not None:
+        for cell_id in getMapCells(location):
+            add_cell(cell_id)
+        pokemons = getSpawnedPokemon(location)
+    else:
+        pokemons = [(cellId(pokemon), pokemon) for pokemon in makeWildPokemon(location)]
+
+    for fort in getForts(location):
+        cell(fort_cells[fort['id']])['forts'].append(fort)
+    for cell_id, pokemon in pokemons:
+        cell(cell_id)['wild_pokemons'].append(pokemon)
+
+    return jsonify({'responses': {'GET_MAP_OBJECTS': {'map_cells': cells.values()}}})
+
+
+@app.route('/spawnpoints')
+def api_spawnpoints():
+    return jsonify([{'lat': point['latitude'], 'lng': point['longitude'], 'spawnpoint_id': point['id'], 'time': point['appears']}
+                    for point in spawnpoints])
 
 if __name__ == '__main__':
     app.run(threaded=True, debug=args.debug, host=args.host, port=args.port)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Load test
+
+Measures how much runserver.py gets done end to end, scanning the fake PokemonGo
+API (fake-pgo-api.py) as fast as it can. It starts the fake API with a fixed
+seed, a webhook receiver and runserver.py with a number of mock workers without
+any scan delay on a new database, lets it warm up, and then measures for a
+while:
+
+ - scans per second
+ - rows written to the database per second, by model
+ - webhook messages received per second, by type
+ - the highest length seen of the database, webhook, gym and search queues
+ - p50/p99 latency of /raw_data requests, made over and over while it runs
+
+The results are printed as JSON (and written to --output), so runs can be
+compared between changes and database backends:
+
+    python contrib/load-test.py -w 20 -t 60 -o results.json
+
+Everything after -- is passed on to runserver.py, e.g. to test with MySQL:
+
+    python contrib/load-test.py -w 20 -- --db-type mysql --db-name loadtest ...
+
+With the default SQLite database the test runs on a new database file in a
+temporary directory. Other databases are used as they are, so point them at
+one you don't mind being filled up (and pass -cd to start from scratch).
+'''
+
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import configargparse
+import requests
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+logging.basicConfig(format='%(asctime)s [%(threadName)16s][%(module)14s][%(levelname)8s] %(message)s')
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+logging.getLogger('requests').setLevel(logging.WARNING)
+
+CONTRIB_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(CONTRIB_DIR)
+
+parser = configargparse.ArgParser(usage='%(prog)s [options] [-- runserver.py options]')
+parser.add_argument('-w', '--workers', help='Number of search workers (and accounts)', type=int, default=10)
+parser.add_argument('-st', '--step-limit', help='Steps of the area every worker scans', type=int, default=5)
+parser.add_argument('-l', '--location', help='Location to scan, as latitude,longitude', default='40.7831,-73.9712')
+parser.add_argument('-s', '--seed', help='Seed for the map and pokemon of the fake API', default='loadtest')
+parser.add_argument('-sp', '--spawnpoints', help='Have the fake API hand out pokemon from spawnpoints, like the real thing', action='store_true')
+parser.add_argument('-wu', '--warmup', help='Seconds to let the scanner run before measuring', type=float, default=10)
+parser.add_argument('-t', '--duration', help='Seconds to measure for', type=float, default=60)
+parser.add_argument('-i', '--interval', help='Seconds between looks at the queues', type=float, default=1)
+parser.add_argument('-o', '--output', help='File to write the results to as JSON')
+parser.add_argument('-k', '--keep', help='Keep the temporary directory with the database and logs', action='store_true')
+
+
+# Counts the webhook messages runserver.py sends us
+class WebhookReceiver(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        HTTPServer.__init__(self, address, WebhookHandler)
+        self.lock = threading.Lock()
+        # Message type: how many of them arrived
+        self.received = {}
+
+    def counts(self):
+        with self.lock:
+            return dict(self.received)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        try:
+            message_type = json.loads(body)['type']
+        except (ValueError, KeyError, TypeError):
+            message_type = 'unknown'
+        with self.server.lock:
+            self.server.received[message_type] = self.server.received.get(message_type, 0) + 1
+
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_for(url, timeout, process):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+# The samples of a /metrics page, as (name, labels, value) tuples
+def parse_metrics(text):
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match is None:
+            continue
+        labels = dict(LABEL.findall(match.group(2) or ''))
+        samples.append((match.group(1), labels, float(match.group(3))))
+    return samples
+
+
+# The sum of the samples called name, by the value of their label by (or in total without one)
+def total(samples, name, by=None, **match):
+    totals = {}
+    for sample_name, labels, value in samples:
+        if sample_name != name or any(labels.get(key) != wanted for key, wanted in match.items()):
+            continue
+        key = labels.get(by) if by else 'total'
+        totals[key] = totals.get(key, 0) + value
+    return totals if by else totals.get('total', 0)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[int(round(q * (len(values) - 1)))], 1)
+
+
+# Makes /raw_data requests one after the other until stop is set, keeping their latency in ms
+def raw_data_client(url, params, latencies, stop):
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.time()
+        try:
+            session.get(url, params=params, timeout=30).raise_for_status()
+        except requests.exceptions.RequestException as e:
+            log.warning('/raw_data request failed: %s', e)
+            time.sleep(1)
+            continue
+        latencies.append((time.time() - start) * 1000)
+        time.sleep(0.1)
+
+
+def rates(start, end, elapsed):
+    return {key: round((end.get(key, 0) - start.get(key, 0)) / elapsed, 2) for key in end}
+
+
+def main():
+    args, runserver_args = parser.parse_known_args()
+    if runserver_args and runserver_args[0] == '--':
+        runserver_args = runserver_args[1:]
+
+    lat, lng = [float(x) for x in args.location.split(',')]
+    tmp_dir = tempfile.mkdtemp(prefix='pogom-loadtest-')
+    processes = []
+    receiver = None
+
+    try:
+        # The fake API, generating the same map every run
+        api_port = free_port()
+        api_log = open(os.path.join(tmp_dir, 'fake-pgo-api.log'), 'w')
+        command = [sys.executable, os.path.join(CONTRIB_DIR, 'fake-pgo-api.py'), '-p', str(api_port), '-s', args.seed]
+        if args.spawnpoints:
+            command.append('--spawnpoints')
+        processes.append(subprocess.Popen(command, stdout=api_log, stderr=subprocess.STDOUT))
+        if not wait_for('http://127.0.0.1:{}/'.format(api_port), 30, processes[-1]):
+            log.error('The fake API did not start, see %s', api_log.name)
+            return 1
+
+        receiver = WebhookReceiver(('127.0.0.1', free_port()))
+        t = threading.Thread(target=receiver.serve_forever, name='webhook-receiver')
+        t.daemon = True
+        t.start()
+
+        port = free_port()
+        command = [sys.executable, os.path.join(ROOT_DIR, 'runserver.py'),
+                   '-m', 'http://127.0.0.1:{}'.format(api_port),
+                   '-wh', 'http://127.0.0.1:{}/'.format(receiver.server_address[1]),
+                   '-H', '127.0.0.1', '-P', str(port),
+                   '-l', args.location, '-st', str(args.step_limit),
+                   '-w', str(args.workers), '-sd', '0', '-ld', '0', '-tc', '',
+                   '-k', 'loadtest', '-D', os.path.join(tmp_dir, 'pogom.db'), '-p', 'loadtest']
+        for i in range(args.workers):
+            command += ['-u', 'loadtest{}'.format(i)]
+        command += runserver_args
+
+        server_log = open(os.path.join(tmp_dir, 'runserver.log'), 'w')
+        log.info('Starting runserver.py with %d workers', args.workers)
+        processes.append(subprocess.Popen(command, stdout=server_log, stderr=subprocess.STDOUT, cwd=ROOT_DIR))
+
+        metrics_url = 'http://127.0.0.1:{}/metrics'.format(port)
+        if not wait_for(metrics_url, 60, processes[-1]):
+            log.error('runserver.py did not start, see %s', server_log.name)
+            return 1
+
+        log.info('Warming up for %g seconds', args.warmup)
+        time.sleep(args.warmup)
+
+        # The area scanned, roughly
+        span = args.step_limit * 0.0015
+        params = {'swLat': lat - span, 'swLng': lng - span, 'neLat': lat + span, 'neLng': lng + span,
+                  'pokemon': 'true', 'pokestops': 'true', 'gyms': 'true', 'scanned': 'true'}
+        latencies = []
+        stop = threading.Event()
+        client = threading.Thread(target=raw_data_client, name='raw-data-client',
+                                  args=('http://127.0.0.1:{}/raw_data'.format(port), params, latencies, stop))
+        client.daemon = True
+        client.start()
+
+        log.info('Measuring for %g seconds', args.duration)
+        high_water = {}
+        first = parse_metrics(requests.get(metrics_url, timeout=10).text)
+        first_webhooks = receiver.counts()
+        start = time.time()
+        while True:
+            time.sleep(args.interval)
+            samples = parse_metrics(requests.get(metrics_url, timeout=10).text)
+            queues = total(samples, 'pogom_queue_items', by='queue')
+            queues['search'] = total(samples, 'pogom_search_queue_items')
+            for queue, items in queues.items():
+                high_water[queue] = max(high_water.get(queue, 0), int(items))
+            if time.time() - start >= args.duration:
+                break
+        elapsed = time.time() - start
+        last = samples
+        last_webhooks = receiver.counts()
+        stop.set()
+        client.join()
+
+        if processes[-1].poll() is not None:
+            log.error('runserver.py stopped while it was being measured, see %s', server_log.name)
+            return 1
+
+        scans = total(last, 'pogom_worker_phase_seconds_count', phase='map_request') - total(first, 'pogom_worker_phase_seconds_count', phase='map_request')
+        db_rows = rates(total(first, 'pogom_db_upserted_rows_total', by='model'), total(last, 'pogom_db_upserted_rows_total', by='model'), elapsed)
+        webhooks = rates(first_webhooks, last_webhooks, elapsed)
+
+        results = {
+            'config': {
+                'workers': args.workers,
+                'step_limit': args.step_limit,
+                'location': args.location,
+                'seed': args.seed,
+                'spawnpoints': args.spawnpoints,
+                'warmup': args.warmup,
+                'duration': round(elapsed, 2),
+                'runserver_args': runserver_args
+            },
+            'scans_per_second': round(scans / elapsed, 2),
+            'db_rows_per_second': dict(db_rows, total=round(sum(db_rows.values()), 2)),
+            'webhook_messages_per_second': dict(webhooks, total=round(sum(webhooks.values()), 2)),
+            'queue_high_water': high_water,
+            'raw_data_latency_ms': {
+                'requests': len(latencies),
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99)
+            }
+        }
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        print output
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + '\n')
+        return 0
+
+    finally:
+        for process in reversed(processes):
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        if receiver is not None:
+            receiver.shutdown()
+        if args.keep:
+            log.info('Database and logs are in %s', tmp_dir)
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
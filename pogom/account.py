@@ -0,0 +1,427 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import time
+
+from threading import Condition, Lock, Thread
+from queue import Empty
+
+from pgoapi import PGoApi
+from pgoapi.auth_ptc import AuthPtc
+from pgoapi.auth_google import AuthGoogle
+
+log = logging.getLogger(__name__)
+
+# PTC doesn't always tell us when its access tokens expire; they are good for two hours
+PTC_TOKEN_LIFETIME = 7200
+
+# Access tokens of accounts in use closer than this to expiring are replaced by the refresher
+REFRESH_MARGIN = 600
+
+# Cooldowns double with every failed stint in a row, up to this many times the rest interval
+MAX_COOLDOWN_FACTOR = 16
+
+
+# Keeps the login sessions (access tokens and auth tickets) of accounts, so an account only has to log in
+# when its session has actually expired: not when a worker switches accounts, gets a new API object, or
+# the whole scanner is restarted. With a cache directory every account's session is kept in its own file
+# there, named after the account.
+#
+# A background thread keeps the cache up to date with the sessions in use, and gets accounts that are
+# in use new access tokens shortly before theirs expire, so workers hardly ever have to wait for a login.
+# Another one logs in the accounts given to prepare() that have no session yet, one after another, so
+# workers getting them later find their sessions ready.
+class LoginManager(object):
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self.lock = Lock()
+        # username: session dict, see _session()
+        self.sessions = {}
+        # username: (account, api, proxy_url) of the sessions being used by workers
+        self.live = {}
+
+        if self.cache_dir:
+            # Access tokens let anyone use the accounts, so only we get to read them
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0o700)
+            self._load()
+
+    def start(self):
+        t = Thread(target=self._refresher, name='token-refresher')
+        t.daemon = True
+        t.start()
+
+    # Log in the accounts that have no usable session in the background. proxies() returns the proxies to
+    # spread the logins over, if any.
+    def prepare(self, accounts, proxies=lambda: []):
+        t = Thread(target=self._prepare, name='login-preparer', args=(list(accounts), proxies))
+        t.daemon = True
+        t.start()
+        return t
+
+    def _prepare(self, accounts, proxies):
+        prepared = 0
+        for i, account in enumerate(accounts):
+            with self.lock:
+                # Workers log in the accounts they are using themselves
+                if self._usable(self.sessions.get(account['username']), account) or account['username'] in self.live:
+                    continue
+
+            available = proxies()
+            proxy_url = available[i % len(available)] if available else None
+            try:
+                api = self._login(account, proxy_url)
+            except Exception as e:
+                log.debug('Unable to log in account %s ahead of time: %s', account['username'], e)
+                continue
+
+            session = self._session(api._auth_provider, account, time.time())
+            if session['access_token']:
+                self._save(account, session)
+                prepared += 1
+
+        log.info('Logged in %d of %d accounts ahead of time', prepared, len(accounts))
+
+    # Log account in on a new API object, and return that
+    def _login(self, account, proxy_url):
+        api = PGoApi()
+        if proxy_url:
+            api.set_authentication(provider=account['auth_service'], username=account['username'], password=account['password'], proxy_config={'http': proxy_url, 'https': proxy_url})
+        else:
+            api.set_authentication(provider=account['auth_service'], username=account['username'], password=account['password'])
+        return api
+
+    # Whether session can be used for account for a while yet
+    def _usable(self, session, account):
+        return session is not None and session['auth_service'] == account['auth_service'] and bool(session['access_token']) and self._expires(session) >= time.time() + 60
+
+    # Give api the cached session of account, if it still has one. Returns False when account has to log in.
+    def restore(self, api, account, proxy_url):
+        with self.lock:
+            session = self.sessions.get(account['username'])
+        if not self._usable(session, account):
+            return False
+
+        if session['auth_service'] == 'google':
+            provider = AuthGoogle()
+        else:
+            provider = AuthPtc()
+        if proxy_url:
+            provider.set_proxy({'http': proxy_url, 'https': proxy_url})
+
+        # Lets the provider log in again by itself when it has to
+        provider._username = account['username']
+        provider._password = account['password']
+
+        provider._login = True
+        provider._access_token = session['access_token']
+        provider._access_token_expiry = session['access_token_expiry']
+        provider._refresh_token = session['refresh_token']
+        if session['ticket']:
+            provider.set_ticket(session['ticket'])
+
+        api._auth_provider = provider
+        self.track(api, account, proxy_url)
+
+        log.debug('Restored session of account %s, valid for another %d seconds', account['username'], self._expires(session) - time.time())
+        return True
+
+    # Remember the session api has just logged in with. Without an access token there is nothing to remember.
+    def store(self, api, account, proxy_url):
+        session = self._session(api._auth_provider, account, time.time())
+        if not session['access_token']:
+            log.warning('Not keeping the session of account %s, it has no access token', account['username'])
+            return
+
+        self._save(account, session)
+        self.track(api, account, proxy_url)
+
+    # Drop the session of account, so it logs in from scratch next time
+    def forget(self, account):
+        with self.lock:
+            self.sessions.pop(account['username'], None)
+            self.live.pop(account['username'], None)
+
+        if self.cache_dir and os.path.exists(self._path(account['username'])):
+            try:
+                os.remove(self._path(account['username']))
+            except OSError as e:
+                log.warning('Unable to remove token cache file of account %s: %s', account['username'], e)
+
+    # Follow the session api is using, e.g. when it has been moved to another proxy
+    def track(self, api, account, proxy_url):
+        with self.lock:
+            self.live[account['username']] = (account, api, proxy_url)
+
+    # When the session can no longer be used without logging in again
+    def _expires(self, session):
+        # Google refresh tokens don't expire; pgoapi gets new access tokens with them by itself
+        if session['refresh_token']:
+            return float('inf')
+
+        token_expiry = session['access_token_expiry'] or session['login_time'] + PTC_TOKEN_LIFETIME
+        ticket_expiry = session['ticket'][0] / 1000.0 if session['ticket'] else 0
+        return max(token_expiry, ticket_expiry)
+
+    def _session(self, provider, account, login_time):
+        ticket = None
+        if getattr(provider, '_ticket_expire', None):
+            ticket = [provider._ticket_expire, provider._ticket_start, provider._ticket_end]
+
+        return {
+            'auth_service': account['auth_service'],
+            'access_token': getattr(provider, '_access_token', None),
+            'access_token_expiry': getattr(provider, '_access_token_expiry', 0) or 0,
+            'refresh_token': getattr(provider, '_refresh_token', None),
+            'ticket': ticket,
+            'login_time': login_time
+        }
+
+    def _path(self, username):
+        return os.path.join(self.cache_dir, re.sub(r'[^\w.@-]', '_', username) + '.json')
+
+    def _load(self):
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, filename)) as f:
+                    data = json.load(f)
+                self.sessions[data['username']] = data['session']
+            except (IOError, ValueError, KeyError) as e:
+                log.warning('Ignoring unreadable token cache file %s: %s', filename, e)
+        log.info('Loaded %d cached login sessions', len(self.sessions))
+
+    def _save(self, account, session):
+        with self.lock:
+            if self.sessions.get(account['username']) == session:
+                return
+            self.sessions[account['username']] = session
+
+        if not self.cache_dir:
+            return
+
+        # Write a new file and move it into place, so a crash can't leave half a file behind
+        path = self._path(account['username'])
+        try:
+            with os.fdopen(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump({'username': account['username'], 'session': session}, f)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            log.warning('Unable to write token cache file %s: %s', path, e)
+
+    def _refresher(self):
+        while True:
+            time.sleep(60)
+            self.refresh()
+
+    # Save the sessions in use, and get new access tokens for those about to expire
+    def refresh(self):
+        with self.lock:
+            live = self.live.values()
+
+        for account, api, proxy_url in live:
+            provider = api._auth_provider
+            if provider is None:
+                continue
+
+            # Sessions in use get new tickets with every request; keep the cache up to date with them.
+            # Unless the session has been forgotten since.
+            with self.lock:
+                stored = self.sessions.get(account['username'])
+            if stored is None:
+                continue
+            login_time = stored['login_time']
+            session = self._session(provider, account, login_time)
+            self._save(account, session)
+
+            # Accounts that are no longer being used (their ticket ran out) are left to expire
+            if not session['ticket'] or session['ticket'][0] / 1000.0 < time.time():
+                continue
+
+            # Get a new access token before the current one expires, so the worker doesn't have to log
+            # in again in the middle of a scan as soon as its ticket is not accepted anymore
+            token_expiry = session['access_token_expiry'] or login_time + PTC_TOKEN_LIFETIME
+            if session['refresh_token'] or token_expiry > time.time() + REFRESH_MARGIN:
+                continue
+
+            log.debug('Access token of account %s is about to expire, logging in again', account['username'])
+            try:
+                new_api = self._login(account, proxy_url)
+            except Exception as e:
+                log.warning('Unable to refresh access token of account %s: %s', account['username'], e)
+                continue
+
+            # Hand the new access token to the worker, keeping its current ticket
+            provider._access_token = new_api._auth_provider._access_token
+            provider._access_token_expiry = getattr(new_api._auth_provider, '_access_token_expiry', 0)
+            self._save(account, self._session(provider, account, time.time()))
+
+
+# All accounts of a search overseer, with how well they have been doing.
+#
+# Accounts are either ready, kept in a heap by health so workers get the healthiest one first, or resting,
+# kept in a heap by the time they are ready again. Getting and returning accounts is O(log n).
+#
+# An account returned after a rest interval, or because of an exception in the worker rather than a problem
+# with the account, is ready again after --account-rest-interval. An account returned because it failed gets
+# a cooldown starting at the rest interval, and doubling for every failed stint in a row; a scan with finds
+# ends the row. A stint without a single scan with finds is a sign of a ban, and gets the longest cooldown.
+#
+# Has the get()/get_nowait()/qsize() of a Queue, so workers can wait for accounts like for anything else.
+class AccountPool(object):
+
+    def __init__(self, args, accounts):
+        self.args = args
+        self.cond = Condition()
+        self.counter = itertools.count()
+        # username: account and stats
+        self.accounts = {}
+        # (-health, sequence, username) of the ready accounts
+        self.ready = []
+        # (ready time, sequence, username) of the resting accounts
+        self.resting = []
+
+        for account in accounts:
+            self.add(account)
+
+    def add(self, account):
+        with self.cond:
+            self.accounts[account['username']] = {
+                'account': account,
+                'success': 0,
+                'fail': 0,
+                'noitems': 0,
+                # Of the current stint
+                'stint_scans': 0,
+                'stint_success': 0,
+                # Failed stints in a row
+                'strikes': 0,
+                'ready_time': 0,
+                'reason': None,
+                'ban_suspected': False
+            }
+            self._make_ready(account['username'])
+            self.cond.notify()
+
+    # Health of an account: its rate of scans with finds (starting out at 1/2), lower with every strike
+    def health(self, stats):
+        scans = stats['success'] + stats['fail'] + stats['noitems']
+        return (stats['success'] + 1.0) / (scans + 2) / (1 + stats['strikes'])
+
+    def _make_ready(self, username):
+        heapq.heappush(self.ready, (-self.health(self.accounts[username]), next(self.counter), username))
+
+    # Move accounts that have rested long enough over to the ready heap
+    def _wake(self):
+        current = time.time()
+        while self.resting and self.resting[0][0] <= current:
+            username = heapq.heappop(self.resting)[2]
+            stats = self.accounts[username]
+            log.info('Account %s returning to active duty.', username)
+            stats['reason'] = None
+            self._make_ready(username)
+
+    def _take(self):
+        stats = self.accounts[heapq.heappop(self.ready)[2]]
+        stats['stint_scans'] = 0
+        stats['stint_success'] = 0
+        return stats['account']
+
+    def get_nowait(self):
+        with self.cond:
+            self._wake()
+            if not self.ready:
+                raise Empty
+            return self._take()
+
+    def get(self, block=True, timeout=None):
+        if not block:
+            return self.get_nowait()
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                self._wake()
+                if self.ready:
+                    return self._take()
+
+                wait = None
+                if self.resting:
+                    wait = self.resting[0][0] - time.time()
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+
+                # add() and release() notify us of accounts that are ready right away
+                self.cond.wait(wait)
+
+    # Number of accounts ready to be used
+    def qsize(self):
+        with self.cond:
+            self._wake()
+            return len(self.ready)
+
+    # Number of accounts resting or cooling down
+    def resting_count(self):
+        with self.cond:
+            return len(self.resting)
+
+    # The resting accounts, as (account, ready time, reason) tuples, the first to be ready first
+    def get_resting(self):
+        with self.cond:
+            return [(self.accounts[username]['account'], ready_time, self.accounts[username]['reason'])
+                    for ready_time, sequence, username in sorted(self.resting)]
+
+    # Record the result of a scan: 'success' (with finds), 'noitems' or 'fail'
+    def record(self, account, result):
+        with self.cond:
+            stats = self.accounts[account['username']]
+            stats[result] += 1
+            stats['stint_scans'] += 1
+            if result == 'success':
+                stats['stint_success'] += 1
+                stats['strikes'] = 0
+                stats['ban_suspected'] = False
+
+    # Take back an account a worker is done with. reason is 'rest interval' for an account that has been
+    # working long enough, 'exception' when the worker ran into one, anything else when it has been failing.
+    def release(self, account, reason):
+        with self.cond:
+            stats = self.accounts[account['username']]
+
+            if reason == 'rest interval':
+                stats['strikes'] = 0
+                stats['ban_suspected'] = False
+                rest = self.args.account_rest_interval
+            elif reason == 'exception':
+                rest = self.args.account_rest_interval
+            else:
+                stats['strikes'] += 1
+                stats['ban_suspected'] = stats['stint_success'] == 0 and stats['stint_scans'] >= self.args.max_failures
+                if stats['ban_suspected']:
+                    factor = MAX_COOLDOWN_FACTOR
+                    reason += ', ban suspected'
+                    log.warning('Account %s had no finds in %d scans, it may be banned', account['username'], stats['stint_scans'])
+                else:
+                    factor = min(2 ** (stats['strikes'] - 1), MAX_COOLDOWN_FACTOR)
+                rest = self.args.account_rest_interval * factor
+
+            stats['reason'] = reason
+            stats['ready_time'] = time.time() + rest
+            heapq.heappush(self.resting, (stats['ready_time'], next(self.counter), account['username']))
+            log.info('Account %s needs to cool off for %d seconds due to %s', account['username'], rest, reason)
+
+            # Someone may be waiting for an account that is ready earlier than this one
+            self.cond.notify()
@@ -3,8 +3,9 @@
 
 import calendar
 import logging
+import time
 
-from flask import Flask, abort, jsonify, render_template, request
+from flask import Flask, Response, abort, g, jsonify, render_template, request
 from flask.json import JSONEncoder
 from flask_compress import Compress
 from datetime import datetime
@@ -15,6 +16,7 @@ from collections import OrderedDict
 
 from . import config
 from .models import Pokemon, Gym, Pokestop, ScannedLocation, MainWorker, WorkerStatus
+from . import metrics
 from .utils import now
 log = logging.getLogger(__name__)
 compress = Compress()
@@ -35,6 +37,10 @@ class Pogom(Flask):
         self.route("/stats", methods=['GET'])(self.get_stats)
         self.route("/status", methods=['GET'])(self.get_status)
         self.route("/status", methods=['POST'])(self.post_status)
+        self.route("/metrics", methods=['GET'])(self.get_metrics)
+        self.before_request(self.start_request_timer)
+        self.after_request(self.record_request_time)
+        self.status_registry = None
 
     def set_search_control(self, control):
         self.search_control = control
@@ -48,6 +54,33 @@ class Pogom(Flask):
     def set_current_location(self, location):
         self.current_location = location
 
+    def set_status_registry(self, registry):
+        self.status_registry = registry
+
+    # The status of the workers of all instances, as (main workers, workers). Those of this instance come
+    # straight from its status registry, the others from the database.
+    def get_worker_statuses(self):
+        if self.status_registry is None:
+            return MainWorker.get_all(), WorkerStatus.get_all()
+
+        overseer, workers = self.status_registry.snapshot()
+        main_workers = MainWorker.get_all_except(self.status_registry.name)
+        if overseer is not None:
+            main_workers.insert(0, overseer)
+        return main_workers, sorted(workers.values(), key=lambda w: w['username']) + WorkerStatus.get_all_except(self.status_registry.name)
+
+    def start_request_timer(self):
+        g.request_start = time.time()
+
+    def record_request_time(self, response):
+        if 'request_start' in g:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            metrics.HTTP_REQUEST_SECONDS.observe(time.time() - g.request_start, route=route, method=request.method, code=response.status_code)
+        return response
+
+    def get_metrics(self):
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
     def get_search_control(self):
         return jsonify({'status': not self.search_control.is_set()})
 
@@ -139,8 +172,7 @@ class Pogom(Flask):
             if args.status_page_password is None:
                 d['error'] = 'Access denied'
             elif request.args.get('password', None) == args.status_page_password:
-                d['main_workers'] = MainWorker.get_all()
-                d['workers'] = WorkerStatus.get_all()
+                d['main_workers'], d['workers'] = self.get_worker_statuses()
 
         return jsonify(d)
 
@@ -272,8 +304,7 @@ class Pogom(Flask):
 
         if request.form.get('password', None) == args.status_page_password:
             d['login'] = 'ok'
-            d['main_workers'] = MainWorker.get_all()
-            d['workers'] = WorkerStatus.get_all()
+            d['main_workers'], d['workers'] = self.get_worker_statuses()
         else:
             d['login'] = 'failed'
         return jsonify(d)
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Closed-form geodesy for the short distances the scanner works with.
+
+geopy solves the direct and inverse geodesic problems on the WGS84 ellipsoid by
+iteration (Vincenty), and wraps every point and distance in objects of its own.
+That's exact, but costs ~20 us a call, and grid generators, hex_bounds and
+jitterLocation make thousands of them. The functions here take and return plain
+floats, in degrees and meters, and solve on a sphere with the radii of curvature
+of the ellipsoid at the origin, in a handful of math calls (~2 us):
+
+ - destination() moves along a great circle of a sphere with the prime vertical
+   radius N, which gets the longitude right, and scales the change in latitude
+   by N/M, the ratio to the meridional radius.
+ - distance() measures in the local tangent plane at the mean latitude, east
+   scaled by N cos(latitude) and north by M.
+
+Largest error compared to geopy's Vincenty, over random origins between
+80°S and 80°N and random bearings:
+
+    distance    destination()    distance()
+    70 m        0.2 mm           0.2 mm
+    1 km        3 mm             3 mm
+    10 km       8 cm             3 cm
+    50 km       2 m              4 m
+    200 km      32 m             290 m
+
+So anything within a scan area is exact to well within the precision GPS and
+the API have, but don't use these for distances between cities.
+
+Origin measures the distances from one lat/lng to many others with a few
+multiplications each, and with NumPy, for arrays of them at once.
+'''
+
+import math
+
+# NumPy isn't required, but measures the distances to many points at once much faster
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# WGS84
+A = 6378137.0
+F = 1 / 298.257223563
+E2 = F * (2 - F)
+
+DEGREE = math.pi / 180
+
+# Below this many points, converting them to and from arrays costs more than NumPy saves
+NUMPY_MIN_POINTS = 16
+
+
+# The meridional (M) and prime vertical (N) radii of curvature of the ellipsoid at a latitude, given its sine
+def radii(sin_lat):
+    w = 1 - E2 * sin_lat * sin_lat
+    n = A / math.sqrt(w)
+    return n * (1 - E2) / w, n
+
+
+def destination(lat, lng, meters, bearing):
+    """
+    The lat/lng reached from lat/lng after meters in the direction of bearing
+    (degrees clockwise from north).
+    """
+    sin_lat = math.sin(math.radians(lat))
+    cos_lat = math.cos(math.radians(lat))
+    m, n = radii(sin_lat)
+    return _destination(lat, lng, sin_lat, cos_lat, n / m, meters / n, math.radians(bearing))
+
+
+def destinations(lat, lng, steps):
+    """
+    destination() for a list of (meters, bearing) from the same lat/lng,
+    returning a list of lat/lng.
+    """
+    sin_lat = math.sin(math.radians(lat))
+    cos_lat = math.cos(math.radians(lat))
+    m, n = radii(sin_lat)
+    return [_destination(lat, lng, sin_lat, cos_lat, n / m, meters / n, math.radians(bearing))
+            for meters, bearing in steps]
+
+
+def _destination(lat, lng, sin_lat, cos_lat, n_over_m, delta, theta):
+    sin_delta = math.sin(delta)
+    cos_delta = math.cos(delta)
+    cos_theta = math.cos(theta)
+    sin_lat2 = sin_lat * cos_delta + cos_lat * sin_delta * cos_theta
+    lat2 = lat + (math.degrees(math.asin(sin_lat2)) - lat) * n_over_m
+    lng2 = lng + math.degrees(math.atan2(math.sin(theta) * sin_delta * cos_lat, cos_delta - sin_lat * sin_lat2))
+    if not -180 <= lng2 <= 180:
+        lng2 = (lng2 + 180) % 360 - 180
+    return lat2, lng2
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    The distance between two lat/lng in meters.
+    """
+    mean_lat = math.radians((lat1 + lat2) / 2.0)
+    m, n = radii(math.sin(mean_lat))
+    d_lng = lng2 - lng1
+    # The short way around the antimeridian
+    if d_lng > 180:
+        d_lng -= 360
+    elif d_lng < -180:
+        d_lng += 360
+    return math.hypot(math.radians(d_lng) * n * math.cos(mean_lat), math.radians(lat2 - lat1) * m)
+
+
+class Origin(object):
+    """
+    A lat/lng to measure the distances of many others from, like the location
+    of a scan to the forts it found, with what only depends on the origin
+    worked out once. The distances agree with distance() to within 1e-7 of them
+    up to 10 km, and 2e-6 up to 50 km.
+    """
+
+    def __init__(self, lat, lng):
+        self.lat = lat
+        self.lng = lng
+        sin_lat = math.sin(math.radians(lat))
+        cos_lat = math.cos(math.radians(lat))
+        m, n = radii(sin_lat)
+        w = 1 - E2 * sin_lat * sin_lat
+        # Meters per degree north (y) and east (x) at the origin, and half how much they change per degree
+        # north, so that they're taken at the mean latitude of the origin and the other point
+        self.ky = m * DEGREE
+        self.kx = n * cos_lat * DEGREE
+        self.dky = 1.5 * m * E2 * sin_lat * cos_lat / w * DEGREE * DEGREE
+        self.dkx = 0.5 * n * sin_lat * (E2 * cos_lat * cos_lat / w - 1) * DEGREE * DEGREE
+
+    def distance(self, lat, lng, m=math):
+        """
+        The distance to lat/lng in meters. m is the module to do the math with:
+        math for a lat/lng, numpy for arrays of them.
+        """
+        d_lat = lat - self.lat
+        # The short way around the antimeridian
+        d_lng = (lng - self.lng + 180) % 360 - 180
+        return m.hypot(d_lng * (self.kx + self.dkx * d_lat), d_lat * (self.ky + self.dky * d_lat))
+
+    def distances(self, lats, lngs):
+        """
+        distance() for lists of latitudes and longitudes, returning a list of
+        the distances. With NumPy installed, they are all measured at once.
+        """
+        if numpy is None or len(lats) < NUMPY_MIN_POINTS:
+            return [self.distance(lat, lng) for lat, lng in zip(lats, lngs)]
+        return self.distance(numpy.asarray(lats, dtype=float), numpy.asarray(lngs, dtype=float), numpy).tolist()
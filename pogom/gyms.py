@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from threading import Condition, Lock
+
+from queue import Empty
+
+from .models import GymDetails
+from . import geo
+
+log = logging.getLogger(__name__)
+
+
+# When the details of every gym we know of were last fetched, so workers can tell which gyms need their
+# details fetched without asking the database. Loaded from the database once at startup, and kept up to
+# date by the workers fetching gym details.
+class GymIndex(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        # gym_id: last details scan (UTC datetime)
+        self.last_scanned = {}
+
+    def warm(self):
+        query = GymDetails.select(GymDetails.gym_id, GymDetails.last_scanned).tuples()
+        with self.lock:
+            for gym_id, last_scanned in query:
+                self.last_scanned[gym_id] = last_scanned
+        log.info('Loaded the details scan times of %d gyms', len(self.last_scanned))
+
+    # True when we have no details of gym, or they are older than its last change
+    def needs_details(self, gym):
+        with self.lock:
+            last_scanned = self.last_scanned.get(gym['gym_id'])
+        return last_scanned is None or last_scanned < gym['last_modified']
+
+    def scanned(self, gym_ids):
+        scan_time = datetime.utcnow()
+        with self.lock:
+            for gym_id in gym_ids:
+                self.last_scanned[gym_id] = scan_time
+
+
+# Gyms waiting for their details to be fetched, as (gym, location to fetch them from), oldest first.
+#
+# Shared by all workers of an overseer. A gym is queued only once: until the worker that took it calls
+# done(), later sightings of it are ignored.
+#
+# Has the get()/get_nowait()/qsize() of a Queue, so workers can wait for gyms like for anything else.
+class GymDetailQueue(object):
+
+    def __init__(self):
+        self.cond = Condition()
+        # gym_id: (gym, location)
+        self.waiting = OrderedDict()
+        # Ids of the gyms being fetched
+        self.taken = set()
+
+    def put(self, gym, location):
+        with self.cond:
+            if gym['gym_id'] in self.waiting or gym['gym_id'] in self.taken:
+                return
+            self.waiting[gym['gym_id']] = (gym, location)
+            self.cond.notify()
+
+    def get_nowait(self):
+        with self.cond:
+            if not self.waiting:
+                raise Empty
+            gym_id, item = self.waiting.popitem(last=False)
+            self.taken.add(gym_id)
+            return item
+
+    # Like get_nowait(), but only takes the oldest gym within meters of location
+    def get_near(self, location, meters):
+        origin = geo.Origin(location[0], location[1])
+        with self.cond:
+            for gym_id, item in self.waiting.iteritems():
+                if origin.distance(item[0]['latitude'], item[0]['longitude']) < meters:
+                    break
+            else:
+                raise Empty
+            del self.waiting[gym_id]
+            self.taken.add(gym_id)
+            return item
+
+    def get(self, block=True, timeout=None):
+        if not block:
+            return self.get_nowait()
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while not self.waiting:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                self.cond.wait(remaining)
+            return self.get_nowait()
+
+    # A gym taken with get() has been dealt with, whether fetching its details worked or not
+    def done(self, gym_id):
+        with self.cond:
+            self.taken.discard(gym_id)
+
+    def qsize(self):
+        with self.cond:
+            return len(self.waiting)
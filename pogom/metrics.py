@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Metrics of this process, served by the web app at /metrics in the Prometheus text format.
+
+Counters and timings are updated where things happen (database upserts, webhooks, web
+requests). Gauges are collected from whoever registered them at the time of the scrape,
+like the queue depths and the status of the search workers.
+'''
+
+import math
+
+from threading import Lock
+
+from .utils import Histogram
+
+# Everything /metrics shows, in order
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render():
+    lines = []
+    for metric in list(REGISTRY):
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = Lock()
+        # Sorted label items: value
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = self.values.items()
+        for key, value in sorted(values):
+            yield self.name, dict(key), value
+
+
+# A histogram of durations in seconds, per set of labels
+class Timing(object):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = Lock()
+        # Sorted label items: Histogram
+        self.histograms = {}
+
+    def observe(self, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def samples(self):
+        with self.lock:
+            histograms = [(key, _copy(histogram)) for key, histogram in self.histograms.items()]
+        for key, histogram in sorted(histograms):
+            for sample in histogram_samples(self.name, dict(key), histogram):
+                yield sample
+
+
+def _copy(histogram):
+    copy = Histogram(histogram.buckets)
+    copy.merge(histogram)
+    return copy
+
+
+# The samples of a utils.Histogram, with cumulative buckets like Prometheus wants them
+def histogram_samples(name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        yield name + '_bucket', dict(labels, le=_format_value(float(bound))), cumulative
+    yield name + '_sum', labels, histogram.sum
+    yield name + '_count', labels, histogram.count
+
+
+# A metric whose samples are collected when /metrics is requested. collect() returns a list of
+# (labels, value) tuples, or for kind 'histogram' (labels, utils.Histogram) tuples.
+class Collected(object):
+
+    def __init__(self, name, documentation, collect, kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        for labels, value in self.collect():
+            if self.kind == 'histogram':
+                for sample in histogram_samples(self.name, labels, value):
+                    yield sample
+            else:
+                yield self.name, labels, value
+
+
+DB_UPSERT_ROWS = register(Counter('pogom_db_upserted_rows_total', 'Rows upserted into the database, by model.'))
+DB_UPSERT_SECONDS = register(Timing('pogom_db_upsert_seconds', 'Time taken by database upserts, by model.'))
+WEBHOOK_SEND_SECONDS = register(Timing('pogom_webhook_send_seconds', 'Time taken by webhook posts, by webhook type.'))
+WEBHOOK_ERRORS = register(Counter('pogom_webhook_errors_total', 'Webhook posts that timed out or failed, by error.'))
+HTTP_REQUEST_SECONDS = register(Timing('pogom_http_request_seconds', 'Time taken by web requests, by route, method and status code.'))
@@ -6,7 +6,7 @@ import calendar
 import sys
 import gc
 import time
-import geopy
+import requests
 from peewee import SqliteDatabase, InsertQuery, \
     IntegerField, CharField, DoubleField, BooleanField, \
     DateTimeField, fn, DeleteQuery, CompositeKey, FloatField, SQL, TextField
@@ -18,20 +18,28 @@ from datetime import datetime, timedelta
 from base64 import b64encode
 from cachetools import TTLCache
 from cachetools import cached
+from queue import Empty
 
 from . import config
 from .utils import get_pokemon_name, get_pokemon_rarity, get_pokemon_types, get_args
-from .transform import transform_from_wgs_to_gcj, get_new_coords
+from .transform import transform_rows_from_wgs_to_gcj
+from . import geo
 from .customLog import printPokemon
+from .metrics import DB_UPSERT_ROWS, DB_UPSERT_SECONDS
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 flaskDb = FlaskDB()
 cache = TTLCache(maxsize=100, ttl=60 * 5)
+# The GCJ-02 coordinates of pokestops and spawnpoints for --china, which don't move
+gcj_cache = {}
 
 db_schema_version = 7
 
+# Meters in a yard, the unit of the distances posted to Slack
+YARD = 0.9144
+
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
     pass
@@ -66,11 +74,8 @@ class BaseModel(flaskDb.Model):
     @classmethod
     def get_all(cls):
         results = [m for m in cls.select().dicts()]
-        if args.china:
-            for result in results:
-                result['latitude'], result['longitude'] = \
-                    transform_from_wgs_to_gcj(
-                        result['latitude'], result['longitude'])
+        if args.china and 'latitude' in cls._meta.fields:
+            transform_rows_from_wgs_to_gcj(results, gcj_cache)
         return results
 
 
@@ -112,11 +117,11 @@ class Pokemon(BaseModel):
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
             p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
             p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
             pokemons.append(p)
 
+        if args.china:
+            transform_rows_from_wgs_to_gcj(pokemons, gcj_cache)
+
         # Re-enable the GC.
         gc.enable()
 
@@ -149,11 +154,11 @@ class Pokemon(BaseModel):
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
             p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
             p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
             pokemons.append(p)
 
+        if args.china:
+            transform_rows_from_wgs_to_gcj(pokemons, gcj_cache)
+
         # Re-enable the GC.
         gc.enable()
 
@@ -311,12 +316,9 @@ class Pokemon(BaseModel):
         # steps - 1 to account for the center circle then add 70 for the edge
         step_distance = ((steps - 1) * 121.2436) + 70
         # Compare spawnpoint list to a circle with radius steps * 120
-        # Uses the direct geopy distance between the center and the spawnpoint.
-        filtered = []
-
-        for idx, sp in enumerate(s):
-            if geopy.distance.distance(center, (sp['lat'], sp['lng'])).meters <= step_distance:
-                filtered.append(s[idx])
+        # Uses the direct distance between the center and the spawnpoint.
+        distances = geo.Origin(center[0], center[1]).distances([sp['lat'] for sp in s], [sp['lng'] for sp in s])
+        filtered = [sp for sp, distance in zip(s, distances) if distance <= step_distance]
 
         # at this point, 'time' is DISAPPEARANCE time, we're going to morph it to APPEARANCE time
         for location in filtered:
@@ -361,11 +363,11 @@ class Pokestop(BaseModel):
 
         pokestops = []
         for p in query:
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
             pokestops.append(p)
 
+        if args.china:
+            transform_rows_from_wgs_to_gcj(pokestops, gcj_cache)
+
         # Re-enable the GC.
         gc.enable()
 
@@ -483,6 +485,10 @@ class MainWorker(BaseModel):
     method = CharField(max_length=50)
     last_modified = DateTimeField(index=True)
 
+    @staticmethod
+    def get_all_except(worker_name):
+        return [m for m in MainWorker.select().where(MainWorker.worker_name != worker_name).dicts()]
+
 
 class WorkerStatus(BaseModel):
     username = CharField(primary_key=True, max_length=50)
@@ -509,6 +515,10 @@ class WorkerStatus(BaseModel):
 
         return status
 
+    @staticmethod
+    def get_all_except(worker_name):
+        return [s for s in WorkerStatus.select().where(WorkerStatus.worker_name != worker_name).dicts()]
+
 
 class Versions(flaskDb.Model):
     key = CharField()
@@ -565,19 +575,24 @@ class GymDetails(BaseModel):
 def hex_bounds(center, steps):
     # Make a box that is (70m * step_limit * 2) + 70m away from the center point
     # Rationale is that you need to travel
-    sp_dist = 0.07 * 2 * steps
-    n = get_new_coords(center, sp_dist, 0)[0]
-    e = get_new_coords(center, sp_dist, 90)[1]
-    s = get_new_coords(center, sp_dist, 180)[0]
-    w = get_new_coords(center, sp_dist, 270)[1]
-    return (n, e, s, w)
+    sp_dist = 70 * 2 * steps
+    n, e, s, w = geo.destinations(center[0], center[1], [(sp_dist, 0), (sp_dist, 90), (sp_dist, 180), (sp_dist, 270)])
+    return (n[0], e[1], s[0], w[1])
 
 
 # todo: this probably shouldn't _really_ be in "models" anymore, but w/e
-def parse_map(args, map_dict, step_location, user_location, db_update_queue, wh_update_queue):
+# With a cell_cache (see utils.CellCache), forts of map cells that haven't changed since they were last parsed are skipped
+def parse_map(args, map_dict, step_location, user_location, db_update_queue, wh_update_queue, cell_cache=None):
     pokemons = {}
     pokestops = {}
     gyms = {}
+    # Gyms of unchanged cells, which may still need their details fetched from here
+    unchanged_gyms = {}
+    # Ids of the gyms of unchanged cells, which have been seen again all the same
+    seen_gyms = []
+    skipped = 0
+    # Where the distances of pokemon posted to Slack are measured from
+    slack_origin = geo.Origin(user_location[0], user_location[1]) if args.slack_webhooks else None
 
     cells = map_dict['responses']['GET_MAP_OBJECTS']['map_cells']
     for cell in cells:
@@ -623,7 +638,23 @@ def parse_map(args, map_dict, step_location, user_location, db_update_queue, wh_
                     }))
 					
                 if not existing and args.slack_webhooks:
-                    notify_via_slack(pokemons[p['encounter_id']], user_location, p['time_till_hidden_ms'])
+                    notify_via_slack(pokemons[p['encounter_id']], slack_origin, p['time_till_hidden_ms'])
+
+        if cell_cache is not None and not cell_cache.forts_changed(cell):
+            skipped += len(cell.get('forts', []))
+            if config['parse_gyms']:
+                seen_gyms.extend(f['id'] for f in cell.get('forts', []) if f.get('type') is None)
+            if args.gym_info and config['parse_gyms']:
+                for f in cell.get('forts', []):
+                    if f.get('type') is None:
+                        unchanged_gyms[f['id']] = {
+                            'gym_id': f['id'],
+                            'latitude': f['latitude'],
+                            'longitude': f['longitude'],
+                            'last_modified': datetime.utcfromtimestamp(
+                                f['last_modified_timestamp_ms'] / 1000.0),
+                        }
+            continue
 
         for f in cell.get('forts', []):
             if config['parse_pokestops'] and f.get('type') == 1:  # Pokestops
@@ -708,11 +739,14 @@ def parse_map(args, map_dict, step_location, user_location, db_update_queue, wh_
         db_update_queue.put((Pokestop, pokestops))
     if len(gyms):
         db_update_queue.put((Gym, gyms))
+    if len(seen_gyms):
+        db_update_queue.put((Gym, seen_gyms))
 
-    log.info('Parsing found %d pokemons, %d pokestops, and %d gyms',
+    log.info('Parsing found %d pokemons, %d pokestops, and %d gyms, skipped %d forts of unchanged cells',
              len(pokemons),
              len(pokestops),
-             len(gyms))
+             len(gyms),
+             skipped)
 
     db_update_queue.put((ScannedLocation, {0: {
         'latitude': step_location[0],
@@ -721,11 +755,12 @@ def parse_map(args, map_dict, step_location, user_location, db_update_queue, wh_
     }}))
 
     return {
-        'count': len(pokemons) + len(pokestops) + len(gyms),
-        'gyms': gyms,
+        'count': len(pokemons) + len(pokestops) + len(gyms) + skipped,
+        'gyms': dict(unchanged_gyms, **gyms),
     }
 	
-def notify_via_slack(input, user_location, time_till_hidden_ms):
+# Posts a pokemon to Slack, with its distance in yards from origin (a geo.Origin)
+def notify_via_slack(input, origin, time_till_hidden_ms):
 
     encodedPokename = get_pokemon_name(input['pokemon_id'])
     rarity = get_pokemon_rarity(input['pokemon_id'])
@@ -733,7 +768,7 @@ def notify_via_slack(input, user_location, time_till_hidden_ms):
     if args.slack_rarities and rarity not in args.slack_rarities:
         return
 
-    distance = haversine(input['longitude'], input['latitude'], user_location[1], user_location[0])
+    distance = origin.distance(input['latitude'], input['longitude']) / YARD
 
     if args.slack_max_distance >= 0 and args.slack_max_distance < distance:
         return
@@ -752,40 +787,26 @@ def notify_via_slack(input, user_location, time_till_hidden_ms):
             requests.post(url, data = "{\"username\":\"Pokefinder BOT\", \"icon_emoji\":\":pokeball:\", \"text\": \"A wild *" + encodedPokename + "* is " + "%.0f" % distance + " yards away!\", \"attachments\": [ {\"title\": \"View on map\", \"thumb_url\": \"" + image_url + "\", \"title_link\": \"" + map_url + "\", \"text\": \"Expires in " + time_string + "\"}]}")
 
 
-def haversine(lon1, lat1, lon2, lat2):
-    #print "-----------------------------------------------------------------------------------------"
-    #print "input longitude:" + str(lon1) + " latitude:" + str(lat1)
-    #print "input longitude:" + str(lon2) + " latitude:" + str(lat2)
-    #print "-----------------------------------------------------------------------------------------"
-    
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    
-    # haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    r = 6962560
-    return c * r
-
+# Turns gym details responses into a snapshot of each gym (its details, members, their pokemon and trainers),
+# and hands them to gym_writer() through gym_updates_queue.
+def parse_gyms(args, gym_responses, wh_update_queue, gym_updates_queue):
+    snapshots = {}
 
-def parse_gyms(args, gym_responses, wh_update_queue):
-    gym_details = {}
-    gym_members = {}
-    gym_pokemon = {}
-    trainers = {}
-
-    i = 0
     for g in gym_responses.values():
         gym_state = g['gym_state']
         gym_id = gym_state['fort_data']['id']
 
-        gym_details[gym_id] = {
-            'gym_id': gym_id,
-            'name': g['name'],
-            'description': g.get('description'),
-            'url': g['urls'][0],
+        snapshots[gym_id] = snapshot = {
+            'details': {
+                'gym_id': gym_id,
+                'name': g['name'],
+                'description': g.get('description'),
+                'url': g['urls'][0],
+                'last_scanned': datetime.utcnow(),
+            },
+            'members': [],
+            'pokemon': [],
+            'trainers': [],
         }
 
         if args.webhooks:
@@ -801,12 +822,12 @@ def parse_gyms(args, gym_responses, wh_update_queue):
             }
 
         for member in gym_state.get('memberships', []):
-            gym_members[i] = {
+            snapshot['members'].append({
                 'gym_id': gym_id,
                 'pokemon_uid': member['pokemon_data']['id'],
-            }
+            })
 
-            gym_pokemon[i] = {
+            snapshot['pokemon'].append({
                 'pokemon_uid': member['pokemon_data']['id'],
                 'pokemon_id': member['pokemon_data']['pokemon_id'],
                 'cp': member['pokemon_data']['cp'],
@@ -824,14 +845,14 @@ def parse_gyms(args, gym_responses, wh_update_queue):
                 'iv_stamina': member['pokemon_data'].get('individual_stamina', 0),
                 'iv_attack': member['pokemon_data'].get('individual_attack', 0),
                 'last_seen': datetime.utcnow(),
-            }
+            })
 
-            trainers[i] = {
+            snapshot['trainers'].append({
                 'name': member['trainer_public_profile']['name'],
                 'team': gym_state['fort_data']['owned_by_team'],
                 'level': member['trainer_public_profile']['level'],
                 'last_seen': datetime.utcnow(),
-            }
+            })
 
             if args.webhooks:
                 webhook_data['pokemon'].append({
@@ -854,36 +875,96 @@ def parse_gyms(args, gym_responses, wh_update_queue):
                     'trainer_level': member['trainer_public_profile']['level'],
                 })
 
-            i += 1
         if args.webhooks:
             wh_update_queue.put(('gym_details', webhook_data))
 
-    # All this database stuff is synchronous (not using the upsert queue) on purpose.
-    # Since the search workers load the GymDetails model from the database to determine if a gym
-    # needs rescanned, we need to be sure the GymDetails get fully committed to the database before moving on.
-    #
-    # We _could_ synchronously upsert GymDetails, then queue the other tables for
-    # upsert, but that would put that Gym's overall information in a weird non-atomic state.
+    gym_updates_queue.put(snapshots)
 
-    # upsert all the models
-    if len(gym_details):
-        bulk_upsert(GymDetails, gym_details)
-    if len(gym_pokemon):
-        bulk_upsert(GymPokemon, gym_pokemon)
-    if len(trainers):
-        bulk_upsert(Trainer, trainers)
 
-    # This needs to be completed in a transaction, because we don't wany any other thread or process
-    # to mess with the GymMembers for the gyms we're updating while we're updating the bridge table.
+# Writes the gym snapshots of parse_gyms(). Whatever snapshots are waiting are written together, the latest
+# snapshot of a gym replacing earlier ones, in a single transaction: no other thread or process gets to see
+# (or mess with) a gym whose members are only partly replaced. Search workers don't wait for any of this;
+# they know which gyms are up to date from their GymIndex.
+#
+# Snapshots that fail to be written are kept, and written together with whatever arrives meanwhile. They're
+# marked done in q once they are in the database, so q.join() waits for that.
+def gym_writer(args, q):
+    # Taken from q but not written yet, and how many items of q they are
+    snapshots = {}
+    items = 0
+
+    # The forever loop
+    while True:
+        try:
+
+            while True:
+                try:
+                    flaskDb.connect_db()
+                    break
+                except Exception as e:
+                    log.warning('%s... Retrying', e)
+
+            # Loop the queue
+            while True:
+                if not items:
+                    snapshots = q.get()
+                    items = 1
+                try:
+                    while True:
+                        snapshots.update(q.get_nowait())
+                        items += 1
+                except Empty:
+                    pass
+
+                write_gym_snapshots(snapshots)
+                for i in range(items):
+                    q.task_done()
+                snapshots = {}
+                items = 0
+
+        except Exception as e:
+            log.exception('Exception in gym_writer: %s', e)
+            time.sleep(1)
+
+
+def write_gym_snapshots(snapshots):
+    if not snapshots:
+        return
+
+    gym_details = {}
+    gym_members = {}
+    gym_pokemon = {}
+    trainers = {}
+
+    for gym_id, snapshot in snapshots.items():
+        gym_details[gym_id] = snapshot['details']
+        for member in snapshot['members']:
+            gym_members[len(gym_members)] = member
+        for pokemon in snapshot['pokemon']:
+            gym_pokemon[pokemon['pokemon_uid']] = pokemon
+        for trainer in snapshot['trainers']:
+            trainers[trainer['name']] = trainer
+
+    start = time.time()
     with flaskDb.database.transaction():
+        # upsert all the models
+        bulk_upsert(GymDetails, gym_details)
+        if len(gym_pokemon):
+            bulk_upsert(GymPokemon, gym_pokemon)
+        if len(trainers):
+            bulk_upsert(Trainer, trainers)
+
         # get rid of all the gym members, we're going to insert new records
-        if len(gym_details):
-            DeleteQuery(GymMember).where(GymMember.gym_id << gym_details.keys()).execute()
+        DeleteQuery(GymMember).where(GymMember.gym_id << gym_details.keys()).execute()
 
         # insert new gym members
         if len(gym_members):
             bulk_upsert(GymMember, gym_members)
 
+    DB_UPSERT_SECONDS.observe(time.time() - start, model='gym_snapshots')
+    for model, rows in ((GymDetails, gym_details), (GymPokemon, gym_pokemon), (Trainer, trainers), (GymMember, gym_members)):
+        DB_UPSERT_ROWS.inc(len(rows), model=model.__name__)
+
     log.info('Upserted %d gyms and %d gym members',
              len(gym_details),
              len(gym_members))
@@ -904,7 +985,14 @@ def db_updater(args, q):
             # Loop the queue
             while True:
                 model, data = q.get()
-                bulk_upsert(model, data)
+                start = time.time()
+                # Rows by primary key are upserted, a list of primary keys is of rows seen again unchanged
+                if isinstance(data, list):
+                    bulk_touch(model, data)
+                else:
+                    bulk_upsert(model, data)
+                DB_UPSERT_SECONDS.observe(time.time() - start, model=model.__name__)
+                DB_UPSERT_ROWS.inc(len(data), model=model.__name__)
                 q.task_done()
                 log.debug('Upserted to %s, %d records (upsert queue remaining: %d)',
                           model.__name__,
@@ -980,6 +1068,18 @@ def bulk_upsert(cls, data):
         i += step
 
 
+# Set last_scanned of the rows of cls with the primary keys ids to now
+def bulk_touch(cls, ids):
+    scan_time = datetime.utcnow()
+    # Stays below SQLite's max number of parameters
+    step = 500
+    pk = cls._meta.primary_key
+
+    for i in range(0, len(ids), step):
+        log.debug('Updating last scanned of items %d to %d', i, min(i + step, len(ids)))
+        cls.update(last_scanned=scan_time).where(pk << ids[i:i + step]).execute()
+
+
 def create_tables(db):
     db.connect()
     verify_database_schema(db)
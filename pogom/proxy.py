@@ -2,87 +2,242 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import math
 import requests
 import sys
+import time
 
-from queue import Queue
-from threading import Thread
+from collections import deque
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import Lock, Thread
 
 log = logging.getLogger(__name__)
 
 
-# Simple function to do a call to Niantic's system for testing proxy connectivity
-def check_proxy(proxy_queue, timeout, proxies):
-
-    # Update check url - Thanks ChipWolf #1282 and #1281
-    proxy_test_url = 'https://pgorelease.nianticlabs.com/plfe/rpc'
-    proxy = proxy_queue.get()
-
-    if proxy and proxy[1]:
-
-        log.debug('Checking proxy: %s', proxy[1])
-
-        try:
-            proxy_response = requests.post(proxy_test_url, '', proxies={'http': proxy[1], 'https': proxy[1]}, timeout=timeout)
-
-            if proxy_response.status_code == 200:
-                log.debug('Proxy %s is ok', proxy[1])
-                proxy_queue.task_done()
-                proxies.append(proxy[1])
-                return True
-
-            elif proxy_response.status_code == 403:
-                log.error("Proxy %s is banned - got status code: %s", proxy[1], str(proxy_response.status_code))
-                return False
-
-            else:
-                proxy_error = "Wrong status code - " + str(proxy_response.status_code)
+# Probes kept per proxy for its rolling latency and error rate
+PROXY_HISTORY = 10
+
+# Probes failing in a row before a proxy is taken out of use
+PROXY_MAX_FAILURES = 2
+
+# Seconds a proxy check may take on top of its timeouts, before it is given up on
+PROXY_CHECK_GRACE = 5
+
+
+# Probe a proxy once, by a call to Niantic's system (or --proxy-test-url). Returns a dict with the proxy,
+# its status ('ok', 'banned' or 'error'), the latency in seconds when it is ok, and the error otherwise.
+def probe_proxy(proxy, test_url, timeout):
+    result = {'proxy': proxy, 'status': 'error', 'latency': None, 'error': None}
+
+    if not proxy:
+        result['error'] = 'Empty proxy server'
+        return result
+
+    log.debug('Checking proxy: %s', proxy)
+    start = time.time()
+    try:
+        response = requests.post(test_url, '', proxies={'http': proxy, 'https': proxy}, timeout=timeout)
+    except requests.ConnectTimeout:
+        result['error'] = 'Connection timeout ({} second(s)) via proxy {}'.format(timeout, proxy)
+        return result
+    except requests.ConnectionError:
+        result['error'] = 'Failed to connect to proxy {}'.format(proxy)
+        return result
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+
+    if response.status_code == 200:
+        result['status'] = 'ok'
+        result['latency'] = time.time() - start
+    elif response.status_code == 403:
+        result['status'] = 'banned'
+        result['error'] = 'Proxy {} is banned - got status code: {}'.format(proxy, response.status_code)
+    else:
+        result['error'] = 'Wrong status code - {}'.format(response.status_code)
+    return result
 
-        except requests.ConnectTimeout:
-            proxy_error = "Connection timeout (" + str(timeout) + " second(s) ) via proxy " + proxy[1]
 
-        except requests.ConnectionError:
-            proxy_error = "Failed to connect to proxy " + proxy[1]
+# Probe proxies on a pool of at most threads threads. Returns the results of probe_proxy(), in the order of
+# proxies. Checks that haven't finished by the time all of them should have (timeout for connecting and
+# timeout for the answer, per round of checks) get status 'timeout', so this always returns.
+def probe_proxies(proxies, test_url, timeout, threads):
+    if not proxies:
+        return []
 
-        except Exception as e:
-            proxy_error = e
+    threads = max(1, min(threads, len(proxies)))
+    pool = ThreadPool(threads)
+    try:
+        pending = [(proxy, pool.apply_async(probe_proxy, (proxy, test_url, timeout))) for proxy in proxies]
 
-    else:
-            proxy_error = "Empty proxy server"
+        rounds = math.ceil(len(proxies) / float(threads))
+        deadline = time.time() + rounds * (2 * timeout + PROXY_CHECK_GRACE)
 
-    log.warning('%s', proxy_error)
-    proxy_queue.task_done()
+        results = []
+        for proxy, pending_result in pending:
+            try:
+                results.append(pending_result.get(max(deadline - time.time(), 0)))
+            except TimeoutError:
+                results.append({'proxy': proxy, 'status': 'timeout', 'latency': None,
+                                'error': 'Check of proxy {} did not finish in time'.format(proxy)})
+    finally:
+        # Checks still hanging are abandoned; the pool's threads are daemons
+        pool.terminate()
 
-    return False
+    return results
 
 
-# Check all proxies and return a working list with proxies
+# Check all proxies, and return the results of probe_proxy() for them. Aborts when none of them work.
 def check_proxies(args):
 
-    proxy_queue = Queue()
     total_proxies = len(args.proxy)
 
-    log.info('Checking %d proxies...', total_proxies)
+    log.info('Checking %d proxies on %d threads...', total_proxies, min(args.proxy_check_threads, total_proxies))
+    start = time.time()
 
-    proxies = []
+    results = probe_proxies(args.proxy, args.proxy_test_url, args.proxy_timeout, args.proxy_check_threads)
 
-    for proxy in enumerate(args.proxy):
-        proxy_queue.put(proxy)
+    for result in results:
+        if result['status'] == 'ok':
+            log.debug('Proxy %s is ok, %.3f seconds', result['proxy'], result['latency'])
+        elif result['status'] == 'banned':
+            log.error('%s', result['error'])
+        else:
+            log.warning('%s', result['error'])
 
-        t = Thread(target=check_proxy,
-                   name='check_proxy',
-                   args=(proxy_queue, args.proxy_timeout, proxies))
-        t.daemon = True
-        t.start()
-
-    # This is painfull but we need to wait here untill proxy_queue is completed so we have a working list of proxies
-    proxy_queue.join()
-
-    working_proxies = len(proxies)
+    working_proxies = len([result for result in results if result['status'] == 'ok'])
 
     if working_proxies == 0:
         log.error('Proxy was configured but no working proxies was found! We are aborting!')
         sys.exit(1)
     else:
-        log.info('Proxy check completed with %d working proxies of %d configured', working_proxies, total_proxies)
-        return proxies
+        log.info('Proxy check completed in %.1f seconds with %d working proxies of %d configured', time.time() - start, working_proxies, total_proxies)
+        return results
+
+
+# The proxies of a search overseer, with how well they have been doing.
+#
+# A background thread probes every proxy against --proxy-test-url every --proxy-refresh-interval seconds,
+# keeping the latency and outcome of the last PROXY_HISTORY probes. Proxies failing PROXY_MAX_FAILURES
+# probes in a row, or most of their recent ones, are unhealthy until they pass probes again.
+#
+# Workers are given the healthy proxy with the fewest workers on it (the fastest one of those), and move
+# to another one as soon as theirs turns unhealthy.
+#
+# on_probe() is called with the results of every round of probes, so they can be passed on to the pools of
+# search processes, which record() them instead of probing the proxies themselves.
+class ProxyPool(object):
+
+    def __init__(self, args, proxies, on_probe=None):
+        self.args = args
+        self.on_probe = on_probe
+        self.lock = Lock()
+        # In --proxy order, which is what the status shows with --proxy-display index
+        self.proxies = list(proxies)
+        # proxy: stats
+        self.stats = {}
+
+        for proxy in self.proxies:
+            self.stats[proxy] = {
+                'workers': 0,
+                'latency': deque(maxlen=PROXY_HISTORY),
+                'results': deque(maxlen=PROXY_HISTORY),
+                'failures': 0,
+                'error': None
+            }
+
+    def start(self):
+        if not self.proxies or not self.args.proxy_refresh_interval:
+            return
+        t = Thread(target=self._refresher, name='proxy-refresher')
+        t.daemon = True
+        t.start()
+
+    # Record the outcome of a probe, see probe_proxy()
+    def record(self, result):
+        proxy = result['proxy']
+        with self.lock:
+            stats = self.stats[proxy]
+            was_healthy = self._healthy(stats)
+
+            ok = result['status'] == 'ok'
+            stats['results'].append(ok)
+            if ok:
+                stats['latency'].append(result['latency'])
+                stats['failures'] = 0
+                stats['error'] = None
+            else:
+                stats['failures'] += 1
+                stats['error'] = result['error']
+
+            healthy = self._healthy(stats)
+
+        if was_healthy and not healthy:
+            log.warning('Proxy %s stopped working (%s), moving its workers to other proxies', proxy, result['error'])
+        elif healthy and not was_healthy:
+            log.info('Proxy %s is working again', proxy)
+
+    def _healthy(self, stats):
+        results = stats['results']
+        return stats['failures'] < PROXY_MAX_FAILURES and results.count(False) * 2 <= len(results)
+
+    # Proxies without failures count as healthy; so do unknown ones and False (not using a proxy)
+    def healthy(self, proxy):
+        with self.lock:
+            stats = self.stats.get(proxy)
+            return stats is None or self._healthy(stats)
+
+    # Average latency over the last probes, or None before the first successful one
+    def latency(self, proxy):
+        with self.lock:
+            latency = self.stats[proxy]['latency']
+            return sum(latency) / len(latency) if latency else None
+
+    # Share of the last probes that failed
+    def error_rate(self, proxy):
+        with self.lock:
+            results = self.stats[proxy]['results']
+            return float(results.count(False)) / len(results) if results else 0.0
+
+    # Position of proxy in --proxy, for the status display
+    def index(self, proxy):
+        return self.proxies.index(proxy)
+
+    # Move a worker from proxy previous (False for none) to the least loaded healthy proxy, and return that.
+    # Returns False without proxies.
+    def assign(self, previous=False):
+        with self.lock:
+            if previous in self.stats:
+                self.stats[previous]['workers'] -= 1
+
+            if not self.proxies:
+                return False
+
+            candidates = [proxy for proxy in self.proxies if self._healthy(self.stats[proxy])]
+            if not candidates:
+                log.error('None of the proxies are working, assigning one anyway')
+                candidates = self.proxies
+
+            def load(proxy):
+                latency = self.stats[proxy]['latency']
+                return (self.stats[proxy]['workers'], sum(latency) / len(latency) if latency else float('inf'))
+
+            proxy = min(candidates, key=load)
+            self.stats[proxy]['workers'] += 1
+            return proxy
+
+    def _refresher(self):
+        while True:
+            time.sleep(self.args.proxy_refresh_interval)
+
+            log.debug('Probing %d proxies', len(self.proxies))
+            results = probe_proxies(self.proxies, self.args.proxy_test_url, self.args.proxy_timeout, self.args.proxy_check_threads)
+            for result in results:
+                self.record(result)
+            if self.on_probe is not None:
+                self.on_probe(results)
+
+            with self.lock:
+                healthy = len([proxy for proxy in self.proxies if self._healthy(self.stats[proxy])])
+            log.info('Proxy probe completed, %d of %d proxies working', healthy, len(self.proxies))
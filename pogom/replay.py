@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Recording the responses workers get from the API, and feeding them through the database and webhooks again.
+
+With --record-map-objects, the map responses of all scans, and the gym details fetched for -gi, are written to
+a gzipped file, one JSON object per line:
+
+    {"time": 1479244800.5, "type": "map", "location": [lat, lng, alt], "response": {"responses": {...}}}
+    {"time": 1479244801.2, "type": "gyms", "responses": {gym_id: {...}}}
+
+With --replay, runserver.py doesn't scan but feeds recorded responses through parse_map() and parse_gyms()
+into the database and webhook threads, at the speed they were recorded at or as fast as they go, so the ingest
+path can be benchmarked with real data without any accounts. Timestamps in the responses are left as they
+were recorded.
+'''
+
+import gzip
+import heapq
+import json
+import logging
+import time
+
+from threading import Thread
+from queue import Queue, Empty
+
+from .models import parse_map, parse_gyms
+from .utils import CellCache
+
+log = logging.getLogger(__name__)
+
+# Recordings are flushed at least this often (seconds), so a recording is readable up to then if the scanner
+# doesn't stop cleanly
+RECORD_FLUSH_INTERVAL = 5
+
+
+# Writes the responses of the workers to a recording. Workers only queue them up; encoding, compressing and
+# writing them is left to a thread of its own.
+class MapRecorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = Queue()
+
+    def start(self):
+        log.info('Recording map responses to %s', self.path)
+        t = Thread(target=self._writer, name='map-recorder')
+        t.daemon = True
+        t.start()
+
+    def map(self, step_location, response):
+        # Only what parse_map() looks at; the rest of the response is about the session
+        self.queue.put({
+            'time': time.time(),
+            'type': 'map',
+            'location': step_location,
+            'response': {'responses': {'GET_MAP_OBJECTS': response['responses']['GET_MAP_OBJECTS']}}
+        })
+
+    def gyms(self, gym_responses):
+        self.queue.put({
+            'time': time.time(),
+            'type': 'gyms',
+            'responses': gym_responses
+        })
+
+    def _writer(self):
+        f = gzip.open(self.path, 'wb')
+        last_flush = time.time()
+        while True:
+            try:
+                record = self.queue.get(timeout=RECORD_FLUSH_INTERVAL)
+                try:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                except (TypeError, ValueError) as e:
+                    log.warning('Unable to record %s response: %s', record['type'], e)
+            except Empty:
+                pass
+
+            if time.time() - last_flush >= RECORD_FLUSH_INTERVAL:
+                f.flush()
+                last_flush = time.time()
+
+
+# The records of a recording, oldest first
+def read_recording(path):
+    with gzip.open(path, 'rb') as f:
+        try:
+            for line in f:
+                yield json.loads(line)
+        except (IOError, EOFError, ValueError) as e:
+            # Cut off when the scanner that recorded it stopped
+            log.warning('Recording %s ends early: %s', path, e)
+
+
+# Feeds the records of recordings (those of several search processes are merged by time) through parse_map()
+# and parse_gyms(). speed 1 replays them at the speed they were recorded at, 2 twice as fast, and so on; 0 as
+# fast as they can be parsed. Returns once the database and webhook threads have caught up.
+def replay(args, paths, speed, user_location, db_updates_queue, wh_queue, gym_updates_queue):
+    cell_cache = None if args.no_cell_cache else CellCache()
+
+    records = heapq.merge(*[((record['time'], record) for record in read_recording(path)) for path in paths])
+
+    log.info('Replaying %s', ', '.join(paths))
+    start = time.time()
+    first = None
+    maps = gyms = 0
+    for recorded, record in records:
+        if first is None:
+            first = recorded
+        if speed > 0:
+            wait = start + (recorded - first) / speed - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+        if record['type'] == 'map':
+            try:
+                parse_map(args, record['response'], record['location'], user_location, db_updates_queue, wh_queue, cell_cache)
+            except KeyError:
+                log.exception('Unable to parse recorded map response')
+            maps += 1
+        elif record['type'] == 'gyms':
+            parse_gyms(args, record['responses'], wh_queue, gym_updates_queue)
+            gyms += 1
+
+    parsed = time.time() - start
+    log.info('Replayed %d map responses and %d gym details responses in %.1f seconds (%.1f map responses/s), waiting for the database and webhooks to catch up',
+             maps, gyms, parsed, maps / parsed if parsed else 0)
+
+    for q in (db_updates_queue, wh_queue, gym_updates_queue):
+        q.join()
+    log.info('Replay done after %.1f seconds', time.time() - start)
@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Worker runtimes.
+
+Search workers are written as generators that yield whatever they are about to wait for,
+instead of blocking on it themselves:
+
+    yield Sleep(seconds)               - pause for a while
+    result = yield Call(fn, *args)     - run a blocking function (API requests, database work)
+    result = yield Wait(poll, block)   - wait for something to become available (queues, pause switch)
+    yield some_generator()             - run another generator to completion, like a function call
+
+Exceptions raised by a Call, or by a nested generator, are thrown back into the generator
+that yielded it, so the usual try/except blocks work unchanged.
+
+There are two ways to drive such a worker:
+ - run_in_thread() runs it on the calling thread, simply doing each thing it yields. This is
+   the classic one thread per account setup.
+ - CoroutineRuntime multiplexes any number of workers on a single scheduler thread and hands
+   blocking calls to a bounded pool of threads. A sleeping worker costs nothing but a heap entry.
+   A waiting worker is a heap entry too, but polls what it waits for every second or so (a
+   get_nowait() or the like), so one process can still run thousands of accounts.
+
+Whatever blocks, including API calls that don't look like it (creating an API, the first
+set_position() of the fake API, which logs in), has to be a Call: anything else a worker does
+runs on the scheduler thread and holds up all other workers.
+'''
+
+import heapq
+import itertools
+import logging
+import sys
+import time
+import types
+
+from multiprocessing.pool import ThreadPool
+from threading import Thread
+from queue import Queue, Empty
+
+log = logging.getLogger(__name__)
+
+# Returned by a Wait's poll function when there is nothing to hand out yet
+NOT_READY = object()
+
+
+class Sleep(object):
+
+    def __init__(self, seconds):
+        self.seconds = max(seconds, 0)
+
+
+class Call(object):
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.fn(*self.args, **self.kwargs)
+
+
+# poll() must not block; it returns NOT_READY or the result. block() waits for and returns the result.
+# retry is the number of seconds between polls, or a function returning it.
+class Wait(object):
+
+    def __init__(self, poll, block, retry=1):
+        self.poll = poll
+        self.block = block
+        self.retry = retry
+
+    def retry_in(self):
+        return self.retry() if callable(self.retry) else self.retry
+
+
+# Wait for the next ready item of a DelayQueue. Polls when the head is due, or at least every second
+# in case the queue gets refilled.
+def wait_for_item(queue):
+    def poll():
+        try:
+            return queue.get_ready(timeout=0)
+        except Empty:
+            return NOT_READY
+
+    def retry():
+        remain = queue.next_ready_in()
+        return 1 if remain is None else min(remain, 1)
+
+    return Wait(poll, queue.get_ready, retry)
+
+
+# Wait for an item of a plain Queue
+def wait_for_queue(queue):
+    def poll():
+        try:
+            return queue.get_nowait()
+        except Empty:
+            return NOT_READY
+
+    return Wait(poll, queue.get)
+
+
+# Wait until the SearchControl pause switch is released
+def wait_for_resume(control):
+    return Wait(lambda: NOT_READY if control.is_set() else True, control.wait_for_resume)
+
+
+# Send a value (or throw an exception) into the innermost generator of stack and return the
+# next instruction it yields. Nested generators are pushed onto the stack and finished generators
+# popped off it. Returns None once the outermost generator has finished, and re-raises anything
+# the outermost generator doesn't handle.
+def _advance(stack, value=None, exc_info=None):
+    while stack:
+        try:
+            if exc_info is not None:
+                instruction = stack[-1].throw(*exc_info)
+            else:
+                instruction = stack[-1].send(value)
+        except StopIteration:
+            stack.pop()
+            value, exc_info = None, None
+            continue
+        except Exception:
+            stack.pop()
+            if not stack:
+                raise
+            value, exc_info = None, sys.exc_info()
+            continue
+
+        if isinstance(instruction, types.GeneratorType):
+            stack.append(instruction)
+            value, exc_info = None, None
+            continue
+
+        return instruction
+
+    return None
+
+
+# Run a worker generator on the current thread until it finishes
+def run_in_thread(worker):
+    stack = [worker]
+    value, exc_info = None, None
+
+    while True:
+        instruction = _advance(stack, value, exc_info)
+        value, exc_info = None, None
+
+        if instruction is None:
+            return
+        elif isinstance(instruction, Sleep):
+            time.sleep(instruction.seconds)
+        elif isinstance(instruction, Call):
+            try:
+                value = instruction()
+            except Exception:
+                exc_info = sys.exc_info()
+        elif isinstance(instruction, Wait):
+            value = instruction.block()
+        else:
+            exc_info = (TypeError, TypeError('Workers cannot yield {!r}'.format(instruction)), None)
+
+
+class _Task(object):
+
+    def __init__(self, worker, name):
+        self.stack = [worker]
+        self.name = name
+        self.waiting = None
+
+
+# Runs worker generators as coroutines on one scheduler thread. Blocking calls are handed to a
+# pool of pool_size threads, which is the only limit on how many of them run at once.
+class CoroutineRuntime(object):
+
+    def __init__(self, pool_size):
+        self.pool = ThreadPool(pool_size)
+        # Results of finished blocking calls, as (task, value, exc_info)
+        self.completed = Queue()
+        # Sleeping and polling tasks, as (wake up time, sequence, task)
+        self.timers = []
+        self.counter = itertools.count()
+
+    def spawn(self, worker, name):
+        self.completed.put((_Task(worker, name), None, None))
+
+    def start(self, name='coroutine-runtime'):
+        t = Thread(target=self.run, name=name)
+        t.daemon = True
+        t.start()
+        return t
+
+    def run(self):
+        log.info('Coroutine runtime starting')
+
+        while True:
+            timeout = None
+            if self.timers:
+                timeout = max(self.timers[0][0] - time.time(), 0)
+
+            try:
+                task, value, exc_info = self.completed.get(timeout=timeout)
+                self._step(task, value, exc_info)
+                # Handle everything else that finished meanwhile before looking at the timers again
+                while True:
+                    task, value, exc_info = self.completed.get_nowait()
+                    self._step(task, value, exc_info)
+            except Empty:
+                pass
+
+            current = time.time()
+            while self.timers and self.timers[0][0] <= current:
+                task = heapq.heappop(self.timers)[2]
+                self._wake(task)
+
+    def _sleep(self, task, seconds):
+        heapq.heappush(self.timers, (time.time() + seconds, next(self.counter), task))
+
+    def _wake(self, task):
+        wait = task.waiting
+        if wait is None:
+            self._step(task)
+            return
+
+        value = wait.poll()
+        if value is NOT_READY:
+            self._sleep(task, wait.retry_in())
+        else:
+            task.waiting = None
+            self._step(task, value)
+
+    def _call(self, task, instruction):
+        try:
+            value = instruction()
+        except Exception:
+            self.completed.put((task, None, sys.exc_info()))
+        else:
+            self.completed.put((task, value, None))
+
+    # Advance a task until it yields something it has to wait for
+    def _step(self, task, value=None, exc_info=None):
+        while True:
+            try:
+                instruction = _advance(task.stack, value, exc_info)
+            except Exception as e:
+                log.exception('Coroutine %s died: %s', task.name, e)
+                return
+            value, exc_info = None, None
+
+            if instruction is None:
+                log.debug('Coroutine %s finished', task.name)
+                return
+            elif isinstance(instruction, Sleep):
+                self._sleep(task, instruction.seconds)
+                return
+            elif isinstance(instruction, Call):
+                self.pool.apply_async(self._call, (task, instruction))
+                return
+            elif isinstance(instruction, Wait):
+                value = instruction.poll()
+                if value is NOT_READY:
+                    task.waiting = instruction
+                    self._sleep(task, instruction.retry_in())
+                    return
+            else:
+                exc_info = (TypeError, TypeError('Workers cannot yield {!r}'.format(instruction)), None)
@@ -37,11 +37,11 @@ If implementing a new scheduler, place it before SchedulerFactory, and add it to
 
 import logging
 import math
-import geopy
 import json
 from queue import Empty
 from operator import itemgetter
 from .transform import get_new_coords
+from . import geo
 from .models import hex_bounds, Pokemon
 from .utils import now, cur_sec
 
@@ -71,7 +71,7 @@ class BaseScheduler(object):
 
     # scanning_pause function is called when scanning is paused from the UI
     # The default function will empty all the queues.
-    # Note: This function is called repeatedly while scanning is paused!
+    # Note: This function is called once each time scanning is paused, not while it stays paused.
     def scanning_paused(self):
         self.empty_queues()
 
@@ -222,7 +222,8 @@ class HexSearch(BaseScheduler):
 class HexSearchSpawnpoint(HexSearch):
 
     def _any_spawnpoints_in_range(self, coords, spawnpoints):
-        return any(geopy.distance.distance(coords, x).meters <= 70 for x in spawnpoints)
+        origin = geo.Origin(coords[0], coords[1])
+        return any(origin.distance(lat, lng) <= 70 for lat, lng in spawnpoints)
 
     # Extend the generate_locations function to remove locations with no spawnpoints
     def _generate_locations(self):
@@ -15,18 +15,26 @@ Search Architecture:
    - Listens to the same Queue for areas to scan
    - Can re-login as needed
    - Pushes finds to db queue and webhook queue
+ - With --search-processes, the workers are spread over several processes:
+   - Each process runs its own overseer for a share of the workers and accounts
+   - The main process passes location changes and pausing on to them
+   - Finds and worker status come back to the main process over multiprocessing queues
 '''
 
+import bisect
+import copy
+import itertools
 import logging
 import math
+import multiprocessing
 import os
 import random
+import signal
+import sys
 import time
-import geopy
-import geopy.distance
 
-from datetime import datetime
-from threading import Thread
+from functools import partial
+from threading import Thread, Timer
 from queue import Queue, Empty
 
 from pgoapi import PGoApi
@@ -34,30 +42,46 @@ from pgoapi.utilities import f2i
 from pgoapi import utilities as util
 from pgoapi.exceptions import AuthException
 
-from .models import parse_map, GymDetails, parse_gyms, MainWorker, WorkerStatus
+from .models import parse_map, parse_gyms
 from .fakePogoApi import FakePogoApi
-from .utils import now
-from .transform import get_new_coords
+from .account import AccountPool, LoginManager
+from .proxy import ProxyPool
+from .gyms import GymIndex, GymDetailQueue
+from .status import StatusRegistry
+from .replay import MapRecorder
+from .utils import now, CellCache, DelayQueue, PhaseTimer, SearchControl, SignalQueue, TIMING_BUCKETS
+from .transform import get_new_coords, get_beehive_locations
+from . import geo
+from .runtime import CoroutineRuntime, Call, Sleep, run_in_thread, wait_for_item, wait_for_queue, wait_for_resume
+from . import metrics
 import schedulers
 
 import terminalsize
 
 log = logging.getLogger(__name__)
 
+# How close (in meters) to a gym search workers have to be to fetch its details, see update_gyms()
+GYM_DETAILS_RANGE = 1000
+
+# How many gym details search workers fetch between hex scans, when there are no gym workers to do it
+GYMS_BETWEEN_SCANS = 3
+
+# How long to wait before asking a scheduler that had nothing to scan again
+SCHEDULE_RETRY_SECONDS = 5
+
 TIMESTAMP = '\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000'
 
 
 # Apply a location jitter
 def jitterLocation(location=None, maxMeters=10):
-    origin = geopy.Point(location[0], location[1])
     b = random.randint(0, 360)
-    d = math.sqrt(random.random()) * (float(maxMeters) / 1000)
-    destination = geopy.distance.distance(kilometers=d).destination(origin, b)
-    return (destination.latitude, destination.longitude, location[2])
+    d = math.sqrt(random.random()) * maxMeters
+    lat, lng = geo.destination(location[0], location[1], d, b)
+    return (lat, lng, location[2])
 
 
 # Thread to handle user input
-def switch_status_printer(display_type, current_page):
+def switch_status_printer(display_type, current_page, redraw):
     # Get a reference to the root logger
     mainlog = logging.getLogger()
     # Disable logging of the first handler - the stream handler, and disable it's output
@@ -66,6 +90,8 @@ def switch_status_printer(display_type, current_page):
     while True:
         # Wait for the user to press a key
         command = raw_input()
+        # What the user typed is on the screen now
+        redraw[0] = True
 
         if command == '':
             # Switch between logging and display.
@@ -86,54 +112,132 @@ def switch_status_printer(display_type, current_page):
         elif command.lower() == 'f':
                 mainlog.handlers[0].setLevel(logging.CRITICAL)
                 display_type[0] = 'failedaccounts'
+        elif command.lower() == 't':
+            mainlog.handlers[0].setLevel(logging.CRITICAL)
+            display_type[0] = 'timings'
+
+
+# The ids of the workers in threadStatus, sorted. Workers are only ever added, so the index only has to look
+# for new ones when threadStatus has grown, instead of sorting all of them every time the status is printed.
+class WorkerIndex(object):
+
+    def __init__(self, threadStatus):
+        self.threadStatus = threadStatus
+        self.size = 0
+        self.ids = []
+
+    def update(self):
+        if len(self.threadStatus) != self.size:
+            known = set(self.ids)
+            for item, status in self.threadStatus.items():
+                if item not in known and status['type'] == 'Worker':
+                    bisect.insort(self.ids, item)
+            self.size = len(self.threadStatus)
+        return self.ids
+
+
+# Draws the status screen, rewriting only the lines that changed since the last time with ANSI escape codes
+# instead of clearing the whole screen. Windows consoles don't know these codes; there the screen is still
+# cleared, but only when something changed.
+class StatusScreen(object):
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        # The lines on the screen, None when we don't know what is on it
+        self.lines = None
+
+    # Draw the next screen from scratch, e.g. after logs or user input have been written over it
+    def reset(self):
+        self.lines = None
+
+    def draw(self, lines, width):
+        # Lines wrapping around would push everything below them down a row
+        lines = [line[:width] for line in lines]
+        if lines == self.lines:
+            return
+
+        if os.name == 'nt':
+            os.system('cls')
+            self.out.write('\n'.join(lines) + '\n')
+        elif self.lines is None:
+            self.out.write('\033[H\033[2J' + '\n'.join(lines))
+        else:
+            changes = []
+            for row, line in enumerate(lines):
+                if row >= len(self.lines) or line != self.lines[row]:
+                    changes.append('\033[{};1H{}\033[K'.format(row + 1, line))
+            if len(lines) < len(self.lines):
+                changes.append('\033[{};1H\033[J'.format(len(lines) + 1))
+            self.out.write(''.join(changes))
+
+        # Leave the cursor below the status, where commands are typed
+        if os.name != 'nt':
+            self.out.write('\033[{};1H'.format(len(lines) + 1))
+        self.out.flush()
+        self.lines = lines
 
 
 # Thread to print out the status of each worker
-def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue, account_queue, account_failures):
+def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue, account_pool):
     display_type = ["workers"]
     current_page = [1]
+    # Set by the input thread when the user typed something over the status
+    redraw = [False]
 
     # Start another thread to get user input
     t = Thread(target=switch_status_printer,
                name='switch_status_printer',
-               args=(display_type, current_page))
+               args=(display_type, current_page, redraw))
     t.daemon = True
     t.start()
 
+    worker_index = WorkerIndex(threadStatus)
+    screen = StatusScreen()
+    # Column widths only grow, so they don't jump around from one second to the next
+    userlen = 4
+    proxylen = 5
+    total_pages = 1
+    last_size = None
+
     while True:
         time.sleep(1)
 
         if display_type[0] == 'logs':
             # In log display mode, we don't want to show anything
+            screen.reset()
             continue
 
+        # Get the terminal size
+        width, height = terminalsize.get_terminal_size()
+        if redraw[0] or (width, height) != last_size:
+            redraw[0] = False
+            last_size = (width, height)
+            screen.reset()
+
         # Create a list to hold all the status lines, so they can be printed all at once to reduce flicker
         status_text = []
 
         if display_type[0] == 'workers':
 
-            # Get the terminal size
-            width, height = terminalsize.get_terminal_size()
             # Queue and overseer take 2 lines.  Switch message takes up 2 lines.  Remove an extra 2 for things like screen status lines.
             usable_height = height - 6
             # Prevent people running terminals only 6 lines high from getting a divide by zero
             if usable_height < 1:
                 usable_height = 1
 
+            worker_ids = worker_index.update()
+
             # Calculate total skipped items
-            skip_total = 0
-            for item in threadStatus:
-                if 'skip' in threadStatus[item]:
-                    skip_total += threadStatus[item]['skip']
+            skip_total = sum(threadStatus[item]['skip'] for item in worker_ids)
 
             # Print the queue length
-            status_text.append('Queues: {} search items, {} db updates, {} webhook.  Total skipped items: {}. Spare accounts available: {}. Accounts on hold: {}'.format(search_items_queue.qsize(), db_updates_queue.qsize(), wh_queue.qsize(), skip_total, account_queue.qsize(), len(account_failures)))
+            status_text.append('Queues: {} search items, {} db updates, {} webhook.  Total skipped items: {}. Spare accounts available: {}. Accounts on hold: {}'.format(search_items_queue.qsize(), db_updates_queue.qsize(), wh_queue.qsize(), skip_total, account_pool.qsize(), account_pool.resting_count()))
 
             # Print status of overseer
             status_text.append('{} Overseer: {}'.format(threadStatus['Overseer']['scheduler'], threadStatus['Overseer']['message']))
 
-            # Calculate the total number of pages.  Subtracting 1 for the overseer.
-            total_pages = math.ceil((len(threadStatus) - 1) / float(usable_height))
+            # Calculate the total number of pages
+            total_pages = max(1, int(math.ceil(len(worker_ids) / float(usable_height))))
 
             # Prevent moving outside the valid range of pages
             if current_page[0] > total_pages:
@@ -141,138 +245,126 @@ def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue,
             if current_page[0] < 1:
                 current_page[0] = 1
 
-            # Calculate which lines to print
+            # The workers on this page
             start_line = usable_height * (current_page[0] - 1)
-            end_line = start_line + usable_height
-            current_line = 1
+            page = [(item, threadStatus[item]) for item in worker_ids[start_line:start_line + usable_height]]
 
             # Find the longest username and proxy
-            userlen = 4
-            proxylen = 5
-            for item in threadStatus:
-                if threadStatus[item]['type'] == 'Worker':
-                    userlen = max(userlen, len(threadStatus[item]['user']))
-                    if 'proxy_display' in threadStatus[item]:
-                        proxylen = max(proxylen, len(str(threadStatus[item]['proxy_display'])))
+            for item, worker in page:
+                userlen = max(userlen, len(worker['user']))
+                proxylen = max(proxylen, len(str(worker.get('proxy_display', ''))))
 
             # How pretty
             status = '{:10} | {:5} | {:' + str(userlen) + '} | {:' + str(proxylen) + '} | {:7} | {:6} | {:5} | {:7} | {:10}'
 
             # Print the worker status
             status_text.append(status.format('Worker ID', 'Start', 'User', 'Proxy', 'Success', 'Failed', 'Empty', 'Skipped', 'Message'))
-            for item in sorted(threadStatus):
-                if(threadStatus[item]['type'] == 'Worker'):
-                    current_line += 1
-
-                    # Skip over items that don't belong on this page
-                    if current_line < start_line:
-                        continue
-                    if current_line > end_line:
-                        break
-
-                    status_text.append(status.format(item, time.strftime('%H:%M', time.localtime(threadStatus[item]['starttime'])), threadStatus[item]['user'], threadStatus[item]['proxy_display'], threadStatus[item]['success'], threadStatus[item]['fail'], threadStatus[item]['noitems'], threadStatus[item]['skip'], threadStatus[item]['message']))
+            for item, worker in page:
+                status_text.append(status.format(item, time.strftime('%H:%M', time.localtime(worker['starttime'])), worker['user'], worker['proxy_display'], worker['success'], worker['fail'], worker['noitems'], worker['skip'], worker['message']))
 
         elif display_type[0] == 'failedaccounts':
             status_text.append('-----------------------------------------')
             status_text.append('Accounts on hold:')
             status_text.append('-----------------------------------------')
 
+            resting = account_pool.get_resting()
+
             # Find the longest account name
             userlen = 4
-            for account in account_failures:
-                userlen = max(userlen, len(account['account']['username']))
+            for account, ready_time, reason in resting:
+                userlen = max(userlen, len(account['username']))
 
             status = '{:' + str(userlen) + '} | {:10} | {:20}'
-            status_text.append(status.format('User', 'Hold Time', 'Reason'))
+            status_text.append(status.format('User', 'Hold Until', 'Reason'))
+
+            for account, ready_time, reason in resting:
+                status_text.append(status.format(account['username'], time.strftime('%H:%M:%S', time.localtime(ready_time)), reason))
+
+        elif display_type[0] == 'timings':
+            status_text.append('-----------------------------------------')
+            status_text.append('Time spent by all workers:')
+            status_text.append('-----------------------------------------')
 
-            for account in account_failures:
-                status_text.append(status.format(account['account']['username'], time.strftime('%H:%M:%S', time.localtime(account['last_fail_time'])), account['reason']))
+            timer = PhaseTimer.combined(threadStatus.values())
+            total = sum(histogram.sum for histogram in timer.histograms.values())
+
+            # Percentiles are the upper bounds of the histogram buckets they fall in
+            def bound(value):
+                if value is None:
+                    return '-'
+                return '> {}'.format(TIMING_BUCKETS[-2]) if value == float('inf') else '<= {}'.format(value)
+
+            status = '{:12} | {:8} | {:10} | {:6} | {:8} | {:8} | {:8} | {:8}'
+            status_text.append(status.format('Phase', 'Count', 'Total (s)', 'Share', 'Mean (s)', 'p50', 'p90', 'p99'))
+            for phase in PhaseTimer.PHASES:
+                histogram = timer.histograms[phase]
+                status_text.append(status.format(
+                    phase, histogram.count, '{:.1f}'.format(histogram.sum),
+                    '{:.1%}'.format(histogram.sum / total) if total else '-',
+                    '{:.3f}'.format(histogram.sum / histogram.count) if histogram.count else '-',
+                    bound(histogram.quantile(0.5)), bound(histogram.quantile(0.9)), bound(histogram.quantile(0.99))))
 
         # Print the status_text for the current screen
-        status_text.append('Page {}/{}. Page number to switch pages. F to show on hold accounts. <ENTER> alone to switch between status and log view'.format(current_page[0], total_pages))
-        # Clear the screen
-        os.system('cls' if os.name == 'nt' else 'clear')
+        status_text.append('Page {}/{}. Page number to switch pages. F to show on hold accounts. T to show timings. <ENTER> alone to switch between status and log view'.format(current_page[0], total_pages))
         # Print status
-        print "\n".join(status_text)
+        screen.draw(status_text, width)
 
 
-# The account recycler monitors failed accounts and places them back in the account queue 2 hours after they failed.
-# This allows accounts that were soft banned to be retried after giving them a chance to cool down.
-def account_recycler(accounts_queue, account_failures, args):
-    while True:
-        # Run once a minute
-        time.sleep(60)
-        log.info('Account recycler running. Checking status of {} accounts'.format(len(account_failures)))
-
-        # Create a new copy of the failure list to search through, so we can iterate through it without it changing
-        failed_temp = list(account_failures)
-
-        # Search through the list for any item that last failed before 2 hours ago
-        ok_time = now() - args.account_rest_interval
-        for a in failed_temp:
-            if a['last_fail_time'] <= ok_time:
-                # Remove the account from the real list, and add to the account queue
-                log.info('Account {} returning to active duty.'.format(a['account']['username']))
-                account_failures.remove(a)
-                accounts_queue.put(a['account'])
-            else:
-                log.info('Account {} needs to cool off for {} seconds due to {}'.format(a['account']['username'], a['last_fail_time'] - ok_time, a['reason']))
+# Make the status of the workers in threadStatus part of /metrics
+def register_worker_metrics(threadStatus):
 
+    def workers():
+        return [(name, status) for name, status in threadStatus.items() if status['type'] == 'Worker']
 
-def worker_status_db_thread(threads_status, name, db_updates_queue):
-    log.info("Clearing previous statuses for '%s' worker", name)
-    WorkerStatus.delete().where(WorkerStatus.worker_name == name).execute()
+    def scans():
+        samples = []
+        for name, status in workers():
+            for result in ('success', 'fail', 'noitems', 'skip'):
+                samples.append(({'worker': name, 'result': result}, status.get(result, 0)))
+        return samples
 
-    while True:
-        workers = {}
-        overseer = None
-        for status in threads_status.values():
-            if status['type'] == 'Overseer':
-                overseer = {
-                    'worker_name': name,
-                    'message': status['message'],
-                    'method': status['scheduler'],
-                    'last_modified': datetime.utcnow()
-                }
-            if status['type'] == 'Worker':
-                workers[status['user']] = {
-                    'username': status['user'],
-                    'worker_name': name,
-                    'success': status['success'],
-                    'fail': status['fail'],
-                    'no_items': status['noitems'],
-                    'skip': status['skip'],
-                    'last_modified': datetime.utcnow(),
-                    'message': status['message']
-                }
-        if overseer is not None:
-            db_updates_queue.put((MainWorker, {0: overseer}))
-            db_updates_queue.put((WorkerStatus, workers))
-        time.sleep(3)
+    def queued():
+        return [({}, sum(status.get('queued', 0) for name, status in workers()))]
+
+    def phases():
+        timer = PhaseTimer.combined(status for name, status in workers())
+        return [({'phase': phase}, timer.histograms[phase]) for phase in PhaseTimer.PHASES]
+
+    metrics.register(metrics.Collected('pogom_worker_scans', 'Scans of each worker with its current account, by result.', scans))
+    metrics.register(metrics.Collected('pogom_search_queue_items', 'Items waiting in the search queues of all workers.', queued))
+    metrics.register(metrics.Collected('pogom_worker_phase_seconds', 'Time spent by all workers, by phase of their loop. The count of the map_request phase counts the scans.', phases, kind='histogram'))
 
 
 # The main search loop that keeps an eye on the over all process
-def search_overseer_thread(args, user_location, new_location_queue, pause_bit, heartb, encryption_lib_path, db_updates_queue, wh_queue):
+# worker_ids and gym_worker_ids limit this overseer to some of the workers (hive cells) and gym workers, when they are spread over several processes.
+def search_overseer_thread(args, user_location, new_location_queue, pause_bit, heartb, encryption_lib_path, db_updates_queue, wh_queue, gym_updates_queue, worker_ids=None, status_queue=None, overseer_events=None, gym_worker_ids=None, status_registry=None):
 
     log.info('Search overseer starting')
 
+    if worker_ids is None:
+        worker_ids = range(0, args.workers)
+    if gym_worker_ids is None:
+        gym_worker_ids = range(0, args.gym_workers)
+
     search_items_queue_array = []
     scheduler_array = []
-    account_queue = Queue()
     threadStatus = {}
 
+    # Everything the overseer reacts to arrives here as (event, value) tuples: a worker queue draining
+    # (value is its index), a new location being posted, scanning being paused/resumed, or, from the main
+    # process, more workers being handed over (value is a (worker ids, accounts, gym worker ids) tuple) and
+    # the results of probing the proxies.
+    if overseer_events is None:
+        overseer_events = Queue()
+
     '''
-    Create a queue of accounts for workers to pull from. When a worker has failed too many times,
-    it can get a new account from the queue and reinitialize the API. Workers should return accounts
-    to the queue so they can be tried again later, but must wait a bit before doing do so to
-    prevent accounts from being cycled through too quickly.
+    Create a pool of accounts for workers to pull from. When a worker has failed too many times,
+    it can get a new account from the pool and reinitialize the API. Workers return accounts
+    to the pool, which lets them rest or cool down for a while before handing them out again,
+    to prevent accounts from being cycled through too quickly.
     '''
-    for i, account in enumerate(args.accounts):
-        account_queue.put(account)
+    account_pool = AccountPool(args, args.accounts)
 
-    # Create a list for failed accounts
-    account_failures = []
-    
     search_items_queue = Queue()
 
     threadStatus['Overseer'] = {
@@ -285,40 +377,85 @@ def search_overseer_thread(args, user_location, new_location_queue, pause_bit, h
         log.info('Starting status printer thread')
         t = Thread(target=status_printer,
                    name='status_printer',
-                   args=(threadStatus, search_items_queue, db_updates_queue, wh_queue, account_queue, account_failures))
+                   args=(threadStatus, search_items_queue, db_updates_queue, wh_queue, account_pool))
         t.daemon = True
         t.start()
 
-    # Create account recycler thread
-    log.info('Starting account recycler thread')
-    t = Thread(target=account_recycler, name='account-recycler', args=(account_queue, account_failures, args))
-    t.daemon = True
-    t.start()
-
     if args.status_name is not None:
-        log.info('Starting status database thread')
-        t = Thread(target=worker_status_db_thread,
-                   name='status_worker_db',
-                   args=(threadStatus, args.status_name, db_updates_queue))
+        if status_registry is None:
+            status_registry = StatusRegistry(args.status_name)
+        log.info('Starting status writer thread')
+        status_registry.start(threadStatus)
+
+    # The main process serves /metrics; search processes send their worker status there
+    if status_queue is None:
+        register_worker_metrics(threadStatus)
+
+    if status_queue is not None:
+        log.info('Starting status relay thread')
+        t = Thread(target=status_relay_thread,
+                   name='status-relay',
+                   args=(threadStatus, status_queue))
         t.daemon = True
         t.start()
 
-    # Create specified number of search_worker_thread
-    log.info('Starting search worker threads')
-    for i in range(0, args.workers):
+    # Workers are spread over the proxies by load, and moved off proxies that stop working. In a search
+    # process, the main process probes the proxies and sends the results.
+    proxy_pool = ProxyPool(args, args.proxy or [])
+    if status_queue is None:
+        proxy_pool.start()
+
+    # Login sessions are kept for all workers, and across restarts. Accounts without one are logged in
+    # ahead of time, spread over the proxies that work.
+    logins = LoginManager(args.token_cache)
+
+    def login_proxies():
+        return [proxy for proxy in proxy_pool.proxies if proxy_pool.healthy(proxy)]
+
+    if args.mock == '':
+        logins.start()
+        logins.prepare(args.accounts, login_proxies)
+
+    # Gyms in need of details are queued up for all workers; what they need is decided from memory
+    gym_index = GymIndex()
+    gym_queue = GymDetailQueue()
+    if args.gym_info:
+        gym_index.warm()
+
+    # Forts of map cells that haven't changed since any of the workers last scanned them are skipped
+    cell_cache = None if args.no_cell_cache else CellCache()
+
+    # Map responses are recorded for --replay; search processes each write a file of their own
+    recorder = None
+    if args.record_map_objects:
+        path = args.record_map_objects
+        if status_queue is not None:
+            path = '{}.{}'.format(path, os.getpid())
+        recorder = MapRecorder(path)
+        recorder.start()
+
+    # With the coroutine runtime all workers share one scheduler thread and a pool of threads for blocking calls
+    runtime = None
+    if args.worker_runtime == 'coroutines':
+        log.info('Starting coroutine runtime with %d threads for blocking calls', args.worker_pool_size)
+        runtime = CoroutineRuntime(args.worker_pool_size)
+
+    # The workers this overseer is running, by index
+    running_ids = []
+
+    # Indexes of the workers whose scheduler had nothing to scan, and will be asked again
+    retrying = set()
+
+    # Start worker i, with its own search queue and scheduler. Returns its index.
+    def add_worker(i):
         log.debug('Starting search worker thread %d', i)
-        
-        search_items_queue = Queue()
-        search_items_queue_array.append(search_items_queue)
+        index = len(running_ids)
+        running_ids.append(i)
 
-        # Set proxy for each worker, using round robin
-        proxy_display = 'No'
-        proxy_url = False
-
-        if args.proxy:
-            proxy_display = proxy_url = args.proxy[i % len(args.proxy)]
-            if args.proxy_display.upper() != 'FULL':
-                proxy_display = i % len(args.proxy)
+        # Wake the overseer as soon as the worker takes the last item from its queue.
+        # Items come out in the order they are due, see search_item_ready_time().
+        search_items_queue = DelayQueue(search_item_ready_time, on_low=partial(overseer_events.put, ('drained', index)))
+        search_items_queue_array.append(search_items_queue)
 
         workerId = 'Worker {:03}'.format(i)
         threadStatus[workerId] = {
@@ -329,75 +466,447 @@ def search_overseer_thread(args, user_location, new_location_queue, pause_bit, h
             'noitems': 0,
             'skip': 0,
             'user': '',
-            'proxy_display': proxy_display,
-            'proxy_url': proxy_url,
+            'proxy_display': 'No',
+            'proxy_url': False,
             'location': False,
             'last_scan_time': 0,
+            'timings': PhaseTimer(),
         }
 
-        t = Thread(target=search_worker_thread,
-                   name='search-worker-{}'.format(i),
-                   args=(args, user_location, account_queue, account_failures, search_items_queue, pause_bit,
-                         encryption_lib_path, threadStatus[workerId],
-                         db_updates_queue, wh_queue))
-        t.daemon = True
-        t.start()
-                
+        worker_args = (args, user_location, account_pool, logins, proxy_pool, gym_index, gym_queue, cell_cache, recorder, search_items_queue, pause_bit,
+                       encryption_lib_path, threadStatus[workerId],
+                       db_updates_queue, wh_queue, gym_updates_queue)
+        if runtime is not None:
+            runtime.spawn(search_worker(*worker_args), 'search-worker-{}'.format(i))
+        else:
+            t = Thread(target=search_worker_thread,
+                       name='search-worker-{}'.format(i),
+                       args=worker_args)
+            t.daemon = True
+            t.start()
+
         # Create the appropriate type of scheduler to handle the search queue.
         scheduler = schedulers.SchedulerFactory.get_scheduler(args.scheduler, [search_items_queue], threadStatus, args)
         scheduler_array.append(scheduler)
 
-    # A place to track the current location
-    current_location = False    
+        return index
+
+    # Start gym worker i, getting the details of the gyms the search workers queue up
+    def add_gym_worker(i):
+        log.debug('Starting gym worker thread %d', i)
+
+        workerId = 'Gym Worker {:03}'.format(i)
+        threadStatus[workerId] = {
+            'type': 'Worker',
+            'message': 'Creating thread...',
+            'success': 0,
+            'fail': 0,
+            'noitems': 0,
+            'skip': 0,
+            'user': '',
+            'proxy_display': 'No',
+            'proxy_url': False,
+            'location': False,
+            'last_scan_time': 0,
+            'timings': PhaseTimer(),
+        }
+
+        worker_args = (args, account_pool, logins, proxy_pool, gym_index, gym_queue, recorder, pause_bit,
+                       encryption_lib_path, threadStatus[workerId], wh_queue, gym_updates_queue)
+        if runtime is not None:
+            runtime.spawn(gym_worker(*worker_args), 'gym-worker-{}'.format(i))
+        else:
+            t = Thread(target=gym_worker_thread,
+                       name='gym-worker-{}'.format(i),
+                       args=worker_args)
+            t.daemon = True
+            t.start()
+
+    # Create specified number of search_worker_thread
+    log.info('Starting search worker threads')
+    for i in worker_ids:
+        add_worker(i)
+    for i in gym_worker_ids:
+        add_gym_worker(i)
+
+    if runtime is not None:
+        runtime.start()
+
+    # A place to track the current location, and the locations of the workers around it
+    current_location = False
+    locations = None
+
+    # Hook up the remaining event sources. The first location was queued before we
+    # started listening, so queue an event for it by hand.
+    new_location_queue.on_put = partial(overseer_events.put, ('location', None))
+    pause_bit.add_listener(lambda paused: overseer_events.put(('pause', None)))
+    overseer_events.put(('location', None))
 
     # The real work starts here but will halt on pause_bit.set()
     while True:
 
+        # Only wake up on a timer when we have to notice the web UI going idle
+        timeout = None
+        if args.on_demand_timeout > 0 and not pause_bit.is_set():
+            timeout = max(heartb[0] + args.on_demand_timeout - now(), 1)
+
+        try:
+            event, value = overseer_events.get(timeout=timeout)
+        except Empty:
+            event, value = 'timeout', None
+
         if args.on_demand_timeout > 0 and (now() - args.on_demand_timeout) > heartb[0]:
             pause_bit.set()
             log.info("Searching paused due to inactivity...")
 
-        # Wait here while scanning is paused
-        while pause_bit.is_set():
+        # Empty the queues once and sleep until scanning is resumed. The event that woke us
+        # up is handled afterwards; drains and location changes that arrive meanwhile just queue up.
+        if pause_bit.is_set():
             for i in range(0, len(scheduler_array)):
                 scheduler_array[i].scanning_paused()
-            time.sleep(1)
+            threadStatus['Overseer']['message'] = 'Scanning is paused'
+            pause_bit.wait_for_resume()
+            threadStatus['Overseer']['message'] = 'Scanning resumed'
+            # Anything drained before the pause has been thrown away, so refill every queue
+            for i in range(0, len(search_items_queue_array)):
+                overseer_events.put(('drained', i))
 
         # If a new location has been passed to us, get the most recent one
-        if not new_location_queue.empty():
+        if event == 'location' and not new_location_queue.empty():
             log.info('New location caught, moving search grid')
             try:
                 while True:
                     current_location = new_location_queue.get_nowait()
             except Empty:
                 pass
-                     
-            locations = _generate_locations(current_location, args.step_limit, args.workers)
-                        
-            for i in range(0, args.workers):
-                scheduler_array[i].location_changed(locations[i])
-
-        # If there are no search_items_queue either the loop has finished (or been
-        # cleared above) -- either way, time to fill it back up
-        for i in range(0, len(search_items_queue_array)):
-            if search_items_queue_array[i].empty():
-                log.debug('Search queue empty, scheduling more items to scan')
-                scheduler_array[i].schedule()
-            # TODO: log the status
-            # else:
-                # nextitem = search_items_queue.queue[0]
-                # threadStatus['Overseer']['message'] = 'Processing search queue, next item is {:6f},{:6f}'.format(nextitem[1][0], nextitem[1][1])
-                # If times are specified, print the time of the next queue item, and how many seconds ahead/behind realtime
-                # if nextitem[2]:
-                    # threadStatus['Overseer']['message'] += ' @ {}'.format(time.strftime('%H:%M:%S', time.localtime(nextitem[2])))
-                    # if nextitem[2] > now():
-                        # threadStatus['Overseer']['message'] += ' ({}s ahead)'.format(nextitem[2] - now())
-                    # else:
-                        # threadStatus['Overseer']['message'] += ' ({}s behind)'.format(now() - nextitem[2])
-
-        # Now we just give a little pause here
+
+            if args.beehive:
+                locations = [(lat, lng, 0) for lat, lng in get_beehive_locations(current_location, args.step_limit, args.leaps)]
+            else:
+                locations = _generate_locations(current_location, args.step_limit, args.workers)
+
+            for index, i in enumerate(running_ids):
+                scheduler_array[index].location_changed(locations[i])
+                # location_changed() emptied the queue without necessarily draining it through a get
+                overseer_events.put(('drained', index))
+
+        # A worker has taken the last item of its search_items_queue, either because the loop
+        # has finished or because it was cleared above -- either way, time to fill it back up.
+        # It may already have been refilled by an earlier event, so check again.
+        if event == 'drained' and search_items_queue_array[value].empty():
+            log.debug('Search queue empty, scheduling more items to scan')
+            refill_search_queue(scheduler_array[value], search_items_queue_array[value], value, overseer_events, retrying)
+
+        # TODO: log the status
+        # else:
+            # nextitem = search_items_queue.queue[0]
+            # threadStatus['Overseer']['message'] = 'Processing search queue, next item is {:6f},{:6f}'.format(nextitem[1][0], nextitem[1][1])
+            # If times are specified, print the time of the next queue item, and how many seconds ahead/behind realtime
+            # if nextitem[2]:
+                # threadStatus['Overseer']['message'] += ' @ {}'.format(time.strftime('%H:%M:%S', time.localtime(nextitem[2])))
+                # if nextitem[2] > now():
+                    # threadStatus['Overseer']['message'] += ' ({}s ahead)'.format(nextitem[2] - now())
+                # else:
+                    # threadStatus['Overseer']['message'] += ' ({}s behind)'.format(now() - nextitem[2])
+
+        # Hive cells of a search process that died, see search_processes_overseer_thread()
+        if event == 'workers':
+            new_ids, accounts, new_gym_ids = value
+            log.info('Taking over %d workers, %d gym workers and %d accounts', len(new_ids), len(new_gym_ids), len(accounts))
+            for account in accounts:
+                args.accounts.append(account)
+                account_pool.add(account)
+            if args.mock == '':
+                logins.prepare(accounts, login_proxies)
+            for i in new_ids:
+                index = add_worker(i)
+                if locations is not None:
+                    scheduler_array[index].location_changed(locations[i])
+                    overseer_events.put(('drained', index))
+            args.gym_workers += len(new_gym_ids)
+            for i in new_gym_ids:
+                add_gym_worker(i)
+
+        if event == 'proxies':
+            for result in value:
+                proxy_pool.record(result)
+
+
+# Fills the search queue of worker index from its scheduler. A scheduler can come up empty, like a spawnpoint
+# scheduler before the area has been scanned, or any of them before there is a location. The worker then gets no
+# items to take, so no 'drained' event either: queue one after SCHEDULE_RETRY_SECONDS to ask the scheduler again.
+def refill_search_queue(scheduler, search_items_queue, index, overseer_events, retrying):
+    scheduler.schedule()
+    if not search_items_queue.empty() or index in retrying:
+        return
+
+    log.debug('Nothing to scan for worker %d, trying again in %d seconds', index, SCHEDULE_RETRY_SECONDS)
+    retrying.add(index)
+
+    def retry():
+        retrying.discard(index)
+        overseer_events.put(('drained', index))
+
+    t = Timer(SCHEDULE_RETRY_SECONDS, retry)
+    t.daemon = True
+    t.start()
+
+
+# Spreads the search workers over args.search_processes processes, each running its own search overseer for a
+# share of the workers and accounts. This thread passes location changes and pausing on to them, and collects
+# their finds into db_updates_queue and wh_queue, so there is still just one set of database and webhook threads.
+# When a process dies, its workers and accounts are moved to the remaining ones.
+#
+# The proxies are probed here, and the results sent to all processes. Each process does keep its own login
+# sessions (of its own accounts, so nothing is refreshed twice) and GymIndex, which every process loads from
+# the database in full at startup: a few MB per process for tens of thousands of gyms.
+def search_processes_overseer_thread(args, user_location, new_location_queue, pause_bit, heartb, encryption_lib_path, db_updates_queue, wh_queue, gym_updates_queue, status_registry=None):
+
+    log.info('Search process overseer starting')
+
+    threadStatus = {}
+    threadStatus['Overseer'] = {
+        'message': 'Initializing',
+        'type': 'Overseer',
+        'scheduler': args.scheduler
+    }
+
+    # Placeholders until the processes report in
+    for i in range(0, args.workers):
+        threadStatus['Worker {:03}'.format(i)] = {
+            'type': 'Worker',
+            'message': 'Starting process...',
+            'success': 0,
+            'fail': 0,
+            'noitems': 0,
+            'skip': 0,
+            'user': '',
+            'proxy_display': '',
+            'starttime': now(),
+        }
+
+    if args.print_status:
+        log.info('Starting status printer thread')
+        t = Thread(target=status_printer,
+                   name='status_printer',
+                   args=(threadStatus, Queue(), db_updates_queue, wh_queue, AccountPool(args, [])))
+        t.daemon = True
+        t.start()
+
+    if args.status_name is not None:
+        if status_registry is None:
+            status_registry = StatusRegistry(args.status_name)
+        log.info('Starting status writer thread')
+        status_registry.start(threadStatus)
+
+    # Everything the search processes send back
+    process_db_queue = multiprocessing.Queue()
+    process_wh_queue = multiprocessing.Queue()
+    process_gym_queue = multiprocessing.Queue()
+    status_queue = multiprocessing.Queue()
+
+    for name, source, target in (('db', process_db_queue, db_updates_queue), ('wh', process_wh_queue, wh_queue), ('gym', process_gym_queue, gym_updates_queue)):
+        t = Thread(target=queue_relay_thread, name='{}-relay'.format(name), args=(source, target))
+        t.daemon = True
+        t.start()
+
+    t = Thread(target=status_collector_thread, name='status-collector', args=(threadStatus, status_queue))
+    t.daemon = True
+    t.start()
+
+    register_worker_metrics(threadStatus)
+
+    overseer_events = Queue()
+
+    # Probe the proxies for all processes
+    def send_probe_results(results):
+        for process in processes.values():
+            process['control'].put(('proxies', results))
+
+    proxy_pool = ProxyPool(args, args.proxy or [], on_probe=send_probe_results)
+    proxy_pool.start()
+
+    # The search processes by number, with the workers (hive cells) and accounts they have been given
+    processes = {}
+    process_numbers = itertools.count()
+
+    # Start a search process for worker_ids, accounts and gym_worker_ids, caught up with the current pause state and location
+    def start_process(worker_ids, accounts, gym_worker_ids):
+        p = next(process_numbers)
+
+        process_args = copy.copy(args)
+        process_args.accounts = accounts
+        # Tells search workers whether this process has gym workers getting gym details
+        process_args.gym_workers = len(gym_worker_ids)
+        # On demand scanning and the status database are handled here
+        process_args.on_demand_timeout = 0
+        process_args.status_name = None
+
+        control_queue = multiprocessing.Queue()
+        control_queue.put(('pause', pause_bit.is_set()))
+        if current_location[0]:
+            control_queue.put(('location', current_location[0]))
+
+        log.info('Starting search process %d with %d workers and %d accounts', p, len(worker_ids), len(accounts))
+        proc = multiprocessing.Process(target=search_process,
+                                       name='search-process-{}'.format(p),
+                                       args=(process_args, user_location, worker_ids, gym_worker_ids, encryption_lib_path,
+                                             control_queue, process_db_queue, process_wh_queue, process_gym_queue, status_queue))
+        proc.daemon = True
+        proc.start()
+
+        processes[p] = {'process': proc, 'control': control_queue, 'workers': list(worker_ids), 'accounts': list(accounts),
+                        'gym_workers': list(gym_worker_ids)}
+
+        t = Thread(target=process_watcher_thread, name='process-watcher-{}'.format(p), args=(proc, p, overseer_events))
+        t.daemon = True
+        t.start()
+
+    # A place to track the current location; a list so start_process() sees changes to it
+    current_location = [False]
+
+    for p in range(0, args.search_processes):
+        start_process(range(p, args.workers, args.search_processes), args.accounts[p::args.search_processes],
+                      range(p, args.gym_workers, args.search_processes))
+
+    pause_bit.add_listener(lambda paused: overseer_events.put(('pause', None)))
+    new_location_queue.on_put = partial(overseer_events.put, ('location', None))
+    overseer_events.put(('pause', None))
+    overseer_events.put(('location', None))
+
+    while True:
+
+        # Only wake up on a timer when we have to notice the web UI going idle
+        timeout = None
+        if args.on_demand_timeout > 0 and not pause_bit.is_set():
+            timeout = max(heartb[0] + args.on_demand_timeout - now(), 1)
+
+        try:
+            event, value = overseer_events.get(timeout=timeout)
+        except Empty:
+            event, value = 'timeout', None
+
+        if args.on_demand_timeout > 0 and (now() - args.on_demand_timeout) > heartb[0]:
+            pause_bit.set()
+            log.info("Searching paused due to inactivity...")
+
+        if event == 'pause':
+            paused = pause_bit.is_set()
+            threadStatus['Overseer']['message'] = 'Scanning is paused' if paused else 'Running {} search processes'.format(len(processes))
+            for process in processes.values():
+                process['control'].put(('pause', paused))
+
+        if event == 'location' and not new_location_queue.empty():
+            log.info('New location caught, moving search grid')
+            try:
+                while True:
+                    current_location[0] = new_location_queue.get_nowait()
+            except Empty:
+                pass
+
+            for process in processes.values():
+                process['control'].put(('location', current_location[0]))
+
+        # Hand the hive cells and accounts of a dead search process to the others, round robin,
+        # or to a new process when there are no others left
+        if event == 'died':
+            dead = processes.pop(value)
+
+        # Processes ending on ctrl-c, or being terminated when we shut down, are left alone
+        if event == 'died' and dead['process'].exitcode in (0, -signal.SIGTERM):
+            log.info('Search process %d has stopped', value)
+        elif event == 'died':
+            log.error('Search process %d died with exit code %s, moving its %d workers to other processes',
+                      value, dead['process'].exitcode, len(dead['workers']))
+
+            for i in dead['workers']:
+                threadStatus['Worker {:03}'.format(i)]['message'] = 'Search process died, restarting worker elsewhere...'
+
+            if not processes:
+                start_process(dead['workers'], dead['accounts'], dead['gym_workers'])
+            else:
+                survivors = sorted(processes)
+                for n, p in enumerate(survivors):
+                    worker_ids = dead['workers'][n::len(survivors)]
+                    accounts = dead['accounts'][n::len(survivors)]
+                    gym_worker_ids = dead['gym_workers'][n::len(survivors)]
+                    if worker_ids or accounts or gym_worker_ids:
+                        processes[p]['workers'].extend(worker_ids)
+                        processes[p]['accounts'].extend(accounts)
+                        processes[p]['gym_workers'].extend(gym_worker_ids)
+                        processes[p]['control'].put(('workers', (worker_ids, accounts, gym_worker_ids)))
+
+            if not pause_bit.is_set():
+                threadStatus['Overseer']['message'] = 'Running {} search processes'.format(len(processes))
+
+
+# Entry point of the processes started by search_processes_overseer_thread
+def search_process(args, user_location, worker_ids, gym_worker_ids, encryption_lib_path, control_queue, db_updates_queue, wh_queue, gym_updates_queue, status_queue):
+
+    # The status printer of the main process owns the screen
+    if args.print_status:
+        logging.getLogger().handlers[0].setLevel(logging.CRITICAL)
+        args.print_status = False
+
+    pause_bit = SearchControl()
+    new_location_queue = SignalQueue()
+    overseer_events = Queue()
+
+    t = Thread(target=process_control_thread, name='process-control', args=(control_queue, pause_bit, new_location_queue, overseer_events))
+    t.daemon = True
+    t.start()
+
+    try:
+        search_overseer_thread(args, user_location, new_location_queue, pause_bit, [now()], encryption_lib_path,
+                               db_updates_queue, wh_queue, gym_updates_queue, worker_ids, status_queue, overseer_events, gym_worker_ids)
+    except KeyboardInterrupt:
+        pass
+
+
+# Applies the location changes, pausing, extra workers and proxy probe results sent by the main process
+def process_control_thread(control_queue, pause_bit, new_location_queue, overseer_events):
+    while True:
+        command, value = control_queue.get()
+        if command == 'pause':
+            if value:
+                pause_bit.set()
+            else:
+                pause_bit.clear()
+        elif command == 'location':
+            new_location_queue.put(value)
+        elif command in ('workers', 'proxies'):
+            overseer_events.put((command, value))
+
+
+# Tells the search process overseer when a search process has ended
+def process_watcher_thread(process, number, overseer_events):
+    process.join()
+    overseer_events.put(('died', number))
+
+
+# Moves everything the search processes send on source over to target
+def queue_relay_thread(source, target):
+    while True:
+        target.put(source.get())
+
+
+# Sends the status of the workers of a search process to the main process, once a second
+def status_relay_thread(threads_status, status_queue):
+    while True:
+        workers = {}
+        for name, status in threads_status.items():
+            if status['type'] == 'Worker':
+                workers[name] = dict(status)
+        status_queue.put(workers)
         time.sleep(1)
-        
+
+
+# Takes in the worker status sent by the search processes
+def status_collector_thread(threads_status, status_queue):
+    while True:
+        threads_status.update(status_queue.get())
+
+
 # Generates the list of locations to scan
 def _generate_locations(current_location, step_limit, worker_count):
     NORTH = 0
@@ -460,10 +969,26 @@ def _generate_locations(current_location, step_limit, worker_count):
     return results
 
 
-def search_worker_thread(args, user_location, account_queue, account_failures, search_items_queue, pause_bit, encryption_lib_path, status, dbq, whq):
+# Search items with an appearance time are due 10 seconds after it (a little grace period),
+# everything else right away.
+def search_item_ready_time(item):
+    appears = item[2]
+    return appears + 10 if appears else 0
+
+
+def search_worker_thread(*args):
+    run_in_thread(search_worker(*args))
+
+
+# The search worker itself. It is a generator that yields whatever it would otherwise block on
+# (see runtime.py), so it can run on its own thread or as a coroutine on a CoroutineRuntime.
+def search_worker(args, user_location, account_pool, logins, proxy_pool, gym_index, gym_queue, cell_cache, recorder, search_items_queue, pause_bit, encryption_lib_path, status, dbq, whq, gymq):
 
     log.debug('Search worker thread starting')
 
+    # Where the time goes
+    timer = status['timings']
+
     # The outer forever loop restarts only when the inner one is intentionally exited - which should only be done when the worker is failing too often, and probably banned.
     # This reinitializes the API and grabs a new account from the queue.
     while True:
@@ -471,14 +996,14 @@ def search_worker_thread(args, user_location, account_queue, account_failures, s
             status['starttime'] = now()
 
             # Get account
-            status['message'] = 'Waiting to get new account from the queue'
+            status['message'] = 'Waiting to get new account from the pool'
             log.info(status['message'])
-            account = account_queue.get()
+            account = yield wait_for_queue(account_pool)
             status['message'] = 'Switching to account {}'.format(account['username'])
             status['user'] = account['username']
             log.info(status['message'])
 
-            stagger_thread(args, account)
+            yield stagger_thread(args, account)
 
             # New lease of life right here
             status['fail'] = 0
@@ -491,17 +1016,11 @@ def search_worker_thread(args, user_location, account_queue, account_failures, s
             # only sleep when consecutive_fails reaches max_failures, overall fails for stat purposes
             consecutive_fails = 0
 
-            # Create the API instance this will use
-            if args.mock != '':
-                api = FakePogoApi(args.mock)
-            else:
-                api = PGoApi()
-
-            if status['proxy_url']:
-                log.debug("Using proxy %s", status['proxy_url'])
-                api.set_proxy({'http': status['proxy_url'], 'https': status['proxy_url']})
+            # Use the least loaded healthy proxy
+            switch_proxy(args, proxy_pool, status)
 
-            api.activate_signature(encryption_lib_path)
+            # Create the API instance this will use
+            api = yield Call(create_api, args, status, encryption_lib_path)
 
             # The forever loop for the searches
             while True:
@@ -510,42 +1029,50 @@ def search_worker_thread(args, user_location, account_queue, account_failures, s
                 if consecutive_fails >= args.max_failures:
                     status['message'] = 'Account {} failed more than {} scans; possibly bad account. Switching accounts...'.format(account['username'], args.max_failures)
                     log.warning(status['message'])
-                    account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'failures'})
+                    account_pool.release(account, 'failures')
+                    # Don't trust its session either
+                    yield Call(logins.forget, account)
                     break  # exit this loop to get a new account and have the API recreated
 
-                while pause_bit.is_set():
+                if pause_bit.is_set():
                     status['message'] = 'Scanning paused'
-                    time.sleep(2)
+                    yield wait_for_resume(pause_bit)
+
+                # If the proxy stopped working, move to another one, keeping the account and its session
+                if not proxy_pool.healthy(status['proxy_url']):
+                    previous = status['proxy_url']
+                    switch_proxy(args, proxy_pool, status)
+                    if status['proxy_url'] != previous:
+                        log.warning('Proxy %s stopped working, switching to proxy %s', previous, status['proxy_url'])
+                        proxy_config = {'http': status['proxy_url'], 'https': status['proxy_url']}
+                        api.set_proxy(proxy_config)
+                        if args.mock == '' and api._auth_provider is not None:
+                            api._auth_provider.set_proxy(proxy_config)
+                            logins.track(api, account, status['proxy_url'])
 
                 # If this account has been running too long, let it rest
                 if (args.account_search_interval is not None):
                     if (status['starttime'] <= (now() - args.account_search_interval)):
                         status['message'] = 'Account {} is being rotated out to rest.'.format(account['username'])
                         log.info(status['message'])
-                        account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'rest interval'})
+                        account_pool.release(account, 'rest interval')
                         break
 
+                # Spend any time we have before the next search item is due fetching gym details
+                if gym_queue.qsize():
+                    with timer.time('gym_details'):
+                        yield update_gyms(args, account, api, logins, gym_index, gym_queue, recorder, search_items_queue, status, whq, gymq)
+
                 # Grab the next thing to search (when available)
                 status['message'] = 'Waiting for item from queue'
-                step, step_location, appears, leaves = search_items_queue.get()
-
-                # too soon?
-                if appears and now() < appears + 10:  # adding a 10 second grace period
-                    first_loop = True
-                    paused = False
-                    while now() < appears + 10:
-                        if pause_bit.is_set():
-                            paused = True
-                            break  # why can't python just have `break 2`...
-                        remain = appears - now() + 10
-                        status['message'] = 'Early for {:6f},{:6f}; waiting {}s...'.format(step_location[0], step_location[1], remain)
-                        if first_loop:
-                            log.info(status['message'])
-                            first_loop = False
-                        time.sleep(1)
-                    if paused:
-                        search_items_queue.task_done()
-                        continue
+                remain = search_items_queue.next_ready_in()
+                if remain:
+                    nextitem = search_items_queue.peek()
+                    status['message'] = 'Early for {:6f},{:6f}; waiting {}s...'.format(nextitem[1][0], nextitem[1][1], int(remain))
+                    log.info(status['message'])
+                with timer.time('early_wait' if remain else 'queue_wait'):
+                    step, step_location, appears, leaves = yield wait_for_item(search_items_queue)
+                status['queued'] = search_items_queue.qsize()
 
                 # too late?
                 if leaves and now() > (leaves - args.min_seconds_left):
@@ -560,92 +1087,55 @@ def search_worker_thread(args, user_location, account_queue, account_failures, s
                 # Let the api know where we intend to be for this loop
                 # doing this before check_login so it does not also have to be done there
                 # when the auth token is refreshed
-                api.set_position(*step_location)
+                yield Call(api.set_position, *step_location)
 
                 # Ok, let's get started -- check our login status
-                check_login(args, account, api, step_location, status['proxy_url'])
+                with timer.time('login'):
+                    yield check_login(args, account, api, logins, step_location, status['proxy_url'])
 
                 # putting this message after the check_login so the messages aren't out of order
                 status['message'] = 'Searching at {:6f},{:6f}'.format(step_location[0], step_location[1])
                 log.info(status['message'])
 
                 # Make the actual request (finally!)
-                response_dict = map_request(api, step_location, args.jitter)
+                with timer.time('map_request'):
+                    response_dict = yield Call(map_request, api, step_location, args.jitter, cell_cache if args.since_timestamps else None)
 
                 # G'damnit, nothing back. Mark it up, sleep, carry on
                 if not response_dict:
                     status['fail'] += 1
+                    account_pool.record(account, 'fail')
                     consecutive_fails += 1
                     status['message'] = 'Invalid response at {:6f},{:6f}, abandoning location'.format(step_location[0], step_location[1])
                     log.error(status['message'])
-                    time.sleep(args.scan_delay)
+                    with timer.time('sleep'):
+                        yield Sleep(args.scan_delay)
                     continue
 
                 # Got the response, parse it out, send todo's to db/wh queues
                 try:
-                    parsed = parse_map(args, response_dict, step_location, user_location, dbq, whq)
+                    with timer.time('parse_map'):
+                        parsed = yield Call(parse_map, args, response_dict, step_location, user_location, dbq, whq, cell_cache)
+                    if recorder is not None:
+                        recorder.map(step_location, response_dict)
                     search_items_queue.task_done()
                     status[('success' if parsed['count'] > 0 else 'noitems')] += 1
+                    account_pool.record(account, 'success' if parsed['count'] > 0 else 'noitems')
                     consecutive_fails = 0
                     status['message'] = 'Search at {:6f},{:6f} completed with {} finds'.format(step_location[0], step_location[1], parsed['count'])
                     log.debug(status['message'])
                 except KeyError:
                     parsed = False
                     status['fail'] += 1
+                    account_pool.record(account, 'fail')
                     consecutive_fails += 1
                     status['message'] = 'Map parse failed at {:6f},{:6f}, abandoning location. {} may be banned.'.format(step_location[0], step_location[1], account['username'])
                     log.exception(status['message'])
 
-                # Get detailed information about gyms
+                # Queue up gyms we need detailed information about
                 if args.gym_info and parsed:
-                    # build up a list of gyms to update
-                    gyms_to_update = {}
-                    for gym in parsed['gyms'].values():
-                        # Can only get gym details within 1km of our position
-                        distance = calc_distance(step_location, [gym['latitude'], gym['longitude']])
-                        if distance < 1:
-                            # check if we already have details on this gym (if not, get them)
-                            try:
-                                record = GymDetails.get(gym_id=gym['gym_id'])
-                            except GymDetails.DoesNotExist as e:
-                                gyms_to_update[gym['gym_id']] = gym
-                                continue
-
-                            # if we have a record of this gym already, check if the gym has been updated since our last update
-                            if record.last_scanned < gym['last_modified']:
-                                gyms_to_update[gym['gym_id']] = gym
-                                continue
-                            else:
-                                log.debug('Skipping update of gym @ %f/%f, up to date', gym['latitude'], gym['longitude'])
-                                continue
-                        else:
-                            log.debug('Skipping update of gym @ %f/%f, too far away from our location at %f/%f (%fkm)', gym['latitude'], gym['longitude'], step_location[0], step_location[1], distance)
-
-                    if len(gyms_to_update):
-                        gym_responses = {}
-                        current_gym = 1
-                        status['message'] = 'Updating {} gyms for location {},{}...'.format(len(gyms_to_update), step_location[0], step_location[1])
-                        log.debug(status['message'])
-
-                        for gym in gyms_to_update.values():
-                            status['message'] = 'Getting details for gym {} of {} for location {},{}...'.format(current_gym, len(gyms_to_update), step_location[0], step_location[1])
-                            time.sleep(random.random() + 2)
-                            response = gym_request(api, step_location, gym)
-
-                            # make sure the gym was in range. (sometimes the API gets cranky about gyms that are ALMOST 1km away)
-                            if response['responses']['GET_GYM_DETAILS']['result'] == 2:
-                                log.warning('Gym @ %f/%f is out of range (%dkm), skipping', gym['latitude'], gym['longitude'], distance)
-                            else:
-                                gym_responses[gym['gym_id']] = response['responses']['GET_GYM_DETAILS']
-
-                            # increment which gym we're on (for status messages)
-                            current_gym += 1
-
-                        status['message'] = 'Processing details of {} gyms for location {},{}...'.format(len(gyms_to_update), step_location[0], step_location[1])
-                        log.debug(status['message'])
-
-                        if gym_responses:
-                            parse_gyms(args, gym_responses, whq)
+                    for gym in gyms_needing_details(gym_index, parsed['gyms'].values(), step_location):
+                        gym_queue.put(gym, step_location)
 
                 # Record the time and place the worker left off at
                 status['last_scan_time'] = now()
@@ -653,17 +1143,239 @@ def search_worker_thread(args, user_location, account_queue, account_failures, s
 
                 # Always delay the desired amount after "scan" completion
                 status['message'] += ', sleeping {}s until {}'.format(args.scan_delay, time.strftime('%H:%M:%S', time.localtime(time.time() + args.scan_delay)))
-                time.sleep(args.scan_delay)
+                with timer.time('sleep'):
+                    yield Sleep(args.scan_delay)
+
+        # Failing to log in is the account's fault, and counts against it
+        except TooManyLoginAttempts:
+            status['message'] = 'Account {} failed to log in. Switching accounts...'.format(account['username'])
+            log.warning(status['message'])
+            account_pool.release(account, 'login failures')
 
         # catch any process exceptions, log them, and continue the thread
         except Exception as e:
             status['message'] = 'Exception in search_worker using account {}. Restarting with fresh account. See logs for details.'.format(account['username'])
-            time.sleep(args.scan_delay)
+            yield Sleep(args.scan_delay)
             log.error('Exception in search_worker under account {} Exception message: {}'.format(account['username'], e))
-            account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'exception'})
+            account_pool.release(account, 'exception')
+
+
+# Create an API instance for a worker, using its proxy
+def create_api(args, status, encryption_lib_path):
+    if args.mock != '':
+        api = FakePogoApi(args.mock)
+    else:
+        api = PGoApi()
+
+    if status['proxy_url']:
+        log.debug("Using proxy %s", status['proxy_url'])
+        api.set_proxy({'http': status['proxy_url'], 'https': status['proxy_url']})
+
+    api.activate_signature(encryption_lib_path)
+    return api
+
+
+# Move a worker to the least loaded healthy proxy
+def switch_proxy(args, proxy_pool, status):
+    status['proxy_url'] = proxy_pool.assign(status['proxy_url'])
+    status['proxy_display'] = 'No'
+    if status['proxy_url']:
+        status['proxy_display'] = status['proxy_url']
+        if args.proxy_display.upper() != 'FULL':
+            status['proxy_display'] = proxy_pool.index(status['proxy_url'])
+
+
+# Pick the gyms from a scan that are in range for details, and that we have no (or outdated) details for
+def gyms_needing_details(gym_index, gyms, step_location):
+    outdated = []
+    origin = geo.Origin(step_location[0], step_location[1])
+    for gym in gyms:
+        # Can only get gym details within 1km of our position
+        distance = origin.distance(gym['latitude'], gym['longitude']) / 1000
+        if distance < 1:
+            # check if we have details on this gym that are newer than its last change (if not, get them)
+            if gym_index.needs_details(gym):
+                outdated.append(gym)
+            else:
+                log.debug('Skipping update of gym @ %f/%f, up to date', gym['latitude'], gym['longitude'])
+        else:
+            log.debug('Skipping update of gym @ %f/%f, too far away from our location at %f/%f (%fkm)', gym['latitude'], gym['longitude'], step_location[0], step_location[1], distance)
+
+    return outdated
+
+
+# Fetch details for gyms in the shared gym_queue, oldest first, from the worker's current location. Only gyms
+# in range of it are taken, so the worker never jumps to where another worker found a gym. Gym details give
+# way to timed search items (spawn scans) as soon as one is due, so they fill the time the worker would
+# otherwise sit idle waiting for an early item. Untimed items (hex scans) are always due, so for those a few
+# gym details are fetched between scans, unless there are gym workers for them.
+def update_gyms(args, account, api, logins, gym_index, gym_queue, recorder, search_items_queue, status, whq, gymq):
+    gym_responses = {}
+    taken = []
+
+    # Not scanned anything yet
+    location = status['location']
+    if not location:
+        return
+
+    try:
+        while True:
+            nextitem = search_items_queue.peek()
+            if nextitem is not None and search_items_queue.next_ready_in() <= 0:
+                if nextitem[2] or args.gym_workers or len(taken) >= GYMS_BETWEEN_SCANS:
+                    break
+
+            try:
+                gym, _ = gym_queue.get_near(location, GYM_DETAILS_RANGE)
+            except Empty:
+                break
+            taken.append(gym['gym_id'])
 
+            status['message'] = 'Getting details for gym @ {:6f},{:6f} ({} more waiting)...'.format(gym['latitude'], gym['longitude'], gym_queue.qsize())
+            log.debug(status['message'])
+            yield Sleep(random.random() + 2)
 
-def check_login(args, account, api, position, proxy_url):
+            yield Call(api.set_position, *location)
+            yield check_login(args, account, api, logins, location, status['proxy_url'])
+            response = yield Call(gym_request, api, location, gym)
+
+            if not response:
+                continue
+
+            # make sure the gym was in range. (sometimes the API gets cranky about gyms that are ALMOST 1km away)
+            if response['responses']['GET_GYM_DETAILS']['result'] == 2:
+                log.warning('Gym @ %f/%f is out of range (%fkm), skipping', gym['latitude'], gym['longitude'], calc_distance(location, [gym['latitude'], gym['longitude']]))
+            else:
+                gym_responses[gym['gym_id']] = response['responses']['GET_GYM_DETAILS']
+
+        if gym_responses:
+            status['message'] = 'Processing details of {} gyms...'.format(len(gym_responses))
+            log.debug(status['message'])
+            parse_gyms(args, gym_responses, whq, gymq)
+            gym_index.scanned(gym_responses.keys())
+            if recorder is not None:
+                recorder.gyms(gym_responses)
+    finally:
+        # Gyms we didn't get details for are queued again when they are seen next
+        for gym_id in taken:
+            gym_queue.done(gym_id)
+
+
+def gym_worker_thread(*args):
+    run_in_thread(gym_worker(*args))
+
+
+# Gets the details of the gyms the search workers queue up, on an account of its own
+def gym_worker(args, account_pool, logins, proxy_pool, gym_index, gym_queue, recorder, pause_bit, encryption_lib_path, status, whq, gymq):
+
+    log.debug('Gym worker thread starting')
+
+    # Where the time goes
+    timer = status['timings']
+
+    # Like search_worker(), the outer loop gets a new account and API, the inner one does the work
+    while True:
+        try:
+            status['starttime'] = now()
+
+            # Get account
+            status['message'] = 'Waiting to get new account from the pool'
+            log.info(status['message'])
+            account = yield wait_for_queue(account_pool)
+            status['message'] = 'Switching to account {}'.format(account['username'])
+            status['user'] = account['username']
+            log.info(status['message'])
+
+            yield stagger_thread(args, account)
+
+            status['fail'] = 0
+            status['success'] = 0
+            status['noitems'] = 0
+            status['location'] = False
+            status['last_scan_time'] = 0
+            consecutive_fails = 0
+
+            switch_proxy(args, proxy_pool, status)
+            api = yield Call(create_api, args, status, encryption_lib_path)
+
+            while True:
+
+                if consecutive_fails >= args.max_failures:
+                    status['message'] = 'Account {} failed more than {} gym requests; possibly bad account. Switching accounts...'.format(account['username'], args.max_failures)
+                    log.warning(status['message'])
+                    account_pool.release(account, 'failures')
+                    yield Call(logins.forget, account)
+                    break
+
+                if pause_bit.is_set():
+                    status['message'] = 'Scanning paused'
+                    yield wait_for_resume(pause_bit)
+
+                if (args.account_search_interval is not None):
+                    if (status['starttime'] <= (now() - args.account_search_interval)):
+                        status['message'] = 'Account {} is being rotated out to rest.'.format(account['username'])
+                        log.info(status['message'])
+                        account_pool.release(account, 'rest interval')
+                        break
+
+                status['message'] = 'Waiting for gyms that need details'
+                with timer.time('queue_wait'):
+                    gym, location = yield wait_for_queue(gym_queue)
+
+                try:
+                    status['message'] = 'Getting details for gym @ {:6f},{:6f} ({} more waiting)...'.format(gym['latitude'], gym['longitude'], gym_queue.qsize())
+                    log.debug(status['message'])
+
+                    yield Call(api.set_position, *location)
+                    with timer.time('login'):
+                        yield check_login(args, account, api, logins, location, status['proxy_url'])
+                    with timer.time('gym_details'):
+                        response = yield Call(gym_request, api, location, gym)
+
+                    if not response:
+                        status['fail'] += 1
+                        account_pool.record(account, 'fail')
+                        consecutive_fails += 1
+                        continue
+                    consecutive_fails = 0
+
+                    # make sure the gym was in range. (sometimes the API gets cranky about gyms that are ALMOST 1km away)
+                    details = response['responses']['GET_GYM_DETAILS']
+                    if details['result'] == 2:
+                        log.warning('Gym @ %f/%f is out of range (%fkm), skipping', gym['latitude'], gym['longitude'], calc_distance(location, [gym['latitude'], gym['longitude']]))
+                        status['noitems'] += 1
+                        account_pool.record(account, 'noitems')
+                    else:
+                        parse_gyms(args, {gym['gym_id']: details}, whq, gymq)
+                        gym_index.scanned([gym['gym_id']])
+                        if recorder is not None:
+                            recorder.gyms({gym['gym_id']: details})
+                        status['success'] += 1
+                        account_pool.record(account, 'success')
+
+                    status['last_scan_time'] = now()
+                    status['location'] = location
+                finally:
+                    gym_queue.done(gym['gym_id'])
+
+                # The same pace as gym details fetched between scans
+                with timer.time('sleep'):
+                    yield Sleep(random.random() + 2)
+
+        # Failing to log in is the account's fault, and counts against it
+        except TooManyLoginAttempts:
+            status['message'] = 'Account {} failed to log in. Switching accounts...'.format(account['username'])
+            log.warning(status['message'])
+            account_pool.release(account, 'login failures')
+
+        except Exception as e:
+            status['message'] = 'Exception in gym_worker using account {}. Restarting with fresh account. See logs for details.'.format(account['username'])
+            yield Sleep(args.scan_delay)
+            log.error('Exception in gym_worker under account {} Exception message: {}'.format(account['username'], e))
+            account_pool.release(account, 'exception')
+
+
+def check_login(args, account, api, logins, position, proxy_url):
 
     # Logged in? Enough time left? Cool!
     if api._auth_provider and api._auth_provider._ticket_expire:
@@ -672,28 +1384,39 @@ def check_login(args, account, api, position, proxy_url):
             log.debug('Credentials remain valid for another %f seconds', remaining_time)
             return
 
+    # A session from an earlier login (even from before a restart) is ready to go right away
+    if logins.restore(api, account, proxy_url):
+        return
+
     # Try to login (a few times, but don't get stuck here)
     i = 0
-    while i < args.login_retries:
+    while True:
         try:
             if proxy_url:
-                api.set_authentication(provider=account['auth_service'], username=account['username'], password=account['password'], proxy_config={'http': proxy_url, 'https': proxy_url})
+                yield Call(api.set_authentication, provider=account['auth_service'], username=account['username'], password=account['password'], proxy_config={'http': proxy_url, 'https': proxy_url})
             else:
-                api.set_authentication(provider=account['auth_service'], username=account['username'], password=account['password'])
-            break
+                yield Call(api.set_authentication, provider=account['auth_service'], username=account['username'], password=account['password'])
         except AuthException:
-            if i >= args.login_retries:
-                raise TooManyLoginAttempts('Exceeded login attempts')
-            else:
-                i += 1
-                log.error('Failed to login to Pokemon Go with account %s. Trying again in %g seconds', account['username'], args.login_delay)
-                time.sleep(args.login_delay)
+            pass
+        else:
+            # Only a login that got an access token is any good (and worth keeping)
+            if getattr(api._auth_provider, '_access_token', None):
+                break
+
+        i += 1
+        if i >= args.login_retries:
+            raise TooManyLoginAttempts('Exceeded login attempts')
+        log.error('Failed to login to Pokemon Go with account %s. Trying again in %g seconds', account['username'], args.login_delay)
+        yield Sleep(args.login_delay)
 
     log.debug('Login for account %s successful', account['username'])
-    time.sleep(20)
+    yield Call(logins.store, api, account, proxy_url)
+    # Give a fresh session a moment before it's used, as it always had
+    yield Sleep(args.login_wait)
 
 
-def map_request(api, position, jitter=False):
+# With a cell_cache, asks only for what changed in the map cells since they were last seen
+def map_request(api, position, jitter=False, cell_cache=None):
     # create scan_location to send to the api based off of position, because tuples aren't mutable
     if jitter:
         # jitter it, just a little bit.
@@ -705,7 +1428,10 @@ def map_request(api, position, jitter=False):
 
     try:
         cell_ids = util.get_cell_ids(scan_location[0], scan_location[1])
-        timestamps = [0, ] * len(cell_ids)
+        if cell_cache is not None:
+            timestamps = cell_cache.timestamps(cell_ids)
+        else:
+            timestamps = [0, ] * len(cell_ids)
         return api.get_map_objects(latitude=f2i(scan_location[0]),
                                    longitude=f2i(scan_location[1]),
                                    since_timestamp_ms=timestamps,
@@ -732,20 +1458,9 @@ def gym_request(api, position, gym):
         return False
 
 
+# The distance between two positions in km
 def calc_distance(pos1, pos2):
-    R = 6378.1  # km radius of the earth
-
-    dLat = math.radians(pos1[0] - pos2[0])
-    dLon = math.radians(pos1[1] - pos2[1])
-
-    a = math.sin(dLat / 2) * math.sin(dLat / 2) + \
-        math.cos(math.radians(pos1[0])) * math.cos(math.radians(pos2[0])) * \
-        math.sin(dLon / 2) * math.sin(dLon / 2)
-
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    d = R * c
-
-    return d
+    return geo.distance(pos1[0], pos1[1], pos2[0], pos2[1]) / 1000
 
 
 # Delay each thread start time so that logins only occur ~1s
@@ -754,7 +1469,7 @@ def stagger_thread(args, account):
         return  # No need to delay the first one
     delay = args.accounts.index(account) + ((random.random() - .5) / 2)
     log.debug('Delaying thread startup for %.2f seconds', delay)
-    time.sleep(delay)
+    yield Sleep(delay)
 
 
 class TooManyLoginAttempts(Exception):
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from datetime import datetime
+from threading import Lock, Thread
+
+from .models import MainWorker, WorkerStatus, bulk_upsert
+
+log = logging.getLogger(__name__)
+
+# How often changed statuses are written to the database, for the status pages of other instances
+STATUS_WRITE_INTERVAL = 10
+
+
+# The status of the overseer and workers of this instance, as shown on the status page, kept in memory.
+#
+# The status page of this instance is served straight from here. The database only gets the rows that
+# changed since they were last written, every STATUS_WRITE_INTERVAL seconds, so other instances can show
+# them on their status pages. These writes are done by a thread of their own, and don't wait behind the
+# scan results in the database updates queue.
+class StatusRegistry(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        # The status dicts of the overseer threads, see search_overseer_thread
+        self.threads_status = {}
+        # username: (row without last_modified, when it last changed)
+        self.rows = {}
+        # username: last_modified of the row as last written to the database
+        self.written = {}
+
+    def start(self, threads_status):
+        self.threads_status = threads_status
+
+        log.info("Clearing previous statuses for '%s' worker", self.name)
+        WorkerStatus.delete().where(WorkerStatus.worker_name == self.name).execute()
+
+        t = Thread(target=self._writer, name='status-writer')
+        t.daemon = True
+        t.start()
+
+    # The current rows of the overseer and of the workers, as (MainWorker row, {username: WorkerStatus row})
+    def snapshot(self):
+        current = datetime.utcnow()
+        overseer = None
+        workers = {}
+        for status in self.threads_status.values():
+            if status['type'] == 'Overseer':
+                overseer = {
+                    'worker_name': self.name,
+                    'message': status['message'],
+                    'method': status['scheduler'],
+                    'last_modified': current
+                }
+            # Workers that haven't got an account yet have nothing to show
+            elif status['type'] == 'Worker' and status['user']:
+                workers[status['user']] = {
+                    'username': status['user'],
+                    'worker_name': self.name,
+                    'success': status['success'],
+                    'fail': status['fail'],
+                    'no_items': status['noitems'],
+                    'skip': status['skip'],
+                    'message': status['message']
+                }
+
+        with self.lock:
+            for username, row in workers.items():
+                if username not in self.rows or self.rows[username][0] != row:
+                    self.rows[username] = (row, current)
+                workers[username] = dict(row, last_modified=self.rows[username][1])
+
+        return overseer, workers
+
+    def _writer(self):
+        while True:
+            time.sleep(STATUS_WRITE_INTERVAL)
+
+            overseer, workers = self.snapshot()
+            if overseer is None:
+                continue
+
+            changed = {username: row for username, row in workers.items()
+                       if self.written.get(username) != row['last_modified']}
+
+            # The overseer row is written every time, telling other instances this one is still around
+            bulk_upsert(MainWorker, {0: overseer})
+            if changed:
+                bulk_upsert(WorkerStatus, changed)
+
+            for username, row in changed.items():
+                self.written[username] = row['last_modified']
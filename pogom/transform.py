@@ -1,48 +1,114 @@
 import math
-import geopy
+
+from . import geo
+
+# NumPy isn't required, but transforms many coordinates at once much faster
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 a = 6378245.0
 ee = 0.00669342162296594323
 pi = 3.14159265358979324
 
+# Below this many coordinates, converting them to and from arrays costs more than NumPy saves
+NUMPY_MIN_POINTS = 16
+
+# Coordinates a cache of transform_rows_from_wgs_to_gcj holds before it's cleared
+GCJ_CACHE_SIZE = 100000
+
 
 def transform_from_wgs_to_gcj(latitude, longitude):
     if is_location_out_of_china(latitude, longitude):
         adjust_lat, adjust_lon = latitude, longitude
     else:
-        adjust_lat = transform_lat(longitude - 105, latitude - 35.0)
-        adjust_lon = transform_long(longitude - 105, latitude - 35.0)
-        rad_lat = latitude / 180.0 * pi
-        magic = math.sin(rad_lat)
-        magic = 1 - ee * magic * magic
-        math.sqrt_magic = math.sqrt(magic)
-        adjust_lat = (adjust_lat * 180.0) / ((a * (1 - ee)) / (magic * math.sqrt_magic) * pi)
-        adjust_lon = (adjust_lon * 180.0) / (a / math.sqrt_magic * math.cos(rad_lat) * pi)
+        adjust_lat, adjust_lon = gcj_offsets(latitude, longitude)
         adjust_lat += latitude
         adjust_lon += longitude
     #  print 'transfromed from ', wgs_loc, ' to ', adjust_loc
     return adjust_lat, adjust_lon
 
 
+def transform_from_wgs_to_gcj_batch(latitudes, longitudes):
+    """
+    transform_from_wgs_to_gcj for lists of latitudes and longitudes, returning
+    lists of the transformed latitudes and longitudes. With NumPy installed, they
+    are all transformed at once.
+    """
+    if numpy is None or len(latitudes) < NUMPY_MIN_POINTS:
+        points = [transform_from_wgs_to_gcj(lat, lng) for lat, lng in zip(latitudes, longitudes)]
+        return [p[0] for p in points], [p[1] for p in points]
+
+    latitudes = numpy.asarray(latitudes, dtype=float)
+    longitudes = numpy.asarray(longitudes, dtype=float)
+    out_of_china = (longitudes < 72.004) | (longitudes > 137.8347) | (latitudes < 0.8293) | (latitudes > 55.8271)
+    adjust_lat, adjust_lon = gcj_offsets(latitudes, longitudes, numpy)
+    return (numpy.where(out_of_china, latitudes, latitudes + adjust_lat).tolist(),
+            numpy.where(out_of_china, longitudes, longitudes + adjust_lon).tolist())
+
+
+def transform_rows_from_wgs_to_gcj(rows, cache=None):
+    """
+    Transforms the 'latitude' and 'longitude' of a list of dicts, like query
+    results, in place. With a cache (a dict), coordinates that were transformed
+    before are taken from it, which is worth it for things that don't move.
+    """
+    rows_to_transform = []
+    for row in rows:
+        transformed = cache.get((row['latitude'], row['longitude'])) if cache is not None else None
+        if transformed is None:
+            rows_to_transform.append(row)
+        else:
+            row['latitude'], row['longitude'] = transformed
+
+    if not rows_to_transform:
+        return rows
+
+    latitudes, longitudes = transform_from_wgs_to_gcj_batch([row['latitude'] for row in rows_to_transform],
+                                                            [row['longitude'] for row in rows_to_transform])
+    if cache is not None and len(cache) + len(rows_to_transform) > GCJ_CACHE_SIZE:
+        cache.clear()
+    for row, lat, lng in zip(rows_to_transform, latitudes, longitudes):
+        if cache is not None:
+            cache[(row['latitude'], row['longitude'])] = (lat, lng)
+        row['latitude'], row['longitude'] = lat, lng
+    return rows
+
+
+# The GCJ-02 offsets of coordinates in China, in degrees. m is the module to do
+# the math with: math for a single coordinate, numpy for arrays of them.
+def gcj_offsets(latitude, longitude, m=math):
+    adjust_lat = transform_lat(longitude - 105, latitude - 35.0, m)
+    adjust_lon = transform_long(longitude - 105, latitude - 35.0, m)
+    rad_lat = latitude / 180.0 * pi
+    magic = m.sin(rad_lat)
+    magic = 1 - ee * magic * magic
+    sqrt_magic = m.sqrt(magic)
+    adjust_lat = (adjust_lat * 180.0) / ((a * (1 - ee)) / (magic * sqrt_magic) * pi)
+    adjust_lon = (adjust_lon * 180.0) / (a / sqrt_magic * m.cos(rad_lat) * pi)
+    return adjust_lat, adjust_lon
+
+
 def is_location_out_of_china(latitude, longitude):
     if longitude < 72.004 or longitude > 137.8347 or latitude < 0.8293 or latitude > 55.8271:
         return True
     return False
 
 
-def transform_lat(x, y):
-    lat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * math.sqrt(abs(x))
-    lat += (20.0 * math.sin(6.0 * x * pi) + 20.0 * math.sin(2.0 * x * pi)) * 2.0 / 3.0
-    lat += (20.0 * math.sin(y * pi) + 40.0 * math.sin(y / 3.0 * pi)) * 2.0 / 3.0
-    lat += (160.0 * math.sin(y / 12.0 * pi) + 320 * math.sin(y * pi / 30.0)) * 2.0 / 3.0
+def transform_lat(x, y, m=math):
+    lat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * m.sqrt(abs(x))
+    lat += (20.0 * m.sin(6.0 * x * pi) + 20.0 * m.sin(2.0 * x * pi)) * 2.0 / 3.0
+    lat += (20.0 * m.sin(y * pi) + 40.0 * m.sin(y / 3.0 * pi)) * 2.0 / 3.0
+    lat += (160.0 * m.sin(y / 12.0 * pi) + 320 * m.sin(y * pi / 30.0)) * 2.0 / 3.0
     return lat
 
 
-def transform_long(x, y):
-    lon = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * math.sqrt(abs(x))
-    lon += (20.0 * math.sin(6.0 * x * pi) + 20.0 * math.sin(2.0 * x * pi)) * 2.0 / 3.0
-    lon += (20.0 * math.sin(x * pi) + 40.0 * math.sin(x / 3.0 * pi)) * 2.0 / 3.0
-    lon += (150.0 * math.sin(x / 12.0 * pi) + 300.0 * math.sin(x / 30.0 * pi)) * 2.0 / 3.0
+def transform_long(x, y, m=math):
+    lon = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * m.sqrt(abs(x))
+    lon += (20.0 * m.sin(6.0 * x * pi) + 20.0 * m.sin(2.0 * x * pi)) * 2.0 / 3.0
+    lon += (20.0 * m.sin(x * pi) + 40.0 * m.sin(x / 3.0 * pi)) * 2.0 / 3.0
+    lon += (150.0 * m.sin(x / 12.0 * pi) + 300.0 * m.sin(x / 30.0 * pi)) * 2.0 / 3.0
     return lon
 
 
@@ -51,6 +117,61 @@ def get_new_coords(init_loc, distance, bearing):
     Given an initial lat/lng, a distance(in kms), and a bearing (degrees),
     this will calculate the resulting lat/lng coordinates.
     """
-    origin = geopy.Point(init_loc[0], init_loc[1])
-    destination = geopy.distance.distance(kilometers=distance).destination(origin, bearing)
-    return (destination.latitude, destination.longitude)
+    return geo.destination(init_loc[0], init_loc[1], distance * 1000, bearing)
+
+
+def get_beehive_locations(location, steps, leaps):
+    """
+    Lays out a beehive: a hive cell at location, surrounded by rings of hive cells
+    (leaps counts the center as the first ring), each big enough to be scanned with
+    a step limit of steps. Returns the lat/lng of every cell, the center first.
+
+    This is the layout Tools/Hex-Beehive-Generator has always generated.
+    """
+    R = 6378137.0
+    r_hex = 52.5  # probably not correct
+
+    # Distance between the centers of neighbouring cells, in km
+    d_s = 2.0 * (2 * steps - 1) * r_hex / 1000.0
+    mod = math.degrees(math.atan(1.732 / (6 * (steps - 1) + 3)))
+
+    total_cells = leaps * (leaps - 1) * 3 + 1
+    locations = [(location[0], location[1])]
+
+    brng_s = 0.0
+    turns = 0               # number of turns made in this ring (0 to 6)
+    turn_steps = 0          # number of cells required to complete one turn of the ring
+    turn_steps_so_far = 0   # current cell number in this side of the current ring
+
+    for i in range(1, total_cells):
+        if turns == 6 or turn_steps == 0:
+            # we have completed a ring (or are starting the very first ring)
+            turns = 0
+            turn_steps += 1
+            turn_steps_so_far = 0
+
+        if turn_steps_so_far == 0:
+            brng = brng_s
+            d = turn_steps * d_s
+        else:
+            C = math.radians(60.0)  # inside angle of a regular hexagon
+            a = d_s / R * 2.0 * math.pi  # in radians get the arclength of the unit circle covered by d_s
+            b = turn_steps_so_far * d_s / turn_steps / R * 2.0 * math.pi  # percentage of a
+            # the first spherical law of cosines gives us the length of side c from known angle C
+            c = math.acos(math.cos(a) * math.cos(b) + math.sin(a) * math.sin(b) * math.cos(C))
+            # turn_steps here represents ring number because yay coincidence always the same. multiply by derived arclength and convert to meters
+            d = turn_steps * c * R / 2.0 / math.pi
+            # from the first spherical law of cosines we get the angle A from the side lengths a b c
+            A = math.acos((math.cos(b) - math.cos(a) * math.cos(c)) / (math.sin(c) * math.sin(a)))
+            brng = 60 * turns + math.degrees(A)
+
+        locations.append(get_new_coords(locations[0], d, brng + mod))
+
+        turn_steps_so_far += 1
+        if turn_steps_so_far >= turn_steps:
+            # make a turn
+            brng_s += 60.0
+            turns += 1
+            turn_steps_so_far = 0
+
+    return locations
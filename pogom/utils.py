@@ -2,14 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import bisect
 import configargparse
 import os
 import json
 import logging
 import shutil
 import platform
-import pprint
 import time
+import heapq
+import itertools
+
+from contextlib import contextmanager
+from threading import Condition, Lock
+from queue import Queue, Empty
 
 from . import config
 
@@ -54,6 +60,16 @@ def get_args():
                         help='Passwords, either single one for all accounts or one per account.')
     parser.add_argument('-w', '--workers', type=int,
                         help='Number of search worker threads to start. Defaults to the number of accounts specified.')
+    parser.add_argument('-wr', '--worker-runtime', choices=['threads', 'coroutines'], default='threads',
+                        help='How to run the search workers: one thread each, or as coroutines sharing a pool of threads. Use coroutines for large numbers of accounts.')
+    parser.add_argument('-wps', '--worker-pool-size', type=int, default=20,
+                        help='Number of threads doing API requests and database work for the coroutine worker runtime.')
+    parser.add_argument('-sp', '--search-processes', type=int, default=1,
+                        help='Number of processes to spread the search workers and accounts over, to use more than one CPU core. Results are still written to the database and webhooks by this process.')
+    parser.add_argument('-bh', '--beehive', action='store_true', default=False,
+                        help='Scan a beehive of hive cells around the location instead of one hive per worker. Every cell gets its own worker, scanning --step-limit steps. Use with --search-processes to replace the Hex-Beehive-Generator scripts.')
+    parser.add_argument('-lp', '--leaps', type=int, default=3,
+                        help='Number of rings of hive cells in the beehive, counting the center cell.')
     parser.add_argument('-asi', '--account-search-interval', type=int, default=0,
                         help='Seconds for accounts to search before switching to a new account. 0 to disable.')
     parser.add_argument('-ari', '--account-rest-interval', type=int, default=7200,
@@ -72,6 +88,10 @@ def get_args():
     parser.add_argument('-ld', '--login-delay',
                         help='Time delay between each login attempt',
                         type=float, default=5)
+    parser.add_argument('-lw', '--login-wait', type=float, default=20,
+                        help='Seconds a worker waits after logging an account in, before scanning with it. Accounts logged in ahead of time, or with a cached session, don\'t wait.')
+    parser.add_argument('-tc', '--token-cache', default=os.path.join('~', '.pogom', 'token_cache'),
+                        help='Directory to keep the login sessions of accounts in, so they don\'t need to log in again after a restart. Only readable by you, as they are as good as passwords. Set to an empty string to only keep them while running.')
     parser.add_argument('-lr', '--login-retries',
                         help='Number of logins attempts before refreshing a thread',
                         type=int, default=3)
@@ -141,7 +161,10 @@ def get_args():
     parser.add_argument('-px', '--proxy', help='Proxy url (e.g. socks5://127.0.0.1:9050)', action='append')
     parser.add_argument('-pxsc', '--proxy-skip-check', help='Disable checking of proxies before start', action='store_true', default=False)
     parser.add_argument('-pxt', '--proxy-timeout', help='Timeout settings for proxy checker in seconds ', type=int, default=5)
+    parser.add_argument('-pxct', '--proxy-check-threads', help='Number of threads checking proxies at the same time', type=int, default=100)
     parser.add_argument('-pxd', '--proxy-display', help='Display info on which proxy beeing used (index or full) To be used with -ps', type=str, default='index')
+    parser.add_argument('-pxu', '--proxy-test-url', help='URL proxies are checked against; it has to answer a POST request with status 200', type=str, default='https://pgorelease.nianticlabs.com/plfe/rpc')
+    parser.add_argument('-pxri', '--proxy-refresh-interval', help='Check the proxies again every this many seconds, moving workers off proxies that stop working (0 to disable)', type=int, default=300)
     parser.add_argument('--db-type', help='Type of database to be used (default: sqlite)',
                         default='sqlite')
     parser.add_argument('--db-name', help='Name of the database to be used')
@@ -161,8 +184,20 @@ def get_args():
                         action='append', dest='slack_rarities')
     parser.add_argument('-smd', '--slack-max-distance', help='Define the maximum distance for pokemon that will be posted to slack',
                         type=int, default=-1, dest='slack_max_distance')
+    parser.add_argument('-ncc', '--no-cell-cache', help='Parse all forts of every scan, also those of map cells that have not changed since they were last scanned',
+                        action='store_true', default=False)
+    parser.add_argument('--since-timestamps', help='Tell the API when map cells were last scanned, so it may leave out what has not changed since',
+                        action='store_true', default=False)
+    parser.add_argument('-rmo', '--record-map-objects', help='Record the map responses of all scans (and the gym details of -gi) to this gzipped file, to be replayed with --replay. With --search-processes every process writes its own file, named after this one',
+                        default=None, metavar='filename.json.gz')
+    parser.add_argument('--replay', help='Instead of scanning, feed the map responses recorded in these files with --record-map-objects through the database and webhooks. No accounts needed',
+                        nargs='+', default=None, metavar='filename.json.gz')
+    parser.add_argument('--replay-speed', help='Speed to replay at: 1 for the speed the responses were recorded at, 2 for twice as fast and so on, 0 for as fast as possible',
+                        type=float, default=1)
     parser.add_argument('-gi', '--gym-info', help='Get all details about gyms (causes an additional API hit for every gym)',
                         action='store_true', default=False)
+    parser.add_argument('-gw', '--gym-workers', help='Number of extra workers (and accounts) that only get gym details for -gi. Without them, search workers get gym details when they have time to spare',
+                        type=int, default=0)
     parser.add_argument('--disable-clean', help='Disable clean db loop',
                         action='store_true', default=False)
     parser.add_argument('--webhook-updates-only', help='Only send updates (pokémon & lured pokéstops)',
@@ -287,8 +322,10 @@ def get_args():
         num_usernames = 0
         num_passwords = 0
 
+        # Replaying recorded responses takes no accounts
         if len(args.username) == 0:
-            errors.append('Missing `username` either as -u/--username, csv file using -ac, or in config')
+            if not args.replay:
+                errors.append('Missing `username` either as -u/--username, csv file using -ac, or in config')
         else:
             num_usernames = len(args.username)
 
@@ -296,7 +333,8 @@ def get_args():
             errors.append('Missing `location` either as -l/--location or in config')
 
         if len(args.password) == 0:
-            errors.append('Missing `password` either as -p/--password, csv file, or in config')
+            if not args.replay:
+                errors.append('Missing `password` either as -p/--password, csv file, or in config')
         else:
             num_passwords = len(args.password)
 
@@ -332,17 +370,33 @@ def get_args():
         for i, username in enumerate(args.username):
             args.accounts.append({'username': username, 'password': args.password[i], 'auth_service': args.auth_service[i]})
 
+        # Gym workers need accounts of their own
+        if not args.gym_info:
+            args.gym_workers = 0
+
         # Make max workers equal number of accounts if unspecified, and disable account switching
         if args.workers is None:
-            args.workers = len(args.accounts)
+            args.workers = max(len(args.accounts) - args.gym_workers, 1)
             args.account_search_interval = None
 
+        # A beehive has a worker for every cell, and each worker needs an account
+        if args.beehive:
+            args.leaps = max(args.leaps, 1)
+            args.workers = args.leaps * (args.leaps - 1) * 3 + 1
+            if len(args.accounts) < args.workers + args.gym_workers and not args.replay:
+                print(sys.argv[0] + ": Error: a beehive of {} leaps has {} cells, so it needs at least {} accounts (one per cell and gym worker), but only {} were given".format(
+                    args.leaps, args.workers, args.workers + args.gym_workers, len(args.accounts)))
+                sys.exit(1)
+
+        # No point in having processes without workers
+        args.search_processes = max(min(args.search_processes, args.workers), 1)
+
         # Disable search interval if 0 specified
         if args.account_search_interval == 0:
             args.account_search_interval = None
 
         # Make sure we don't have an empty account list after adding command line and CSV accounts
-        if len(args.accounts) == 0:
+        if len(args.accounts) == 0 and not args.replay:
             print(sys.argv[0] + ": Error: no accounts specified. Use -a, -u, and -p or --accountcsv to add accounts")
             sys.exit(1)
 
@@ -468,19 +522,252 @@ def get_encryption_lib_path(args):
     return lib_path
 
 
-class Timer():
-
-    def __init__(self, name):
-        self.times = [(name, time.time(), 0)]
-
-    def add(self, step):
-        t = time.time()
-        self.times.append((step, t, round((t - self.times[-1][1]) * 1000)))
-
-    def checkpoint(self, step):
-        t = time.time()
-        self.times.append(('total @ ' + step, t, t - self.times[0][1]))
-
-    def output(self):
-        self.checkpoint('end')
-        pprint.pprint(self.times)
+# Pause switch shared by the web app, the overseer and the search workers.
+# It keeps the set()/clear()/is_set() interface of the threading.Event it replaces
+# ("set" means paused), but also lets threads block until scanning is resumed and
+# runs listeners on every pause/resume transition, so nobody has to poll it.
+class SearchControl(object):
+
+    def __init__(self):
+        self._cond = Condition()
+        self._paused = False
+        self._listeners = []
+
+    # Listeners are called with the new paused state, outside of the lock
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def set(self):
+        self._change(True)
+
+    def clear(self):
+        self._change(False)
+
+    def is_set(self):
+        return self._paused
+
+    # Event compatible: wait until scanning is paused. Returns True if it is.
+    def wait(self, timeout=None):
+        with self._cond:
+            if not self._paused:
+                self._cond.wait(timeout)
+            return self._paused
+
+    # Wait until scanning is resumed. Returns True if it is.
+    def wait_for_resume(self, timeout=None):
+        with self._cond:
+            while self._paused:
+                self._cond.wait(timeout)
+                if timeout is not None:
+                    break
+            return not self._paused
+
+    def _change(self, paused):
+        with self._cond:
+            changed = self._paused != paused
+            self._paused = paused
+            self._cond.notify_all()
+
+        if changed:
+            for callback in self._listeners:
+                callback(paused)
+
+
+# A Queue that calls on_put() after every put, and on_low() whenever a get leaves
+# low_watermark or fewer items behind. The overseer uses these to refill work queues
+# the moment they drain and to react to location changes without polling.
+class SignalQueue(Queue):
+
+    def __init__(self, maxsize=0, on_put=None, on_low=None, low_watermark=0):
+        Queue.__init__(self, maxsize)
+        self.on_put = on_put
+        self.on_low = on_low
+        self.low_watermark = low_watermark
+
+    # Both hooks run while the queue's mutex is held, so callbacks must not touch this queue.
+    def _put(self, item):
+        Queue._put(self, item)
+        if self.on_put is not None:
+            self.on_put()
+
+    def _get(self):
+        item = Queue._get(self)
+        if self.on_low is not None and self._qsize() <= self.low_watermark:
+            self.on_low()
+        return item
+
+
+# A SignalQueue that hands items out in the order they become ready rather than FIFO.
+# ready_time(item) gives the unix time an item may be processed at (0 for right away);
+# items that are ready at the same time keep their insertion order.
+# get() and get_nowait() ignore ready times (useful for emptying the queue), while
+# get_ready() blocks until the earliest item is due.
+class DelayQueue(SignalQueue):
+
+    def __init__(self, ready_time, **kwargs):
+        self.ready_time = ready_time
+        SignalQueue.__init__(self, **kwargs)
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.counter = itertools.count()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item):
+        heapq.heappush(self.queue, (self.ready_time(item), next(self.counter), item))
+        if self.on_put is not None:
+            self.on_put()
+
+    def _get(self):
+        item = heapq.heappop(self.queue)[2]
+        if self.on_low is not None and self._qsize() <= self.low_watermark:
+            self.on_low()
+        return item
+
+    # The item get_ready() would return next, or None if the queue is empty
+    def peek(self):
+        with self.mutex:
+            return self.queue[0][2] if self._qsize() else None
+
+    # Seconds until the earliest item is ready (0 if it already is), or None if the queue is empty
+    def next_ready_in(self):
+        with self.mutex:
+            if not self._qsize():
+                return None
+            return max(self.queue[0][0] - time.time(), 0)
+
+    # Remove and return the earliest item once it is ready. Raises Empty if nothing
+    # became ready within timeout seconds.
+    def get_ready(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.not_empty:
+            while True:
+                wait = None
+                if self._qsize():
+                    wait = self.queue[0][0] - time.time()
+                    if wait <= 0:
+                        item = self._get()
+                        self.not_full.notify()
+                        return item
+
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+
+                # put() notifies us, in case the new item is due before the current head
+                self.not_empty.wait(wait)
+
+
+# What the map cells looked like when they were last parsed, shared by the workers of an overseer. Forts of
+# cells that haven't changed since (a neighbouring worker scanned them moments ago) are already in the database
+# and sent to webhooks, so parse_map() skips them.
+class CellCache(object):
+
+    # What tells one version of a fort from another
+    FORT_FIELDS = ('id', 'last_modified_timestamp_ms', 'enabled', 'owned_by_team', 'guard_pokemon_id',
+                   'gym_points', 'active_fort_modifier')
+    # And from its lure_info: a pokestop's lure can be renewed without anything else about it changing
+    LURE_FIELDS = ('lure_expires_timestamp_ms', 'active_pokemon_id', 'encounter_id')
+
+    def __init__(self):
+        self.lock = Lock()
+        # s2_cell_id: (current_timestamp_ms, hash of its forts)
+        self.cells = {}
+
+    # When cell_ids were last seen, in ms (0 for cells we haven't seen), for since_timestamp_ms
+    def timestamps(self, cell_ids):
+        with self.lock:
+            return [self.cells.get(cell_id, (0, None))[0] for cell_id in cell_ids]
+
+    # Remember the forts of a map cell. Returns whether they changed since it was last seen.
+    def forts_changed(self, cell):
+        forts_hash = hash(frozenset(self._fort_version(f) for f in cell.get('forts', [])))
+        with self.lock:
+            previous = self.cells.get(cell['s2_cell_id'])
+            self.cells[cell['s2_cell_id']] = (cell.get('current_timestamp_ms', 0), forts_hash)
+        return previous is None or previous[1] != forts_hash
+
+    def _fort_version(self, fort):
+        version = tuple(map(fort.get, self.FORT_FIELDS))
+        lure = fort.get('lure_info')
+        if lure:
+            version += tuple(map(lure.get, self.LURE_FIELDS))
+        return version
+
+
+# Upper bounds, in seconds, of the buckets timings are counted in
+TIMING_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+
+# Counts of values in fixed buckets, with their sum and count, like a Prometheus histogram.
+# counts[i] is the number of values in (buckets[i - 1], buckets[i]].
+class Histogram(object):
+
+    def __init__(self, buckets=TIMING_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    # The upper bound of the bucket quantile q (0 to 1) of the values falls in, or None without values
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+# Times the phases of a worker's loop, each into a Histogram of its own. Phases can be timed with
+#
+#     with timer.time('map_request'):
+#         ...
+#
+# also around the yields of a worker generator.
+class PhaseTimer(object):
+
+    PHASES = ('queue_wait', 'early_wait', 'login', 'map_request', 'parse_map', 'gym_details', 'sleep')
+
+    def __init__(self):
+        # All phases up front, so the dict never changes while it is being copied or pickled
+        self.histograms = dict((phase, Histogram()) for phase in self.PHASES)
+
+    @contextmanager
+    def time(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.histograms[phase].observe(time.time() - start)
+
+    def merge(self, other):
+        for phase, histogram in other.histograms.items():
+            self.histograms[phase].merge(histogram)
+
+    # The timings of a set of workers (the threadStatus dicts they keep them in) taken together
+    @classmethod
+    def combined(cls, statuses):
+        timer = cls()
+        for status in statuses:
+            if status.get('timings') is not None:
+                timer.merge(status['timings'])
+        return timer
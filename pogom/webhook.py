@@ -3,7 +3,9 @@
 
 import logging
 import requests
+import time
 from .utils import get_args
+from .metrics import WEBHOOK_ERRORS, WEBHOOK_SEND_SECONDS
 
 log = logging.getLogger(__name__)
 
@@ -21,12 +23,16 @@ def send_to_webhook(message_type, message):
     }
 
     for w in args.webhooks:
+        start = time.time()
         try:
             requests.post(w, json=data, timeout=(None, 1))
         except requests.exceptions.ReadTimeout:
             log.debug('Response timeout on webhook endpoint %s', w)
+            WEBHOOK_ERRORS.inc(error='timeout')
         except requests.exceptions.RequestException as e:
             log.debug(e)
+            WEBHOOK_ERRORS.inc(error='request')
+        WEBHOOK_SEND_SECONDS.observe(time.time() - start, type=message_type)
 
 
 def wh_updater(args, q):
@@ -13,17 +13,20 @@ import json
 
 from distutils.version import StrictVersion
 
-from threading import Thread, Event
+from threading import Thread
 from queue import Queue
 from flask_cors import CORS
 from flask_cache_bust import init_cache_busting
 
 from pogom import config
 from pogom.app import Pogom
-from pogom.utils import get_args, get_encryption_lib_path, now
+from pogom.utils import get_args, get_encryption_lib_path, now, SearchControl, SignalQueue
 
-from pogom.search import search_overseer_thread
-from pogom.models import init_database, create_tables, drop_tables, Pokemon, db_updater, clean_db_loop
+from pogom.search import search_overseer_thread, search_processes_overseer_thread
+from pogom.status import StatusRegistry
+from pogom.replay import replay
+from pogom import metrics
+from pogom.models import init_database, create_tables, drop_tables, Pokemon, db_updater, gym_writer, clean_db_loop
 from pogom.webhook import wh_updater
 
 from pogom.proxy import check_proxies
@@ -201,7 +204,7 @@ def main():
     app.set_current_location(position)
 
     # Control the search status (running or not) across threads
-    pause_bit = Event()
+    pause_bit = SearchControl()
     pause_bit.clear()
     if args.on_demand_timeout > 0:
         pause_bit.set()
@@ -209,7 +212,7 @@ def main():
     heartbeat = [now()]
 
     # Setup the location tracking queue and push the first location on
-    new_location_queue = Queue()
+    new_location_queue = SignalQueue()
     new_location_queue.put(position)
 
     # DB Updates
@@ -222,6 +225,12 @@ def main():
         t.daemon = True
         t.start()
 
+    # Gym details are written on a thread of their own, a batch at a time
+    gym_updates_queue = Queue()
+    t = Thread(target=gym_writer, name='gym-writer', args=(args, gym_updates_queue))
+    t.daemon = True
+    t.start()
+
     # db clearner; really only need one ever
     if not args.disable_clean:
         t = Thread(target=clean_db_loop, name='db-cleaner', args=(args,))
@@ -238,13 +247,24 @@ def main():
         t.daemon = True
         t.start()
 
-    if not args.only_server:
+    metrics.register(metrics.Collected('pogom_queue_items', 'Items waiting to be written to the database or sent to webhooks, by queue.',
+                                       lambda: [({'queue': 'db'}, db_updates_queue.qsize()),
+                                                ({'queue': 'webhook'}, wh_updates_queue.qsize()),
+                                                ({'queue': 'gym'}, gym_updates_queue.qsize())]))
+
+    if args.replay:
+        # Feed recorded map responses through the database and webhooks instead of scanning
+        search_thread = Thread(target=replay, name='replay', args=(args, args.replay, args.replay_speed, position, db_updates_queue, wh_updates_queue, gym_updates_queue))
+        search_thread.daemon = True
+        search_thread.start()
+
+    elif not args.only_server:
 
         # Check all proxies before continue so we know they are good
         if args.proxy and not args.proxy_skip_check:
 
             # Overwrite old args.proxy with new working list
-            args.proxy = check_proxies(args)
+            args.proxy = [result['proxy'] for result in check_proxies(args) if result['status'] == 'ok']
 
         # Gather the pokemons!
 
@@ -256,10 +276,20 @@ def main():
                 file.write(json.dumps(spawns))
                 log.info('Finished exporting spawn points')
 
-        argset = (args, position, new_location_queue, pause_bit, heartbeat, encryption_lib_path, db_updates_queue, wh_updates_queue)
+        argset = (args, position, new_location_queue, pause_bit, heartbeat, encryption_lib_path, db_updates_queue, wh_updates_queue, gym_updates_queue)
+
+        # The status page of this instance shows the status of its workers straight from memory
+        status_registry = None
+        if args.status_name is not None:
+            status_registry = StatusRegistry(args.status_name)
+            app.set_status_registry(status_registry)
 
-        log.debug('Starting a %s search thread', args.scheduler)
-        search_thread = Thread(target=search_overseer_thread, name='search-overseer', args=argset)
+        if args.search_processes > 1:
+            log.debug('Starting a %s search thread for %d processes', args.scheduler, args.search_processes)
+            search_thread = Thread(target=search_processes_overseer_thread, name='search-overseer', args=argset, kwargs={'status_registry': status_registry})
+        else:
+            log.debug('Starting a %s search thread', args.scheduler)
+            search_thread = Thread(target=search_overseer_thread, name='search-overseer', args=argset, kwargs={'status_registry': status_registry})
         search_thread.daemon = True
         search_thread.start()
 
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# pogom.models reads the command line when it's imported, so give it one that parses
+# instead of the test runner's, with a database of its own
+sys.argv = ['runserver.py', '-l', '40.7128,-74.0060', '-u', 'user', '-p', 'password', '-k', 'key',
+            '-D', os.path.join(tempfile.mkdtemp(), 'pogom.db')]
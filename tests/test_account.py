@@ -0,0 +1,92 @@
+import time
+import unittest
+
+from argparse import Namespace
+
+from queue import Empty
+
+import pogom.account
+
+from pogom.account import AccountPool, MAX_COOLDOWN_FACTOR
+
+REST = 100
+
+
+def account(username):
+    return {'username': username, 'password': 'password', 'auth_service': 'ptc'}
+
+
+# Stands in for the time module in pogom.account, so accounts can rest without the tests waiting for them
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+class AccountPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        pogom.account.time = self.clock
+        self.args = Namespace(account_rest_interval=REST, max_failures=5)
+        self.pool = AccountPool(self.args, [account('a')])
+
+    def tearDown(self):
+        pogom.account.time = time
+
+    # Take the account, record the results of its scans, release it and let it rest. Returns for how long.
+    def stint(self, reason, *results):
+        taken = self.pool.get_nowait()
+        for result in results:
+            self.pool.record(taken, result)
+        self.pool.release(taken, reason)
+
+        rest = self.pool.get_resting()[0][1] - self.clock.now
+        self.clock.now += rest
+        return rest
+
+    def test_healthiest_first(self):
+        pool = AccountPool(self.args, [account('a'), account('b'), account('c')])
+        results = {'a': 'fail', 'b': 'success', 'c': 'noitems'}
+        for i in range(3):
+            taken = pool.get_nowait()
+            pool.record(taken, results[taken['username']])
+            pool.release(taken, 'rest interval')
+        self.clock.now += REST
+        self.assertEqual([pool.get_nowait()['username'] for i in range(3)], ['b', 'a', 'c'])
+        self.assertRaises(Empty, pool.get_nowait)
+
+    def test_rest_interval(self):
+        self.assertEqual(self.stint('rest interval', 'success'), REST)
+
+    def test_cooldowns_double(self):
+        self.assertEqual([self.stint('failures', 'fail', 'success') for i in range(2)], [REST, REST])
+        self.assertEqual([self.stint('failures', 'fail') for i in range(6)],
+                         [REST * 2, REST * 4, REST * 8, REST * 16, REST * 16, REST * 16])
+
+    def test_success_ends_strikes(self):
+        self.stint('failures', 'fail')
+        self.stint('failures', 'fail')
+        self.assertEqual(self.stint('failures', 'fail', 'success', 'fail'), REST)
+
+    def test_exceptions_are_no_strikes(self):
+        self.assertEqual(self.stint('failures', 'fail'), REST)
+        self.assertEqual(self.stint('exception', 'fail'), REST)
+        self.assertEqual(self.stint('exception'), REST)
+        self.assertEqual(self.stint('failures', 'fail'), REST * 2)
+
+    def test_ban_suspected(self):
+        self.assertEqual(self.stint('failures', *['noitems'] * 5), REST * MAX_COOLDOWN_FACTOR)
+        self.assertTrue(self.pool.accounts['a']['ban_suspected'])
+        self.assertEqual(self.stint('rest interval', 'success'), REST)
+        self.assertFalse(self.pool.accounts['a']['ban_suspected'])
+
+    def test_resting(self):
+        self.pool.release(self.pool.get_nowait(), 'rest interval')
+        self.assertRaises(Empty, self.pool.get_nowait)
+        self.assertEqual((self.pool.qsize(), self.pool.resting_count()), (0, 1))
+        self.clock.now += REST
+        self.assertEqual(self.pool.get_nowait()['username'], 'a')
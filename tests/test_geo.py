@@ -0,0 +1,53 @@
+import random
+import unittest
+
+from geopy.distance import vincenty
+
+from pogom import geo
+
+
+class GeoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(42)
+
+    def points(self, count, max_meters):
+        for i in range(count):
+            lat = self.random.uniform(-80, 80)
+            lng = self.random.uniform(-180, 180)
+            meters = self.random.uniform(0, max_meters)
+            bearing = self.random.uniform(0, 360)
+            yield lat, lng, meters, bearing
+
+    # Within the error the module docstring claims, compared to geopy
+    def test_destination(self):
+        for lat, lng, meters, bearing in self.points(200, 10000):
+            expected = vincenty(meters=meters).destination((lat, lng), bearing)
+            self.assertLess(vincenty(geo.destination(lat, lng, meters, bearing), (expected.latitude, expected.longitude)).meters, 0.08)
+
+    def test_distance(self):
+        for lat, lng, meters, bearing in self.points(200, 10000):
+            lat2, lng2 = geo.destination(lat, lng, meters, bearing)
+            self.assertAlmostEqual(geo.distance(lat, lng, lat2, lng2), vincenty((lat, lng), (lat2, lng2)).meters, delta=0.03)
+
+    def test_destinations(self):
+        steps = [(100, 0), (1000, 90), (5000, 225)]
+        self.assertEqual(geo.destinations(40.0, -74.0, steps), [geo.destination(40.0, -74.0, m, b) for m, b in steps])
+
+    def test_antimeridian(self):
+        lat, lng = geo.destination(0.0, 179.9995, 200, 90)
+        self.assertTrue(-180 <= lng < -179.99)
+        self.assertAlmostEqual(geo.distance(0.0, 179.9995, lat, lng), 200, places=3)
+        self.assertAlmostEqual(geo.Origin(0.0, 179.9995).distance(lat, lng), 200, places=3)
+
+    def test_origin(self):
+        for lat, lng, meters, bearing in self.points(50, 10000):
+            origin = geo.Origin(lat, lng)
+            lats, lngs = zip(*geo.destinations(lat, lng, [(self.random.uniform(0, meters), self.random.uniform(0, 360)) for i in range(40)]))
+            expected = [geo.distance(lat, lng, lat2, lng2) for lat2, lng2 in zip(lats, lngs)]
+
+            for distance, expected_distance in zip(origin.distances(lats, lngs), expected):
+                self.assertAlmostEqual(distance, expected_distance, delta=expected_distance * 1e-7 + 1e-6)
+            # Without NumPy, or with too few points for it
+            for distance, expected_distance in zip(origin.distances(lats[:3], lngs[:3]), expected):
+                self.assertAlmostEqual(distance, expected_distance, delta=expected_distance * 1e-7 + 1e-6)
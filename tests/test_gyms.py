@@ -0,0 +1,62 @@
+import unittest
+
+from datetime import datetime, timedelta
+
+from queue import Empty
+
+from pogom import geo
+from pogom.gyms import GymDetailQueue, GymIndex
+
+
+def gym(gym_id, lat=40.0, lng=-74.0, last_modified=None):
+    return {'gym_id': gym_id, 'latitude': lat, 'longitude': lng, 'last_modified': last_modified or datetime.utcnow()}
+
+
+class GymIndexTest(unittest.TestCase):
+
+    def test_needs_details(self):
+        index = GymIndex()
+        self.assertTrue(index.needs_details(gym('a')))
+
+        index.scanned(['a'])
+        self.assertFalse(index.needs_details(gym('a', last_modified=datetime.utcnow() - timedelta(minutes=1))))
+        self.assertTrue(index.needs_details(gym('a', last_modified=datetime.utcnow() + timedelta(minutes=1))))
+        self.assertTrue(index.needs_details(gym('b')))
+
+
+class GymDetailQueueTest(unittest.TestCase):
+
+    def test_oldest_first(self):
+        queue = GymDetailQueue()
+        queue.put(gym('a'), (40.0, -74.0, 0))
+        queue.put(gym('b'), (40.0, -74.0, 0))
+        self.assertEqual(queue.get_nowait()[0]['gym_id'], 'a')
+        self.assertEqual(queue.get(timeout=0)[0]['gym_id'], 'b')
+        self.assertRaises(Empty, queue.get, timeout=0)
+
+    def test_queued_once(self):
+        queue = GymDetailQueue()
+        queue.put(gym('a'), (40.0, -74.0, 0))
+        queue.put(gym('a'), (40.0, -74.0, 0))
+        self.assertEqual(queue.qsize(), 1)
+
+        # Not even while it's being fetched
+        queue.get_nowait()
+        queue.put(gym('a'), (40.0, -74.0, 0))
+        self.assertEqual(queue.qsize(), 0)
+
+        queue.done('a')
+        queue.put(gym('a'), (40.0, -74.0, 0))
+        self.assertEqual(queue.qsize(), 1)
+
+    def test_get_near(self):
+        queue = GymDetailQueue()
+        far_lat, far_lng = geo.destination(40.0, -74.0, 5000, 90)
+        near_lat, near_lng = geo.destination(40.0, -74.0, 900, 0)
+        queue.put(gym('far', far_lat, far_lng), (far_lat, far_lng, 0))
+        queue.put(gym('near', near_lat, near_lng), (near_lat, near_lng, 0))
+
+        self.assertEqual(queue.get_near((40.0, -74.0, 0), 1000)[0]['gym_id'], 'near')
+        self.assertRaises(Empty, queue.get_near, (40.0, -74.0, 0), 1000)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(queue.get_near((far_lat, far_lng, 0), 1000)[0]['gym_id'], 'far')
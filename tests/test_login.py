@@ -0,0 +1,167 @@
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from argparse import Namespace
+
+from pgoapi import PGoApi
+from pgoapi.exceptions import AuthException
+
+from pogom import runtime
+from pogom.account import LoginManager
+from pogom.search import TooManyLoginAttempts, check_login
+
+ACCOUNT = {'username': 'user', 'password': 'password', 'auth_service': 'ptc'}
+
+
+class FakeProvider(object):
+
+    def __init__(self, access_token):
+        self._access_token = access_token
+        self._access_token_expiry = 0
+        self._refresh_token = None
+        self._ticket_expire = None
+
+
+# An API whose logins raise or get the access tokens given, in turn
+class FakeApi(object):
+
+    def __init__(self, *results):
+        self._auth_provider = None
+        self.results = list(results)
+        self.logins = 0
+
+    def set_authentication(self, **kwargs):
+        self.logins += 1
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        self._auth_provider = FakeProvider(result)
+
+
+# Like runtime.run_in_thread(), without sleeping
+def run(worker):
+    stack = [worker]
+    value, exc_info = None, None
+    while True:
+        instruction = runtime._advance(stack, value, exc_info)
+        value, exc_info = None, None
+        if instruction is None:
+            return
+        elif isinstance(instruction, runtime.Call):
+            try:
+                value = instruction()
+            except Exception as e:
+                exc_info = (type(e), e, None)
+
+
+class CheckLoginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.args = Namespace(login_retries=3, login_delay=0, login_wait=20)
+        self.logins = LoginManager()
+
+    def test_login(self):
+        api = FakeApi(AuthException(), 'token')
+        run(check_login(self.args, ACCOUNT, api, self.logins, (40.0, -74.0, 0), None))
+        self.assertEqual(api.logins, 2)
+        self.assertEqual(self.logins.sessions['user']['access_token'], 'token')
+
+    def test_failed_logins(self):
+        api = FakeApi(AuthException(), AuthException(), AuthException())
+        with self.assertRaises(TooManyLoginAttempts):
+            run(check_login(self.args, ACCOUNT, api, self.logins, (40.0, -74.0, 0), None))
+        self.assertEqual(api.logins, 3)
+        self.assertEqual(self.logins.sessions, {})
+
+    def test_login_without_access_token(self):
+        api = FakeApi(None, None, None)
+        with self.assertRaises(TooManyLoginAttempts):
+            run(check_login(self.args, ACCOUNT, api, self.logins, (40.0, -74.0, 0), None))
+        self.assertEqual(self.logins.sessions, {})
+
+
+class LoginManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.logins = LoginManager(self.cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def logged_in(self, access_token='token'):
+        api = PGoApi()
+        api._auth_provider = FakeProvider(access_token)
+        return api
+
+    def test_restore(self):
+        self.logins.store(self.logged_in(), ACCOUNT, None)
+
+        # Also after a restart
+        for logins in (self.logins, LoginManager(self.cache_dir)):
+            api = PGoApi()
+            self.assertTrue(logins.restore(api, ACCOUNT, None))
+            self.assertEqual(api._auth_provider._access_token, 'token')
+
+    def test_cache_only_for_us(self):
+        cache_dir = os.path.join(self.cache_dir, 'nested', 'token_cache')
+        LoginManager(cache_dir).store(self.logged_in(), ACCOUNT, None)
+        self.assertEqual(stat.S_IMODE(os.stat(cache_dir).st_mode) & 0o077, 0)
+        for filename in os.listdir(cache_dir):
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(cache_dir, filename)).st_mode) & 0o077, 0)
+
+    def test_restore_expired(self):
+        self.logins.store(self.logged_in(), ACCOUNT, None)
+        self.logins.sessions['user']['login_time'] = time.time() - 7200
+        self.assertFalse(self.logins.restore(PGoApi(), ACCOUNT, None))
+
+    def test_restore_other_auth_service(self):
+        self.logins.store(self.logged_in(), ACCOUNT, None)
+        self.assertFalse(self.logins.restore(PGoApi(), dict(ACCOUNT, auth_service='google'), None))
+
+    def test_no_access_token(self):
+        self.logins.store(self.logged_in(None), ACCOUNT, None)
+        self.assertEqual(self.logins.sessions, {})
+        self.assertFalse(self.logins.restore(PGoApi(), ACCOUNT, None))
+
+    def test_forget(self):
+        self.logins.store(self.logged_in(), ACCOUNT, None)
+        self.logins.forget(ACCOUNT)
+        self.assertFalse(self.logins.restore(PGoApi(), ACCOUNT, None))
+        self.assertFalse(LoginManager(self.cache_dir).restore(PGoApi(), ACCOUNT, None))
+
+    def test_refresh_after_forget(self):
+        api = self.logged_in()
+        self.logins.store(api, ACCOUNT, None)
+        live = list(self.logins.live.values())
+        self.logins.forget(ACCOUNT)
+        # As if forgotten while the refresher was going through the sessions in use
+        self.logins.live['user'] = live[0]
+        self.logins.refresh()
+        self.assertEqual(self.logins.sessions, {})
+
+    def test_prepare(self):
+        logged_in = []
+
+        def login(account, proxy_url):
+            logged_in.append((account['username'], proxy_url))
+            if account['username'] == 'fails':
+                raise AuthException()
+            return self.logged_in('token of ' + account['username'])
+
+        self.logins._login = login
+        self.logins.store(self.logged_in(), ACCOUNT, None)
+        self.logins.track(PGoApi(), dict(ACCOUNT, username='working'), None)
+
+        accounts = [dict(ACCOUNT, username=username) for username in ('user', 'working', 'new', 'fails', 'other')]
+        self.logins.prepare(accounts, lambda: ['http://proxy1:8080', 'http://proxy2:8080']).join(5)
+
+        self.assertEqual(logged_in, [('new', 'http://proxy1:8080'), ('fails', 'http://proxy2:8080'), ('other', 'http://proxy1:8080')])
+        self.assertEqual(sorted(self.logins.sessions), ['new', 'other', 'user'])
+        api = PGoApi()
+        self.assertTrue(self.logins.restore(api, accounts[2], None))
+        self.assertEqual(api._auth_provider._access_token, 'token of new')
@@ -0,0 +1,119 @@
+import copy
+import threading
+import unittest
+
+from datetime import datetime, timedelta
+
+from flask import Flask
+from queue import Queue
+
+from pogom import config, models
+from pogom.models import Gym, GymDetails, GymMember, bulk_touch, bulk_upsert, create_tables, gym_writer, init_database, parse_map
+from pogom.utils import CellCache
+
+
+def snapshot(gym_id, name='Gym', members=()):
+    return {gym_id: {
+        'details': {'gym_id': gym_id, 'name': name, 'description': None, 'url': 'url', 'last_scanned': datetime.utcnow()},
+        'members': [{'gym_id': gym_id, 'pokemon_uid': uid} for uid in members],
+        'pokemon': [],
+        'trainers': [],
+    }}
+
+
+class GymWriterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = init_database(Flask(__name__))
+        create_tables(cls.db)
+
+    def setUp(self):
+        GymMember.delete().execute()
+        GymDetails.delete().execute()
+        self.write_gym_snapshots = models.write_gym_snapshots
+        self.queue = Queue()
+        t = threading.Thread(target=gym_writer, args=(models.args, self.queue))
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        models.write_gym_snapshots = self.write_gym_snapshots
+
+    # join() returns once the snapshots are in the database
+    def test_write(self):
+        self.queue.put(snapshot('a', members=['1', '2']))
+        self.queue.put(snapshot('b'))
+        self.queue.put(snapshot('a', 'Renamed', members=['3']))
+        self.queue.join()
+
+        self.assertEqual(dict(GymDetails.select(GymDetails.gym_id, GymDetails.name).tuples()), {'a': 'Renamed', 'b': 'Gym'})
+        self.assertEqual([m.pokemon_uid for m in GymMember.select()], ['3'])
+
+    def test_empty(self):
+        self.queue.put({})
+        self.queue.join()
+        self.assertEqual(GymDetails.select().count(), 0)
+
+    def test_failed_write(self):
+        failures = []
+
+        def write_gym_snapshots(snapshots):
+            if not failures:
+                failures.append(snapshots)
+                raise Exception('database is locked')
+            self.write_gym_snapshots(snapshots)
+
+        models.write_gym_snapshots = write_gym_snapshots
+        self.queue.put(snapshot('a'))
+        self.queue.join()
+
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(GymDetails.select().count(), 1)
+
+
+class SeenGymsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = init_database(Flask(__name__))
+        create_tables(cls.db)
+
+    def setUp(self):
+        Gym.delete().execute()
+        self.config = dict(config)
+        config['parse_pokemon'] = config['parse_pokestops'] = config['parse_gyms'] = True
+
+    def tearDown(self):
+        config.update(self.config)
+
+    def test_parse_map(self):
+        args = copy.copy(models.args)
+        args.webhooks = []
+        args.slack_webhooks = []
+        args.gym_info = False
+        gym = {'id': 'gym', 'latitude': 40.0, 'longitude': -74.0, 'enabled': True, 'last_modified_timestamp_ms': 1000,
+               'owned_by_team': 1, 'guard_pokemon_id': 16, 'gym_points': 100}
+        response = {'responses': {'GET_MAP_OBJECTS': {'map_cells': [{'s2_cell_id': 1, 'current_timestamp_ms': 2000, 'forts': [gym]}]}}}
+        cache = CellCache()
+
+        first = Queue()
+        parse_map(args, response, (40.0, -74.0, 0), (40.0, -74.0, 0), first, Queue(), cache)
+        self.assertEqual([(model, sorted(data)) for model, data in first.queue if model is Gym], [(Gym, ['gym'])])
+
+        # Skipped, but still seen
+        again = Queue()
+        parse_map(args, response, (40.0, -74.0, 0), (40.0, -74.0, 0), again, Queue(), cache)
+        self.assertEqual([(model, data) for model, data in again.queue if model is Gym], [(Gym, ['gym'])])
+
+    def test_bulk_touch(self):
+        long_ago = datetime.utcnow() - timedelta(days=1)
+        bulk_upsert(Gym, {i: {'gym_id': str(i), 'team_id': 1, 'guard_pokemon_id': 16, 'gym_points': 100, 'enabled': True,
+                              'latitude': 40.0, 'longitude': -74.0, 'last_modified': long_ago, 'last_scanned': long_ago}
+                          for i in range(3)})
+        bulk_touch(Gym, ['0', '2'])
+
+        recent = datetime.utcnow() - timedelta(minutes=1)
+        gyms = dict((gym.gym_id, gym) for gym in Gym.select())
+        self.assertEqual(sorted(gym_id for gym_id, gym in gyms.items() if gym.last_scanned > recent), ['0', '2'])
+        self.assertEqual(gyms['0'].gym_points, 100)
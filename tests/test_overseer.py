@@ -0,0 +1,82 @@
+import threading
+import time
+import unittest
+
+from queue import Queue
+
+from pogom import search
+from pogom.utils import DelayQueue, SearchControl, SignalQueue
+
+
+class EmptyScheduler(object):
+    def __init__(self):
+        self.calls = 0
+
+    def schedule(self):
+        self.calls += 1
+
+
+class OneItemScheduler(EmptyScheduler):
+    def __init__(self, queue):
+        super(OneItemScheduler, self).__init__()
+        self.queue = queue
+
+    def schedule(self):
+        super(OneItemScheduler, self).schedule()
+        self.queue.put((1, (40.0, -74.0, 0), 0, 0))
+
+
+class RefillSearchQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.retry_seconds = search.SCHEDULE_RETRY_SECONDS
+        search.SCHEDULE_RETRY_SECONDS = 0.05
+        self.events = Queue()
+        self.queue = DelayQueue(search.search_item_ready_time)
+
+    def tearDown(self):
+        search.SCHEDULE_RETRY_SECONDS = self.retry_seconds
+
+    def test_empty_schedule_is_retried(self):
+        retrying = set()
+        search.refill_search_queue(EmptyScheduler(), self.queue, 3, self.events, retrying)
+        self.assertEqual(retrying, set([3]))
+        self.assertEqual(self.events.get(timeout=5), ('drained', 3))
+        self.assertEqual(retrying, set())
+
+    def test_one_retry_per_worker(self):
+        retrying = set()
+        scheduler = EmptyScheduler()
+        search.refill_search_queue(scheduler, self.queue, 0, self.events, retrying)
+        search.refill_search_queue(scheduler, self.queue, 0, self.events, retrying)
+        self.assertEqual(scheduler.calls, 2)
+        self.assertEqual(self.events.get(timeout=5), ('drained', 0))
+        time.sleep(0.1)
+        self.assertTrue(self.events.empty())
+
+    def test_no_retry_when_items_were_scheduled(self):
+        retrying = set()
+        search.refill_search_queue(OneItemScheduler(self.queue), self.queue, 0, self.events, retrying)
+        self.assertEqual(retrying, set())
+        self.assertEqual(self.queue.qsize(), 1)
+
+
+class ProcessControlTest(unittest.TestCase):
+
+    def test_commands(self):
+        control = Queue()
+        pause_bit = SearchControl()
+        new_location_queue = SignalQueue()
+        events = Queue()
+        t = threading.Thread(target=search.process_control_thread, args=(control, pause_bit, new_location_queue, events))
+        t.daemon = True
+        t.start()
+
+        control.put(('proxies', [{'proxy': 'http://proxy1:8080', 'status': 'ok', 'latency': 0.1, 'error': None}]))
+        self.assertEqual(events.get(timeout=5)[0], 'proxies')
+        control.put(('workers', ([1], [], [])))
+        self.assertEqual(events.get(timeout=5), ('workers', ([1], [], [])))
+        control.put(('location', (40.0, -74.0, 0)))
+        self.assertEqual(new_location_queue.get(timeout=5), (40.0, -74.0, 0))
+        control.put(('pause', True))
+        self.assertTrue(pause_bit.wait(5))
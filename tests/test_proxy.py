@@ -0,0 +1,80 @@
+import unittest
+
+from argparse import Namespace
+
+from queue import Queue
+
+from pogom import proxy
+from pogom.proxy import PROXY_MAX_FAILURES, ProxyPool
+
+PROXIES = ['http://proxy1:8080', 'http://proxy2:8080', 'http://proxy3:8080']
+
+
+def ok(proxy, latency=0.1):
+    return {'proxy': proxy, 'status': 'ok', 'latency': latency, 'error': None}
+
+
+def error(proxy):
+    return {'proxy': proxy, 'status': 'error', 'latency': None, 'error': 'Failed to connect to proxy {}'.format(proxy)}
+
+
+class ProxyPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.args = Namespace(proxy_refresh_interval=0.01, proxy_test_url='https://example.com', proxy_timeout=1,
+                              proxy_check_threads=2)
+        self.pool = ProxyPool(self.args, PROXIES)
+        self.probe_proxies = proxy.probe_proxies
+
+    def tearDown(self):
+        proxy.probe_proxies = self.probe_proxies
+
+    def test_no_proxies(self):
+        pool = ProxyPool(self.args, [])
+        self.assertEqual(pool.assign(), False)
+        self.assertTrue(pool.healthy(False))
+
+    def test_least_loaded(self):
+        self.pool.record(ok(PROXIES[0], 0.3))
+        self.pool.record(ok(PROXIES[1], 0.1))
+        self.pool.record(ok(PROXIES[2], 0.2))
+        self.assertEqual([self.pool.assign() for i in range(4)], [PROXIES[1], PROXIES[2], PROXIES[0], PROXIES[1]])
+
+        # Moving a worker from one proxy to another
+        self.assertEqual(self.pool.assign(PROXIES[0]), PROXIES[0])
+        self.assertEqual([self.pool.stats[p]['workers'] for p in PROXIES], [1, 2, 1])
+
+    def test_unhealthy(self):
+        for i in range(PROXY_MAX_FAILURES * 2):
+            self.pool.record(ok(PROXIES[0]))
+        for i in range(PROXY_MAX_FAILURES):
+            self.assertTrue(self.pool.healthy(PROXIES[0]))
+            self.pool.record(error(PROXIES[0]))
+        self.assertFalse(self.pool.healthy(PROXIES[0]))
+        self.assertAlmostEqual(self.pool.error_rate(PROXIES[0]), 1.0 / 3)
+        self.assertNotIn(PROXIES[0], [self.pool.assign() for i in range(4)])
+
+        self.pool.record(ok(PROXIES[0]))
+        self.assertTrue(self.pool.healthy(PROXIES[0]))
+
+    def test_all_unhealthy(self):
+        for p in PROXIES:
+            for i in range(PROXY_MAX_FAILURES):
+                self.pool.record(error(p))
+        self.assertIn(self.pool.assign(), PROXIES)
+
+    def test_on_probe(self):
+        results = [ok(p) for p in PROXIES]
+        proxy.probe_proxies = lambda proxies, test_url, timeout, threads: results
+        probed = Queue()
+
+        def on_probe(results):
+            # Once is enough
+            self.args.proxy_refresh_interval = 3600
+            probed.put(results)
+
+        pool = ProxyPool(self.args, PROXIES, on_probe=on_probe)
+        pool.start()
+
+        self.assertEqual(probed.get(timeout=5), results)
+        self.assertAlmostEqual(pool.latency(PROXIES[0]), 0.1)
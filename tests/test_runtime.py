@@ -0,0 +1,120 @@
+import threading
+import time
+import unittest
+
+from queue import Queue
+
+from pogom.runtime import CoroutineRuntime, Call, Sleep, run_in_thread, wait_for_item, wait_for_queue
+from pogom.utils import DelayQueue
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+class RunInThreadTest(unittest.TestCase):
+
+    def test_call(self):
+        results = []
+
+        def worker():
+            results.append((yield Call(sum, [1, 2, 3])))
+
+        run_in_thread(worker())
+        self.assertEqual(results, [6])
+
+    def test_exception_thrown_back(self):
+        results = []
+
+        def worker():
+            try:
+                yield Call(fail, 'nope')
+            except ValueError as e:
+                results.append(str(e))
+
+        run_in_thread(worker())
+        self.assertEqual(results, ['nope'])
+
+    def test_nested(self):
+        results = []
+
+        def inner():
+            yield Sleep(0)
+            yield Call(fail, 'inner')
+
+        def worker():
+            try:
+                yield inner()
+            except ValueError as e:
+                results.append(str(e))
+            results.append((yield Call(len, 'abc')))
+
+        run_in_thread(worker())
+        self.assertEqual(results, ['inner', 3])
+
+    def test_unhandled(self):
+        def worker():
+            yield Call(fail, 'unhandled')
+
+        self.assertRaises(ValueError, run_in_thread, worker())
+
+    def test_wait(self):
+        queue = Queue()
+        queue.put('item')
+        results = []
+
+        def worker():
+            results.append((yield wait_for_queue(queue)))
+
+        run_in_thread(worker())
+        self.assertEqual(results, ['item'])
+
+
+class CoroutineRuntimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runtime = CoroutineRuntime(4)
+        self.runtime.start()
+
+    def test_workers(self):
+        done = Queue()
+
+        def worker(i):
+            yield Sleep(0.01 * i)
+            result = yield Call(pow, i, 2)
+            done.put(result)
+
+        for i in range(10):
+            self.runtime.spawn(worker(i), 'worker-{}'.format(i))
+        self.assertEqual(sorted(done.get(timeout=5) for i in range(10)), [i * i for i in range(10)])
+
+    # A worker blocked in a Call doesn't hold up the others
+    def test_blocking_call(self):
+        release = threading.Event()
+        done = Queue()
+
+        def blocked():
+            yield Call(release.wait, 5)
+            done.put('blocked')
+
+        def other():
+            yield Sleep(0)
+            done.put('other')
+
+        self.runtime.spawn(blocked(), 'blocked')
+        self.runtime.spawn(other(), 'other')
+        self.assertEqual(done.get(timeout=5), 'other')
+        release.set()
+        self.assertEqual(done.get(timeout=5), 'blocked')
+
+    def test_wait_for_item(self):
+        queue = DelayQueue(lambda item: item[0])
+        done = Queue()
+
+        def worker():
+            done.put((yield wait_for_item(queue)))
+
+        self.runtime.spawn(worker(), 'worker')
+        queue.put((time.time() + 60, 'later'))
+        queue.put((0, 'now'))
+        self.assertEqual(done.get(timeout=5), (0, 'now'))
@@ -0,0 +1,102 @@
+import threading
+import time
+import unittest
+
+from queue import Empty
+
+from pogom.utils import CellCache, DelayQueue, SearchControl, SignalQueue
+
+
+class SearchControlTest(unittest.TestCase):
+
+    def test_listeners(self):
+        control = SearchControl()
+        changes = []
+        control.add_listener(changes.append)
+        control.set()
+        control.set()
+        control.clear()
+        self.assertEqual(changes, [True, False])
+        self.assertFalse(control.is_set())
+
+    def test_wait_for_resume(self):
+        control = SearchControl()
+        control.set()
+        self.assertFalse(control.wait_for_resume(0.01))
+        threading.Timer(0.01, control.clear).start()
+        self.assertTrue(control.wait_for_resume())
+
+
+class SignalQueueTest(unittest.TestCase):
+
+    def test_signals(self):
+        signals = []
+        queue = SignalQueue(on_put=lambda: signals.append('put'), on_low=lambda: signals.append('low'), low_watermark=1)
+        queue.put(1)
+        queue.put(2)
+        queue.put(3)
+        queue.get()
+        queue.get()
+        queue.get()
+        self.assertEqual(signals, ['put', 'put', 'put', 'low', 'low'])
+
+
+class DelayQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = DelayQueue(lambda item: item[0])
+
+    def test_order(self):
+        for item in [(3, 'c'), (0, 'a'), (3, 'd'), (1, 'b')]:
+            self.queue.put(item)
+        self.assertEqual(self.queue.peek(), (0, 'a'))
+        self.assertEqual([self.queue.get_ready(0)[1] for i in range(4)], ['a', 'b', 'c', 'd'])
+        self.assertIsNone(self.queue.peek())
+        self.assertIsNone(self.queue.next_ready_in())
+
+    def test_get_ready_waits(self):
+        self.queue.put((time.time() + 60, 'later'))
+        self.assertGreater(self.queue.next_ready_in(), 59)
+        self.assertRaises(Empty, self.queue.get_ready, 0.01)
+
+        # An item that is due earlier wakes up get_ready()
+        threading.Timer(0.01, self.queue.put, ((0, 'now'),)).start()
+        self.assertEqual(self.queue.get_ready(5), (0, 'now'))
+
+        # get() ignores ready times
+        self.assertEqual(self.queue.get_nowait()[1], 'later')
+
+    def test_on_low(self):
+        drained = []
+        queue = DelayQueue(lambda item: 0, on_low=lambda: drained.append(True))
+        queue.put('a')
+        queue.put('b')
+        queue.get_ready()
+        self.assertEqual(drained, [])
+        queue.get_ready()
+        self.assertEqual(drained, [True])
+
+
+class CellCacheTest(unittest.TestCase):
+
+    def cell(self, **fort):
+        fort = dict({'id': 'stop', 'last_modified_timestamp_ms': 1000, 'enabled': True, 'type': 1}, **fort)
+        return {'s2_cell_id': 1, 'current_timestamp_ms': 2000, 'forts': [fort]}
+
+    def test_forts_changed(self):
+        cache = CellCache()
+        self.assertEqual(cache.timestamps([1, 2]), [0, 0])
+        self.assertTrue(cache.forts_changed(self.cell()))
+        self.assertFalse(cache.forts_changed(self.cell()))
+        self.assertEqual(cache.timestamps([1, 2]), [2000, 0])
+        self.assertTrue(cache.forts_changed(self.cell(last_modified_timestamp_ms=3000)))
+
+    def test_lure(self):
+        cache = CellCache()
+        lure = {'lure_expires_timestamp_ms': 5000, 'active_pokemon_id': 16, 'encounter_id': 1}
+        cache.forts_changed(self.cell(active_fort_modifier='lure', lure_info=lure))
+        self.assertFalse(cache.forts_changed(self.cell(active_fort_modifier='lure', lure_info=dict(lure))))
+
+        # Renewed, or with another pokemon
+        self.assertTrue(cache.forts_changed(self.cell(active_fort_modifier='lure', lure_info=dict(lure, lure_expires_timestamp_ms=9000))))
+        self.assertTrue(cache.forts_changed(self.cell(active_fort_modifier='lure', lure_info=dict(lure, lure_expires_timestamp_ms=9000, active_pokemon_id=19, encounter_id=2))))